@@ -1,4 +1,6 @@
 #define INF 9999999999
+// Sentinel for int labels outside the image (INF does not fit in an int).
+#define LINF 2147483647
 #define PLATEAU 0
 #define BLOCK_SIZE 8
 
@@ -16,7 +18,7 @@ __constant__ int N_ys[26] = {0,-1,-1,-1,0,1,1,1,0,-1,-1,-1,0,1,1,1,0,-1,-1,-1,0,
 __constant__ int N_zs[26] = {-1,-1,-1,-1,-1,-1,-1,-1,-1,0,0,0,0,0,0,0,0,1,1,1,1,1,1,1,1,1};
 
 // Step 1. Label local minima or flatland as PLATEAU
-__global__ void descent_kernel(double* labeled, const int w, const int h, const int d)
+__global__ void descent_kernel(int* labeled, const int w, const int h, const int d)
 {
   int tx = threadIdx.x;  int ty = threadIdx.y; int tz = threadIdx.z;
   int bx = blockIdx.x;   int by = blockIdx.y; int bz = blockIdx.z;
@@ -75,14 +77,14 @@ __global__ void descent_kernel(double* labeled, const int w, const int h, const
 
 }
 //step1B stabilize the plateau and remove saddle points
-__global__ void stabilize_kernel(double* L, int* C, const int w, const int h, const int d)
+__global__ void stabilize_kernel(int* L, int* C, const int w, const int h, const int d)
 {
   int tx = threadIdx.x;  int ty = threadIdx.y; int tz = threadIdx.z;
   int bx = blockIdx.x;   int by = blockIdx.y; int bz = blockIdx.z;
   int bdx = blockDim.x;  int bdy = blockDim.y; int bdz = blockDim.z;
   int i = bdx * bx + tx; int j = bdy * by + ty; int k = bdz * bz + tz;
  
-  __shared__ double s_L[BLOCK_SIZE*BLOCK_SIZE*BLOCK_SIZE];
+  __shared__ int s_L[BLOCK_SIZE*BLOCK_SIZE*BLOCK_SIZE];
   __shared__ float s_I[BLOCK_SIZE*BLOCK_SIZE*BLOCK_SIZE];
   int img_x = L2I(i,tx);
   int img_y = L2I(j,ty);
@@ -97,7 +99,7 @@ __global__ void stabilize_kernel(double* L, int* C, const int w, const int h, co
 
   if ((img_x < 0) || (img_y < 0) || (img_z < 0) ||
      (img_x == w) || (img_y == h) || (img_z == d)) {
-     s_L[INDEX(tz,ty,tx,BLOCK_SIZE)] = INF;
+     s_L[INDEX(tz,ty,tx,BLOCK_SIZE)] = LINF;
      s_I[INDEX(tz,ty,tx,BLOCK_SIZE)] = INF;
   } else {
     s_L[s_p] = L[INDEX(img_z,img_y,img_x,w)];
@@ -112,7 +114,7 @@ __global__ void stabilize_kernel(double* L, int* C, const int w, const int h, co
     for (int kk = 0; kk < 26; kk++) {
       int n_x = N_xs[kk] + tx; int n_y = N_ys[kk] + ty; int n_z = N_zs[kk] + tz;
       int s_q = INDEX(n_z,n_y,n_x,BLOCK_SIZE);
-      if (s_L[s_q] == INF) continue;
+      if (s_L[s_q] == LINF) continue;
       if ( s_I[s_q] == s_I[s_p] && s_L[s_q] < 0 ) {
         s_L[s_p] = s_L[s_q];
         break;
@@ -126,7 +128,7 @@ __global__ void stabilize_kernel(double* L, int* C, const int w, const int h, co
 }
 
 // Step 2A: change the PLATEAU labels to be location p+1
-__global__ void increment_kernel(double* L, const int w, const int h, const int d)
+__global__ void increment_kernel(int* L, const int w, const int h, const int d)
 {
   int i = blockDim.x * blockIdx.x + threadIdx.x;
   int j = blockDim.y * blockIdx.y + threadIdx.y;
@@ -139,14 +141,14 @@ __global__ void increment_kernel(double* L, const int w, const int h, const int
 }
 
 // Step 2B. Propagate the labels of the plateaus (iterate till convergence)
-__global__ void minima_kernel(double* L, int* C, const int w, const int h, const int d)
+__global__ void minima_kernel(int* L, int* C, const int w, const int h, const int d)
 {
   int tx = threadIdx.x;  int ty = threadIdx.y; int tz = threadIdx.z;
   int bx = blockIdx.x;   int by = blockIdx.y; int bz = blockIdx.z;
   int bdx = blockDim.x;  int bdy = blockDim.y; int bdz = blockDim.z;
   int i = bdx * bx + tx; int j = bdy * by + ty; int k = bdz * bz + tz;
  
-  __shared__ double s_L[BLOCK_SIZE*BLOCK_SIZE*BLOCK_SIZE];
+  __shared__ int s_L[BLOCK_SIZE*BLOCK_SIZE*BLOCK_SIZE];
   int size = BLOCK_SIZE - 2;
   int img_x = L2I(i,tx);
   int img_y = L2I(j,ty);
@@ -164,7 +166,7 @@ __global__ void minima_kernel(double* L, int* C, const int w, const int h, const
 
   if ((img_x < 0) || (img_y < 0) || (img_z < 0) ||
      (img_x == w) || (img_y == h) || (img_z == d)) {
-     s_L[INDEX(tz,ty,tx,BLOCK_SIZE)] = INF;
+     s_L[INDEX(tz,ty,tx,BLOCK_SIZE)] = LINF;
   } else {
     s_L[s_p] = L[INDEX(img_z,img_y,img_x,w)];
   }
@@ -177,7 +179,7 @@ __global__ void minima_kernel(double* L, int* C, const int w, const int h, const
     for (int kk = 0; kk < 26; kk++) {
       int n_x = N_xs[kk] + tx; int n_y = N_ys[kk] + ty; int n_z = N_zs[kk] + tz;
       int s_q = INDEX(n_z,n_y,n_x,BLOCK_SIZE);
-      if (s_L[s_q] == INF) continue;
+      if (s_L[s_q] == LINF) continue;
       if (s_L[s_q] > s_L[s_p]) //if not plateau, propagete to lower image values
                                //if plateau propagate to higher indices
         s_L[s_p] = s_L[s_q];
@@ -191,14 +193,14 @@ __global__ void minima_kernel(double* L, int* C, const int w, const int h, const
 
 
 // Step 3.
-__global__ void plateau_kernel(double* L, int* C, const int w, const int h, const int d)
+__global__ void plateau_kernel(int* L, int* C, const int w, const int h, const int d)
 {
   int tx = threadIdx.x;  int ty = threadIdx.y; int tz = threadIdx.z;
   int bx = blockIdx.x;   int by = blockIdx.y; int bz = blockIdx.z;
   int bdx = blockDim.x;  int bdy = blockDim.y; int bdz = blockDim.z;
   int i = bdx * bx + tx; int j = bdy * by + ty; int k = bdz * bz + tz;
  
-  __shared__ double s_L[BLOCK_SIZE*BLOCK_SIZE*BLOCK_SIZE];
+  __shared__ int s_L[BLOCK_SIZE*BLOCK_SIZE*BLOCK_SIZE];
   int size = BLOCK_SIZE - 2;
   int img_x = L2I(i,tx);
   int img_y = L2I(j,ty);
@@ -217,7 +219,7 @@ __global__ void plateau_kernel(double* L, int* C, const int w, const int h, cons
   // Load data into shared memory.
   if ((img_x < 0) || (img_y < 0) || (img_z < 0) ||
      (img_x == w) || (img_y == h) || (img_z == d)) {
-       s_L[INDEX(tz,ty,tx,BLOCK_SIZE)] = INF;
+       s_L[INDEX(tz,ty,tx,BLOCK_SIZE)] = LINF;
   } else {
      s_L[INDEX(tz,ty,tx,BLOCK_SIZE)] =
      L[INDEX(img_z,img_y,img_x,w)];
@@ -229,12 +231,12 @@ __global__ void plateau_kernel(double* L, int* C, const int w, const int h, cons
     s_L[p] == PLATEAU && ghost == 0) {
     float I_p = tex3D(img,img_x,img_y,img_z); 
     float I_q;
-    int n_x, n_y, n_z; double L_q;
+    int n_x, n_y, n_z; int L_q;
 
     for (int kk = 0; kk < 26; kk++) {
       n_x = N_xs[kk]+tx; n_y = N_ys[kk]+ty; n_z = N_zs[kk]+tz;
       L_q = s_L[INDEX(n_z,n_y,n_x,BLOCK_SIZE)];
-      if (L_q == INF || L_q >= 0) continue;
+      if (L_q == LINF || L_q >= 0) continue;
       int n_tx = L2I(i,n_x); int n_ty = L2I(j,n_y); int n_tz = L2I(k,n_z);
       int q = INDEX(n_tz,n_ty,n_tx,w);
       I_q = tex3D(img,n_tx,n_ty,n_tz);
@@ -248,7 +250,7 @@ __global__ void plateau_kernel(double* L, int* C, const int w, const int h, cons
 
 }
 // Step 4.
-__global__ void flood_kernel(double* L, int* C, const int w, const int h, const int d)
+__global__ void flood_kernel(int* L, int* C, const int w, const int h, const int d)
 {
   int i = blockDim.x * blockIdx.x + threadIdx.x;
   int j = blockDim.y * blockIdx.y + threadIdx.y;
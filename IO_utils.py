@@ -1,5 +1,7 @@
 import pickle
 import os, fnmatch, re
+import struct
+import zipfile
 import numpy as np
 import optparse
 
@@ -21,6 +23,31 @@ def find_initdeltax(directory):
     pattern = 'smoothed_deltax_z0.00*'
     return find_files(directory, pattern=pattern)
 
+def load_npz_region(file, key, index):
+    """Read only index (a numpy index expression such as np.s_[:,100]) of
+    array key from an npz archive. np.savez stores members uncompressed, so
+    the member is memory mapped in place and only the requested cells are
+    read; compressed members fall back to a full load."""
+    with zipfile.ZipFile(file) as zf:
+        info = zf.getinfo(key + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.load(file)[key][index]
+    with open(file, 'rb') as f:
+        #skip the local file header to reach the start of the .npy member
+        f.seek(info.header_offset)
+        header = f.read(30)
+        namelen, extralen = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + namelen + extralen)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    order = 'F' if fortran else 'C'
+    arr = np.memmap(file, dtype=dtype, mode='r', shape=shape, order=order, offset=offset)
+    return np.array(arr[index])
+
 def save_obj(obj, name ):
     with open(name + '.pkl', 'wb') as f:
         pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
@@ -21,7 +21,7 @@ def sample(files, layer=100, mode='labels', ncols=3, nrows=0):
 
 	if Nplots == 1:
 		file = files[0]
-		img = np.load(file)[mode][:,layer]
+		img = load_npz_region(file, mode, np.s_[:,layer])
 		plt.imshow(img, cmap=cmap)
 		plt.title(file.split('/')[-1])
 		plt.show()
@@ -35,7 +35,7 @@ def sample(files, layer=100, mode='labels', ncols=3, nrows=0):
 
 		for n in xrange(len(files)):
 			file = files[n]
-			img = np.load(file)[mode][:,layer]
+			img = load_npz_region(file, mode, np.s_[:,layer])
 			axarr[n/ncols, n%ncols].imshow(img, cmap=cmap)
 			axarr[n/ncols, n%ncols].set_title(file.split('/')[-1])
 		for i in xrange(nrows-1):
@@ -1,12 +1,27 @@
 from Choud14 import *
 from tocmfastpy import *
 from IO_utils import *
-import pycuda.compiler as nvcc
-import pycuda.gpuarray as gpuarray
-import pycuda.driver as cu
-import pycuda.autoinit
-from pyfft.cuda import Plan
-from pycuda.tools import make_default_context
+import find_bubbles_cpu
+import find_bubbles_ooc
+gpuflag = True
+#pycuda needs a GPU and its driver, so allow for CPU only nodes
+try:
+	import pycuda.compiler as nvcc
+	import pycuda.gpuarray as gpuarray
+	import pycuda.driver as cu
+	import pycuda.autoinit
+	from pyfft.cuda import Plan
+	from pycuda.tools import make_default_context
+except:
+	print "pycuda/pyfft not available, so only the CPU backend of conv_bubbles can be used"
+	gpuflag = False
+#scikit-cuda gives real-to-complex cuFFT transforms on half spectra, otherwise
+#the GPU backend falls back to complex-to-complex pyfft transforms
+skcudaflag = gpuflag
+try:
+	import skcuda.fft as cufft
+except:
+	skcudaflag = False
 
 def find_bubbles(I, scale=1., fil='kspace'):
 	"""brute force method"""
@@ -44,8 +59,7 @@ def find_bubbles(I, scale=1., fil='kspace'):
 				height/(block_size[0])+1,
 				depth/(block_size[0])+1)
 	 # Initialize variables.
-	ionized       = np.zeros([height,width,depth]) 
-	ionized       = np.float32(ionized)
+	ionized       = np.zeros([height,width,depth], dtype=np.float32)
 	width         = np.int32(width)
 
 	# Transfer labels asynchronously.
@@ -81,15 +95,31 @@ def conv(delta_d, filt_d, shape, fil):
 	plan.execute(smoothed_d, inverse=True)
 	return smoothed_d.real
 
-def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visualize=False):
-	"""uses fft convolution"""
+def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visualize=False, backend='gpu', memory=2**30,
+		bubble_radius=False):
+	"""uses fft convolution
+	backend 'gpu' runs the kernels of find_bubbles.cu with pycuda, 'cpu' the
+	equivalent numpy code in find_bubbles_cpu. Falls back to the CPU if
+	pycuda is not available. backend 'ooc' runs the CPU code out of core in
+	find_bubbles_ooc, for boxes larger than memory, within about memory
+	bytes; the ionization box is then a numpy.memmap.
+	With bubble_radius=True returns (ionized, radius), radius being a float16
+	box of the largest filter radius (Mpc) at which each cell was ionized,
+	0 where it was not, for bubble size statistics without the watershed"""
+	if backend == 'ooc':
+		return find_bubbles_ooc.conv_bubbles_ooc(I, param_dict, Z, [{'update': update}], scale=scale, fil=fil, LE=LE, memory=memory,
+			bubble_radius=bubble_radius)[0]
+	if backend == 'cpu' or not gpuflag:
+		if not backend == 'cpu':
+			print "GPU backend not available, using CPU"
+		return find_bubbles_cpu.conv_bubbles_cpu(I, param_dict, Z, scale=scale, fil=fil, update=update, LE=LE, bubble_radius=bubble_radius)
 	zeta = 40.
 	Lfactor = 0.620350491
 	# Z = param_dict['z']
 	DELTA_R_FACTOR = 1.05
 	print "Using filter_type {}".format(fil)	
 	if scale is None:
-		scale = param_dict['BoxeSize']/param_dict['HIIdim']
+		scale = float(param_dict['BoxSize'])/param_dict['HIIdim']
 	dk = 2*np.pi/I.shape[0]*scale#param_dict['BoxSize'] #delta k in inverse Mpc
 	RMAX = np.float32(30) #in Mpc
 	RMIN = np.float32(1.)
@@ -115,7 +145,9 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 	update_kernel = main_module.get_function("update_kernel")
 	update_sphere_kernel = main_module.get_function("update_sphere_kernel")
 	final_kernel = main_module.get_function("final_kernel")
+	record_kernel = main_module.get_function("record_kernel")
 	HII_filter = main_module.get_function("HII_filter")
+	HII_filter_r2c = main_module.get_function("HII_filter_r2c")
 	# Get contiguous image + shape.
 	height, width, depth = I.shape
 	HII_TOT_NUM_PIXELS = height*width*depth
@@ -126,6 +158,9 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 	grid_size =   (width/(block_size[0]),
 				height/(block_size[0]),
 				depth/(block_size[0]))
+	half_grid_size = (width/(block_size[0]),
+				height/(block_size[0]),
+				(depth/2+1+block_size[0]-1)/(block_size[0]))
 	 # Initialize variables.
 	#ionized       = np.zeros([height,width,depth]) 
 	#ionized       = np.float32(ionized)
@@ -138,11 +173,33 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 
 	# Transfer labels asynchronously.
 	ionized_d = gpuarray.zeros([height,width,depth], dtype=np.float32) 
-	delta_d = gpuarray.to_gpu_async(I)
+	if bubble_radius:
+		#cells hold the step of the radius schedule at which they were first
+		#ionized, counting from 1 so that 0 is never, and become Mpc on the host
+		radius_d = gpuarray.zeros([height,width,depth], dtype=np.uint8)
+		radii = [0]
 	# I_cu = cu.np_to_array(I, order='C')
 	# cu.bind_array_to_texref(I_cu, image_texture)
 
-	fftplan = Plan(I.shape, dtype=np.complex64)
+	# the density spectrum is the same at every radius, so transform it once and
+	# per radius only filter a scratch copy and inverse transform it
+	if skcudaflag:
+		# real-to-complex: (w,w,w/2+1) half spectra and a real smoothed box
+		fwdplan = cufft.Plan(I.shape, np.float32, np.complex64)
+		invplan = cufft.Plan(I.shape, np.complex64, np.float32)
+		deltak_d = gpuarray.empty((height, width, depth/2+1), dtype=np.complex64)
+		cufft.fft(gpuarray.to_gpu(I), deltak_d, fwdplan)
+		delta_d = gpuarray.empty_like(deltak_d)
+		smoothed_d = gpuarray.empty(I.shape, dtype=np.float32)
+		filter_kernel, filter_grid_size, stride = HII_filter_r2c, half_grid_size, 1
+	else:
+		fftplan = Plan(I.shape, dtype=np.complex64)
+		deltak_d = gpuarray.to_gpu(I.astype(np.complex64))
+		fftplan.execute(deltak_d)
+		delta_d = gpuarray.empty_like(deltak_d)
+		smoothed_d = delta_d # real parts of the complex box
+		filter_kernel, filter_grid_size, stride = HII_filter, grid_size, 2
+	fcoll_d = gpuarray.empty(I.shape, dtype=np.float32)
 	R = RMAX; cnt = 0
 
 	if visualize is not None:
@@ -154,7 +211,7 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 		ax1 = fig.add_subplot(132)
 		fig.suptitle(" Smoothed Density and Ionization")
 		ax1.set_title('smoothed Density')
-		mydelta = plt.imshow(delta_d.get().real[width/2])
+		mydelta = plt.imshow(I[width/2])
 		plt.colorbar()
 		ax2 = fig.add_subplot(133)
 		ax2.set_title('Ionization')
@@ -181,6 +238,10 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 			final_step = True
 		R = np.float32(R)
 		Rpix = np.float32(R/scale)
+		if bubble_radius:
+			if len(radii) > np.iinfo(np.uint8).max:
+				raise ValueError('more than {} filter radii to record'.format(np.iinfo(np.uint8).max))
+			radii.append(R)
 
 		S0 = np.float32(sig0(R))
 		#S0 = np.float32(pb.sigma_r(R, Z, **cosmo)[0])
@@ -197,20 +258,19 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 		start.record()
 		#smoothed_d = conv(delta_d.astype(np.complex64), I.shape, fil=fil)
 
-		delta_d = gpuarray.to_gpu_async(I).astype(np.complex64)
-		fcoll_d = gpuarray.zeros(I.shape, dtype=np.float32)
-		start.synchronize()
-		if R > 1 or True: # smoothing
-			fftplan.execute(delta_d)
-			step1.record(); step1.synchronize()
-			
-			HII_filter(delta_d, width, np.int32(fil), R, block=block_size, grid=grid_size)
-			step2.record(); step2.synchronize()
-			#import IPython; IPython.embed()
+		cu.memcpy_dtod(delta_d.gpudata, deltak_d.gpudata, deltak_d.nbytes)
+		step1.record(); step1.synchronize()
+		
+		filter_kernel(delta_d, width, np.int32(fil), R, block=block_size, grid=filter_grid_size)
+		step2.record(); step2.synchronize()
+		#import IPython; IPython.embed()
+		if skcudaflag:
+			cufft.ifft(delta_d, smoothed_d, invplan, True)
+		else:
 			fftplan.execute(delta_d, inverse=True)
 
 		if not final_step:
-			fcoll_kernel(fcoll_d, delta_d.real, width, denom, block=block_size, grid=grid_size)
+			fcoll_kernel(fcoll_d, smoothed_d, width, denom, np.int32(stride), block=block_size, grid=grid_size)
 			step3.record(); step3.synchronize()
 			if not LE:
 				#fcollmean = gpuarray.sum((1+delta_d.real)*fcoll_d).get()/float(HII_TOT_NUM_PIXELS)
@@ -221,11 +281,13 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 				update_kernel(ionized_d, fcoll_d, width, block=block_size, grid=grid_size)
 			elif update == 1:
 				update_sphere_kernel(ionized_d, fcoll_d, width, Rpix, block=block_size, grid=grid_size)
+			if bubble_radius:
+				record_kernel(radius_d, ionized_d, width, np.uint8(len(radii)-1), block=block_size, grid=grid_size)
 			#import IPython; IPython.embed()
 		else:
 			if (RMIN > Lfactor*scale) or (final_denom < 0): final_denom = denom
 			print 'final denom', final_denom
-			fcoll_kernel(fcoll_d, delta_d.real, width, denom, block=block_size, grid=grid_size)
+			fcoll_kernel(fcoll_d, smoothed_d, width, denom, np.int32(stride), block=block_size, grid=grid_size)
 			step3.record(); step3.synchronize()
 			if not LE:
 				fcollmean = gpuarray.sum(fcoll_d).get()/np.float32(HII_TOT_NUM_PIXELS)
@@ -236,11 +298,13 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 				update_kernel(ionized_d, fcoll_d, width, block=block_size, grid=grid_size)
 			elif update == 1:
 				update_sphere_kernel(ionized_d, fcoll_d, width, Rpix, block=block_size, grid=grid_size)
+			if bubble_radius:
+				record_kernel(radius_d, ionized_d, width, np.uint8(len(radii)-1), block=block_size, grid=grid_size)
 			final_kernel(ionized_d, fcoll_d, width, block=block_size, grid=grid_size)
 		end.record()
 		end.synchronize()
 		if visualize is not None:
-			mydelta.set_data(delta_d[width/2].real.get())
+			mydelta.set_data(smoothed_d[width/2].get().real)
 			myion.set_data(ionized_d[width/2].get())
 			ax1.set_title('R = %f'%(R))
 			if visualize == 'draw':
@@ -254,14 +318,36 @@ def conv_bubbles(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, visual
 		cnt +=1 
 
 	ionized = ionized_d.get()
+	if bubble_radius:
+		return ionized, np.array(radii, dtype=np.float16)[radius_d.get()]
 	return ionized
 
+def compare_backends(I, param_dict, Z, scale=None, fil=1, update=0, LE=False):
+	"""run conv_bubbles on the GPU and CPU backends and report how the
+	ionization boxes differ. Returns (ionized_gpu, ionized_cpu)"""
+	ionized_cpu = conv_bubbles(I, param_dict, Z, scale=scale, fil=fil, update=update, LE=LE, backend='cpu')
+	if not gpuflag:
+		print 'GPU backend not available, nothing to compare against'
+		return None, ionized_cpu
+	ionized_gpu = conv_bubbles(I, param_dict, Z, scale=scale, fil=fil, update=update, LE=LE, visualize=None, backend='gpu')
+
+	flagged = (ionized_gpu == 1) != (ionized_cpu == 1)
+	partial = (ionized_gpu < 1) & (ionized_cpu < 1)
+	print 'cells ionized by one backend only: {} of {}'.format(np.sum(flagged), I.size)
+	if partial.any():
+		print 'max |difference| of partial ionizations: {}'.format(np.max(np.abs(ionized_gpu[partial] - ionized_cpu[partial])))
+	print 'mean ionization gpu: {} cpu: {}'.format(ionized_gpu.mean(), ionized_cpu.mean())
+	return ionized_gpu, ionized_cpu
+
 if __name__ == '__main__':
 	o = optparse.OptionParser()
 	o.add_option('-d','--dir', dest='DIR', default='/home/yunfanz/Data/21cmFast/Boxes/')
 	o.add_option('-f','--filt', dest='FILTER_TYPE', default=1) #0: rtophat; 1: ktophat, 2: Gaussian
 	o.add_option('-u','--upd', dest='UPDATE_TYPE', default=1) #0: center pixel, 1: sphere painting
 	o.add_option('-l','--lin', dest='LIN', action="store_true") #whether to use linearly evolved density
+	o.add_option('-b','--backend', dest='BACKEND', default='gpu') #gpu, cpu or ooc (out-of-core cpu)
+	o.add_option('-m','--memory', dest='MEMORY', default=1024) #MB to work in with the ooc backend
+	o.add_option('-c','--compare', dest='COMPARE', action="store_true") #validate cpu backend against gpu
 	(opts, args) = o.parse_args()
 	print opts
 	print args
@@ -272,12 +358,15 @@ if __name__ == '__main__':
 		opts.LIN = False
 		files = find_deltax(opts.DIR, z=z)
 	file = files[0]
-	b1 = boxio.readbox(file)
+	b1 = boxio.readbox(file, mmap=opts.BACKEND == 'ooc') #the ooc backend reads the box slab by slab
 	scale = 1
 	#d1 = 1 - b1.box_data[::scale, ::scale, ::scale]
 	d1 = b1.box_data#[:256, :256, :256]
 	print d1.shape
 	print opts.UPDATE_TYPE, opts.FILTER_TYPE
 	
-	ion_field = conv_bubbles(d1, b1.param_dict, Z=z, scale=float(scale), fil=int(opts.FILTER_TYPE), update=int(opts.UPDATE_TYPE), LE=opts.LIN, visualize=None)
+	if opts.COMPARE:
+		ion_gpu, ion_field = compare_backends(d1, b1.param_dict, Z=z, scale=float(scale), fil=int(opts.FILTER_TYPE), update=int(opts.UPDATE_TYPE), LE=opts.LIN)
+	else:
+		ion_field = conv_bubbles(d1, b1.param_dict, Z=z, scale=float(scale), fil=int(opts.FILTER_TYPE), update=int(opts.UPDATE_TYPE), LE=opts.LIN, visualize=None, backend=opts.BACKEND, memory=float(opts.MEMORY)*2**20)
 	import IPython; IPython.embed()
@@ -119,17 +119,57 @@ __global__ void real_tophat(float* filter, int w, float R)
 		  if (kR > 1e-4){
 		    fourierbox[p] *= 3.0 * (sin(kR)/pow(kR, float(3)) - cos(kR)/pow(kR, float(2)));
 		  }
+		  break;
 		case 1: // k-space top hat
 		  kR *= 0.413566994; // equates integrated volume to the real space top-hat (9pi/2)^(-1/3)
 		  if (kR > 1){
 		    fourierbox[p] = 0;
 		  }
+		  break;
 		case 2: // gaussian
 		  kR *= 0.643; // equates integrated volume to the real space top-hat
 		  fourierbox[p] *= pow(E, float(-kR*kR/2.0));
+		  break;
  	}
 }
-__global__ void fcoll_kernel(float* fcollapse, float* smoothed, const int w, float denom)
+// HII_filter on the (w,w,w/2+1) half spectrum of a real-to-complex transform
+ __global__ void HII_filter_r2c(pycuda::complex<float>* fourierbox, int w, int filter_type, float R)
+{
+	int tx = threadIdx.x;  int ty = threadIdx.y; int tz = threadIdx.z;
+	int bx = blockIdx.x;   int by = blockIdx.y; int bz = blockIdx.z;
+	int bdx = blockDim.x;  int bdy = blockDim.y; int bdz = blockDim.z;
+	int i = bdx * bx + tx; int j = bdy * by + ty; int k = bdz * bz + tz;
+	int hw = w/2; 
+	int p = (i*w + j)*(hw+1) + k;
+	if (j >= w || i >= w || k > hw) return;
+	float k_x, k_y, k_z, k_mag, kR;
+	k_z = k*%(DELTAK)s;
+	k_y = (j>hw) ? (j-w)*%(DELTAK)s : j*%(DELTAK)s;
+	k_x = (i>hw) ? (i-w)*%(DELTAK)s : i*%(DELTAK)s;
+
+	k_mag = sqrt(k_x*k_x + k_y*k_y + k_z*k_z);
+	kR = k_mag*R; 
+	switch (filter_type) {
+		case 0: // real space top-hat
+		  if (kR > 1e-4){
+		    fourierbox[p] *= 3.0 * (sin(kR)/pow(kR, float(3)) - cos(kR)/pow(kR, float(2)));
+		  }
+		  break;
+		case 1: // k-space top hat
+		  kR *= 0.413566994; // equates integrated volume to the real space top-hat (9pi/2)^(-1/3)
+		  if (kR > 1){
+		    fourierbox[p] = 0;
+		  }
+		  break;
+		case 2: // gaussian
+		  kR *= 0.643; // equates integrated volume to the real space top-hat
+		  fourierbox[p] *= pow(E, float(-kR*kR/2.0));
+		  break;
+ 	}
+}
+// smoothed holds the smoothed box with a stride of 1 (real box) or 2 (real parts
+// of a complex box)
+__global__ void fcoll_kernel(float* fcollapse, float* smoothed, const int w, float denom, const int stride)
 {
   int tx = threadIdx.x;  int ty = threadIdx.y; int tz = threadIdx.z;
   int bx = blockIdx.x;   int by = blockIdx.y; int bz = blockIdx.z;
@@ -139,7 +179,7 @@ __global__ void fcoll_kernel(float* fcollapse, float* smoothed, const int w, flo
   
   if (j >= w || i >= w || k >= w) return;
 
-  float delta0 = smoothed[p];
+  float delta0 = smoothed[stride*p];
   float deltac = %(DELTAC)s;
   float fcoll = erfcf((deltac - delta0)/denom);
   //fcollapse[p] = (fcoll<1.0) ? fcoll : 1.0 ;
@@ -231,6 +271,19 @@ __global__ void update_kernel(float* ionized, float* fcollapse, const int w)
  }
 }
 
+__global__ void record_kernel(unsigned char* radius, float* ionized, const int w, const unsigned char index)
+{
+  int tx = threadIdx.x;  int ty = threadIdx.y; int tz = threadIdx.z;
+  int bx = blockIdx.x;   int by = blockIdx.y; int bz = blockIdx.z;
+  int bdx = blockDim.x;  int bdy = blockDim.y; int bdz = blockDim.z;
+  int i = bdx * bx + tx; int j = bdy * by + ty; int k = bdz * bz + tz;
+  int p = C_INDEX(k,j,i,w); 
+  
+  if (j >= w || i >= w || k >= w || radius[p] > 0 || ionized[p] != 1) return;
+
+  radius[p] = index; //first ionized at this step of the radius schedule, counting from 1
+ }
+
 __global__ void final_kernel(float* ionized, float* fcollapse, const int w, float denom)
 {
   int tx = threadIdx.x;  int ty = threadIdx.y; int tz = threadIdx.z;
@@ -0,0 +1,355 @@
+"""
+CPU engine for the excursion-set ionization of find_HII_bubbles.conv_bubbles
+
+numpy/scipy equivalents of the HII_filter, fcoll_kernel, update_kernel,
+update_sphere_kernel and final_kernel kernels of find_bubbles.cu, working in
+single precision on real-to-complex FFTs from tocmfastpy.fftutils (threaded
+pyfftw when available, numpy otherwise). Boxes use the GPU layout, i.e. the
+first axis of an array is the kernels' i index.
+
+conv_bubbles_cpu takes the same arguments as conv_bubbles and is what
+conv_bubbles(backend='cpu') runs. conv_bubbles_batch runs a list of (zeta,
+Tvir, update) settings on the same density box in a single pass. With
+bubble_radius=True they also return the filter radius at which each cell was
+ionized, whose volume distribution radius_distribution gives directly.
+
+The cosmology of Choud14 is only imported by barrier and engine_setup, so
+the kernels and excursion_set* work on given schedules without it.
+"""
+import numpy as np
+from scipy import ndimage, special
+from tocmfastpy import fftutils
+
+L_FACTOR = 0.620350491 # factor relating cube length to filter radius = (4PI/3)^(-1/3)
+SKIP_MARGIN = 0.99 # radii are skipped only if max fcoll is bounded below SKIP_MARGIN/zeta, allowing for float32 rounding
+
+def fcoll_threshold(zeta):
+	"""smallest float32 >= 1/zeta, so that comparing float32 fcoll against it
+	matches the kernels' fcoll >= 1/zeta test done in double precision"""
+	thresh = np.float32(1./zeta)
+	if thresh < 1./zeta:
+		thresh = np.nextafter(thresh, np.float32(np.inf))
+	return thresh
+
+def HII_filter(fourierbox, dk, filter_type, R, work=None, kgrid=None):
+	"""filter the (w,w,w/2+1) half spectrum fourierbox in place with a filter
+	of radius R, dk being the spacing of the k grid. work is an optional
+	float32 scratch array of the same shape, saving an allocation per call.
+	kgrid gives |k| when fourierbox is only a block of the half spectrum
+	filter_type 0: real space top-hat, 1: k-space top-hat, 2: gaussian"""
+	if kgrid is None:
+		kgrid = fftutils.kGrid(fourierbox.shape[0], 2*np.pi/dk)
+	kR = np.multiply(kgrid, np.float32(R), out=work)
+	if filter_type == 0:
+		#W = 3*(sin(kR)/kR**3 - cos(kR)/kR**2) into kR a plane at a time, so
+		#only plane sized temporaries are allocated
+		with np.errstate(divide='ignore', invalid='ignore'):
+			for x in kR:
+				small = x <= 1e-4
+				power = np.power(x, 3)
+				W = np.sin(x)
+				W /= power
+				np.square(x, out=power)
+				term = np.cos(x)
+				term /= power
+				W -= term
+				W *= 3
+				x[...] = W
+				x[small] = 1
+		fourierbox *= kR
+	elif filter_type == 1:
+		kR *= np.float32(0.413566994) # equates integrated volume to the real space top-hat (9pi/2)^(-1/3)
+		fourierbox[kR > 1] = 0
+	elif filter_type == 2:
+		kR *= np.float32(0.643) # equates integrated volume to the real space top-hat
+		kR *= kR
+		kR /= -2
+		fourierbox *= np.exp(kR, out=kR)
+	else:
+		print 'Unknown filter_type {}'.format(filter_type)
+	return fourierbox
+
+def fcoll_kernel(smoothed, deltac, denom, out=None):
+	"""collapse fraction erfc((deltac - delta_R)/denom) of the smoothed box"""
+	if out is None:
+		out = np.empty(smoothed.shape, dtype=np.float32)
+	np.subtract(np.float32(deltac), smoothed, out=out)
+	out /= denom
+	special.erfc(out, out=out)
+	return out
+
+def update_kernel(ionized, fcoll, zeta):
+	"""flag the cells that can ionize themselves"""
+	ionized[fcoll >= fcoll_threshold(zeta)] = 1
+	return ionized
+
+def update_sphere_kernel(ionized, fcoll, zeta, R, rows=slice(None)):
+	"""flag every cell within R cells of a cell that can ionize itself, i.e.
+	with rsq < R*R as on the GPU, where the painting does not wrap around the
+	box edges either. One Euclidean distance transform gives every cell its
+	distance to the nearest ionizing cell, so the cost does not grow with R.
+	fcoll may extend beyond ionized along the first axis, rows being the
+	planes of fcoll that ionized holds"""
+	centres = fcoll >= fcoll_threshold(zeta)
+	if centres.any():
+		rsq = ndimage.distance_transform_edt(~centres)[rows]
+		rsq *= rsq
+		np.rint(rsq, out=rsq) #squared distances are integers
+		ionized[rsq < np.float32(R)*np.float32(R)] = 1
+	return ionized
+
+def record_kernel(bubble_radius, ionized, R):
+	"""set bubble_radius to R (Mpc) in the cells first ionized at filter
+	radius R, i.e. ionized cells whose bubble_radius is still 0"""
+	bubble_radius[(ionized == 1) & (bubble_radius == 0)] = R
+	return bubble_radius
+
+def final_kernel(ionized, fcoll, zeta):
+	"""give cells left neutral at the final step their partial ionization"""
+	neutral = ionized != 1
+	ionized[neutral] = fcoll[neutral]*np.float32(zeta)
+	return ionized
+
+def radius_schedule(scale, RMAX=30., RMIN=1., DELTA_R_FACTOR=1.05, Lfactor=L_FACTOR):
+	"""float32 filter radii in Mpc visited by conv_bubbles, from RMAX down
+	until the next radius would pass RMIN or the cell size. The last radius
+	is the final step"""
+	radii = []
+	R = np.float32(RMAX)
+	while True:
+		final_step = (R/DELTA_R_FACTOR) <= (Lfactor*scale) or ((R/DELTA_R_FACTOR) <= RMIN)
+		R = np.float32(R)
+		radii.append(R)
+		if final_step:
+			break
+		R = R/DELTA_R_FACTOR
+	return radii
+
+def window(kR, filter_type):
+	"""|W(kR)| of the HII_filter filters in double precision. The k-space
+	top-hat edge is widened slightly so that the result bounds the float32
+	filter"""
+	kR = np.asarray(kR, dtype=np.float64)
+	if filter_type == 0:
+		W = np.ones_like(kR)
+		x = kR[kR > 1e-4]
+		W[kR > 1e-4] = np.abs(3*(np.sin(x)/x**3 - np.cos(x)/x**2))
+	elif filter_type == 1:
+		W = (kR*0.413566994 <= 1+1e-5).astype(np.float64)
+	else:
+		W = np.exp(-(kR*0.643)**2/2)
+	return W
+
+def smoothed_bound(deltak, dk, filter_type):
+	"""Return a function giving, for filter radius R, an upper bound on
+	max |delta_R| over the box, using |delta_R(x)| <= (1/N) sum_k |W(kR)| |delta_k|
+	on the unfiltered half spectrum deltak. The sum is grouped by |k|, so
+	each call costs the number of distinct |k| rather than a filter pass"""
+	w = deltak.shape[0]
+	N = float(deltak.shape[0]*deltak.shape[1]*w)
+	n = np.fft.fftfreq(w, 1./w).astype(np.int64)
+	nz = np.arange(deltak.shape[2], dtype=np.int64)
+	nsq2d = n[:,None]**2 + nz[None,:]**2
+	weights = fftutils.halfWeights(w)[None,:]
+	amps = np.zeros(3*(w/2)**2+1)
+	for i in range(w):
+		amps += np.bincount((n[i]**2 + nsq2d).ravel(), weights=(weights*np.abs(deltak[i])).ravel(),
+			minlength=len(amps))
+	nsq = np.nonzero(amps)[0]
+	kmag = dk*np.sqrt(nsq)
+	amps = amps[nsq]/N
+	def bound(R):
+		return np.dot(window(kmag*R, filter_type), amps)
+	return bound
+
+def can_ionize(deltamax, deltamean, r, settings, groups, deltac, LE=False):
+	"""whether any cell may reach fcoll >= 1/zeta at the r-th radius for any
+	setting in groups (lists of indices of settings sharing a barrier),
+	given the bound deltamax on the smoothed density and its mean"""
+	for group in groups:
+		if deltamax >= deltac:
+			return True
+		denom = settings[group[0]]['denoms'][r]
+		fcollmax = special.erfc((deltac - deltamax)/denom)
+		if not LE:
+			fcollmax *= settings[group[0]]['fc_mean_ps']/special.erfc((deltac - deltamean)/denom)
+		if fcollmax >= SKIP_MARGIN*min(fcoll_threshold(settings[n]['zeta']) for n in group):
+			return True
+	return False
+
+def excursion_set(I, dk, radii, denoms, deltac, fc_mean_ps, zeta=40., fil=1, update=0, LE=False, scale=1., threads=None,
+		skip=True, bubble_radius=False):
+	"""excursion-set loop on a density box I already scaled by the growth
+	factor. radii (Mpc, largest first) and denoms = sqrt(2*(smin - S0(R)))
+	give the filter schedule; at the last radius neutral cells are given
+	zeta*fcoll. Returns the float32 ionization box.
+
+	With bubble_radius=True also returns a float16 box holding, for each
+	ionized cell, the largest filter radius in Mpc at which it was ionized
+	(0 for cells left neutral), i.e. the size of the excursion-set bubble it
+	belongs to. This costs no extra filter passes"""
+	setting = {'zeta': zeta, 'update': update, 'denoms': denoms, 'fc_mean_ps': fc_mean_ps}
+	return excursion_set_batch(I, dk, radii, [setting], deltac, fil=fil, LE=LE, scale=scale, threads=threads, skip=skip,
+		bubble_radius=bubble_radius)[0]
+
+def excursion_set_batch(I, dk, radii, settings, deltac, fil=1, LE=False, scale=1., threads=None, skip=True,
+		bubble_radius=False):
+	"""excursion_set for a list of settings at once, each a dict with keys
+	zeta, update, denoms and fc_mean_ps as the arguments of excursion_set.
+	The density is filtered once per radius for all settings, and settings
+	sharing denoms and fc_mean_ps (i.e. the same Tvir) also share fcoll, so
+	a scan over zeta costs little more than a single run. Returns a list of
+	float32 ionization boxes, one per setting, or of (ionized, radius)
+	pairs with bubble_radius=True
+
+	With skip=True radii that cannot ionize anything are skipped without
+	filtering, and the loop stops once every cell is ionized, neither of
+	which changes the result. A radius is skipped when a bound on the
+	largest smoothed density (see smoothed_bound) keeps fcoll below 1/zeta
+	everywhere. Without linear extrapolation (LE=False) fcoll is
+	renormalised by its mean, which is bounded below by Jensen's inequality
+	as erfc((deltac - mean)/denom) is convex for delta < deltac. The final
+	radius is never skipped."""
+	I = np.asarray(I, dtype=np.float32)
+	HII_TOT_NUM_PIXELS = I.size
+	ionized = [np.zeros(I.shape, dtype=np.float32) for setting in settings]
+	if bubble_radius:
+		radius = [np.zeros(I.shape, dtype=np.float16) for setting in settings]
+	fcoll = np.empty(I.shape, dtype=np.float32)
+
+	#settings with the same barrier see the same fcoll at every radius
+	groups = {}
+	for n, setting in enumerate(settings):
+		key = (float(setting['fc_mean_ps']), tuple(float(d) for d in setting['denoms']))
+		groups.setdefault(key, []).append(n)
+	groups = sorted(groups.values())
+
+	#the density spectrum is the same at every radius, so transform it once
+	#and only filter a scratch copy of it and inverse transform per radius
+	deltak = fftutils.rfftn(I, threads)
+	fourierbox = fftutils.emptyAligned(deltak.shape, np.complex64)
+	work = np.empty(deltak.shape, dtype=np.float32)
+	smoothed = fftutils.emptyAligned(I.shape, np.float32)
+	inverse = fftutils.irfftnPlan(fourierbox, smoothed, threads)
+
+	if skip:
+		bound = smoothed_bound(deltak, dk, fil)
+		deltamean = deltak[0,0,0].real/HII_TOT_NUM_PIXELS
+	done = [False]*len(settings) #settings whose box is fully ionized
+	nskipped = 0
+
+	for r, R in enumerate(radii):
+		final_step = r == len(radii)-1
+		active = [[n for n in group if not done[n]] for group in groups]
+		active = [group for group in active if group]
+		if not active:
+			print 'all cells ionized, stopping at R={} Mpc'.format(R)
+			nskipped += len(radii) - r
+			break
+
+		if skip and not final_step and not can_ionize(bound(R), deltamean, r, settings, active, deltac, LE):
+			nskipped += 1
+			continue
+
+		print 'R={} Mpc'.format(R)
+		fourierbox[...] = deltak
+		HII_filter(fourierbox, dk, fil, R, work)
+		inverse()
+		Rpix = np.float32(R/scale)
+
+		for group in active:
+			first = settings[group[0]]
+			fcoll_kernel(smoothed, deltac, first['denoms'][r], out=fcoll)
+			if not LE:
+				fcollmean = np.float32(fcoll.sum(dtype=np.float64)/HII_TOT_NUM_PIXELS)
+				fcoll *= first['fc_mean_ps']/fcollmean #normalize since we used non-linear density
+			for n in group:
+				zeta = settings[n]['zeta']
+				if settings[n]['update'] == 0:
+					update_kernel(ionized[n], fcoll, zeta)
+				elif settings[n]['update'] == 1:
+					update_sphere_kernel(ionized[n], fcoll, zeta, Rpix)
+				if bubble_radius:
+					record_kernel(radius[n], ionized[n], R)
+				if final_step:
+					final_kernel(ionized[n], fcoll, zeta)
+				elif skip:
+					done[n] = bool(ionized[n].all())
+
+	if skip:
+		print 'skipped {} of {} filter passes'.format(nskipped, len(radii))
+	if bubble_radius:
+		return zip(ionized, radius)
+	return ionized
+
+def radius_distribution(bubble_radius, rows=16):
+	"""volume fraction of the box first ionized at each filter radius, from
+	a bubble_radius box of excursion_set, as (R, fraction) arrays with R in
+	decreasing order. The box is histogrammed rows planes at a time, so a
+	numpy.memmap is never read in full"""
+	counts = np.zeros(2**16, dtype=np.int64)
+	for i in range(0, bubble_radius.shape[0], rows):
+		slab = np.ascontiguousarray(bubble_radius[i:i+rows], dtype=np.float16)
+		counts += np.bincount(slab.view(np.uint16).ravel(), minlength=len(counts))
+	values = np.nonzero(counts)[0].astype(np.uint16)
+	R = values.view(np.float16).astype(np.float32)
+	fraction = counts[values]/float(bubble_radius.size)
+	order = np.argsort(R)[::-1]
+	order = order[R[order] > 0]
+	return R[order], fraction[order]
+
+def barrier(Z, Tvir, radii):
+	"""smin, fc_mean_ps and the per radius denoms of the excursion-set barrier
+	for minimum virial temperature Tvir"""
+	from Choud14 import mmin, m2R, sig0, Deltac, pb
+	mm = mmin(Z, Tvir=Tvir)
+	smin = sig0(m2R(mm))
+	deltac = Deltac(Z)
+	fc_mean_ps = pb.collapse_fraction(np.sqrt(smin), deltac).astype(np.float32)  #mean collapse fraction of universe
+	denoms = [np.sqrt(2*(smin - np.float32(sig0(R)))).astype(np.float32) for R in radii]
+	return smin, fc_mean_ps, denoms
+
+def engine_setup(w, param_dict, Z, settings, scale):
+	"""turn conv_bubbles_batch settings for a box of w cells per side of
+	scale Mpc into (dk, deltac, fgrowth, radii, engine_settings), the last
+	being the settings of excursion_set_batch"""
+	from Choud14 import Deltac
+	DELTA_R_FACTOR = 1.05
+	dk = 2*np.pi/w*scale #delta k in inverse Mpc
+	RMAX = np.float32(30) #in Mpc
+	RMIN = np.float32(1.)
+	deltac = Deltac(Z)
+	fgrowth = np.float32(deltac/1.686)
+	radii = radius_schedule(scale, RMAX, RMIN, DELTA_R_FACTOR)
+
+	barriers = {}
+	engine_settings = []
+	for setting in settings:
+		Tvir = setting.get('Tvir', 1.e4)
+		if Tvir not in barriers:
+			barriers[Tvir] = barrier(Z, Tvir, radii)
+		smin, fc_mean_ps, denoms = barriers[Tvir]
+		engine_settings.append({'zeta': setting.get('zeta', 40.), 'update': setting.get('update', 0),
+			'denoms': denoms, 'fc_mean_ps': fc_mean_ps})
+	return dk, deltac, fgrowth, radii, engine_settings
+
+def conv_bubbles_cpu(I, param_dict, Z, scale=None, fil=1, update=0, LE=False, threads=None, skip=True, bubble_radius=False):
+	"""CPU version of find_HII_bubbles.conv_bubbles"""
+	return conv_bubbles_batch(I, param_dict, Z, [{'update': update}], scale=scale, fil=fil, LE=LE, threads=threads, skip=skip,
+		bubble_radius=bubble_radius)[0]
+
+def conv_bubbles_batch(I, param_dict, Z, settings, scale=None, fil=1, LE=False, threads=None, skip=True, bubble_radius=False):
+	"""conv_bubbles for a list of parameter settings on the same density box,
+	each a dict with any of zeta (default 40), Tvir (default 1e4) and update
+	(default 0). Returns a list of ionization boxes, one per setting, e.g.
+	conv_bubbles_batch(I, param_dict, 12., [{'zeta': z} for z in range(10,50,2)])
+	or of (ionized, radius) pairs with bubble_radius=True, see excursion_set"""
+	print "Using filter_type {}".format(fil)
+	if scale is None:
+		scale = float(param_dict['BoxSize'])/param_dict['HIIdim']
+	dk, deltac, fgrowth, radii, engine_settings = engine_setup(I.shape[0], param_dict, Z, settings, scale)
+	I = np.float32(I.copy())
+	if not LE:
+		I *= fgrowth #linearly extrapolate the non-linear density to present
+	return excursion_set_batch(I, dk, radii, engine_settings, deltac, fil=fil, LE=LE, scale=scale, threads=threads, skip=skip,
+		bubble_radius=bubble_radius)
@@ -0,0 +1,196 @@
+"""
+Out-of-core excursion-set ionization for boxes larger than memory
+
+Runs the kernels of find_bubbles_cpu on slabs of planes along the first axis
+of the box. The density spectrum, the filtered spectrum, the smoothed density
+and the ionization boxes are numpy.memmap files in a work directory, and each
+3D FFT is done as 2D transforms of slabs of planes followed by 1D transforms
+along the first axis in blocks of columns. Sphere painting sees a slab
+together with a halo of planes as wide as the filter radius, which holds
+every ionizing cell close enough to paint into the slab. The number of
+planes per slab follows from a memory budget, so peak memory is set by the
+user rather than by the box size. Pages of the memory mapped files are left
+to the operating system's cache.
+
+conv_bubbles_ooc takes the settings of find_bubbles_cpu.conv_bubbles_batch
+and a density box that may itself be a numpy.memmap, as from
+boxio.readbox(filename, mmap=True), and returns the ionization boxes as
+numpy.memmap files in the work directory.
+"""
+import os
+import tempfile
+import numpy as np
+from find_bubbles_cpu import *
+from tocmfastpy import fftutils
+
+FFT_BYTES = 48 # peak bytes per half spectrum element in a slab FFT, allowing for numpy's double precision temporaries
+CELL_BYTES = 48 # peak bytes per cell in an update pass, mostly the distance transform of sphere painting
+
+def slab_rows(plane_bytes, memory, halo=0):
+	"""planes per slab such that the slab and halo planes on either side,
+	each plane_bytes in size, fit in memory bytes. Raises ValueError if not
+	even a single plane fits"""
+	rows = int(memory // plane_bytes) - 2*halo
+	if rows < 1:
+		raise ValueError('memory budget of {} bytes is too small for slabs with {} halo planes, '
+			'at least {} bytes are needed'.format(memory, halo, (2*halo+1)*plane_bytes))
+	return rows
+
+def slabs(w, rows):
+	"""slices of at most rows planes covering w planes"""
+	return [slice(i, min(i+rows, w)) for i in range(0, w, rows)]
+
+def scratch(workdir, name, dtype, shape):
+	"""zeroed numpy.memmap onto a new file in workdir"""
+	return np.memmap(os.path.join(workdir, name), dtype=dtype, mode='w+', shape=shape)
+
+def forward_slabs(I, deltak, rows, fgrowth=None, threads=None):
+	"""half spectrum of the density box I, times fgrowth in single precision
+	if given, into deltak"""
+	for s in slabs(I.shape[0], rows):
+		slab = np.array(I[s], dtype=np.float32)
+		if fgrowth is not None:
+			slab *= fgrowth
+		deltak[s] = fftutils.rfftn(slab, threads, axes=(1,2))
+	for s in slabs(deltak.shape[1], rows):
+		deltak[:,s] = fftutils.fft(deltak[:,s], 0, threads)
+	return deltak
+
+def smooth_slabs(deltak, filtered, smoothed, dk, fil, R, rows, threads=None):
+	"""density smoothed on radius R into smoothed. Blocks of columns of
+	deltak are filtered and inverse transformed along the first axis into
+	filtered, whose slabs are then inverse transformed along the others"""
+	w = deltak.shape[0]
+	for s in slabs(deltak.shape[1], rows):
+		block = np.array(deltak[:,s])
+		HII_filter(block, dk, fil, R, kgrid=fftutils.kBlock(w, 2*np.pi/dk, cols=s))
+		filtered[:,s] = fftutils.fft(block, 0, threads, inverse=True)
+	for s in slabs(w, rows):
+		smoothed[s] = fftutils.irfftn(filtered[s], smoothed[s].shape, threads, axes=(1,2))
+	return smoothed
+
+def fcoll_mean(smoothed, deltac, denom, rows):
+	"""mean collapse fraction of the smoothed box"""
+	total = 0.
+	for s in slabs(smoothed.shape[0], rows):
+		total += fcoll_kernel(smoothed[s], deltac, denom).sum(dtype=np.float64)
+	return np.float32(total/smoothed.size)
+
+def excursion_set_ooc(I, dk, radii, settings, deltac, fil=1, LE=False, scale=1., fgrowth=None,
+		memory=2**30, workdir=None, threads=None, skip=True, bubble_radius=False):
+	"""find_bubbles_cpu.excursion_set_batch for boxes that don't fit in
+	memory. I is the density box, multiplied by fgrowth slab by slab if
+	given. Arrays held in memory are kept to about memory bytes and the rest
+	lives in files in workdir (a new temporary directory by default). The
+	scratch files are removed at the end, and the ionization boxes are
+	returned as float32 numpy.memmap files ionized_<n> in workdir, one per
+	setting. With bubble_radius=True (ionized, radius) pairs are returned,
+	the float16 radius boxes being numpy.memmap files radius_<n>"""
+	w = I.shape[0]
+	HII_TOT_NUM_PIXELS = I.size
+	if workdir is None:
+		workdir = tempfile.mkdtemp(prefix='ionization')
+	rows = slab_rows(FFT_BYTES*w*(w/2+1), memory)
+	#fail before any work if the widest halo, at the largest radius, won't fit
+	if any(setting['update'] == 1 for setting in settings):
+		slab_rows(CELL_BYTES*w*w, memory, int(np.ceil(np.float32(max(radii)/scale))))
+	print 'out-of-core: {} planes per FFT slab, work files in {}'.format(min(rows, w), workdir)
+
+	ionized = [scratch(workdir, 'ionized_{}'.format(n), np.float32, I.shape) for n in range(len(settings))]
+	if bubble_radius:
+		radius = [scratch(workdir, 'radius_{}'.format(n), np.float16, I.shape) for n in range(len(settings))]
+	deltak = scratch(workdir, 'deltak', np.complex64, (w, w, w/2+1))
+	filtered = scratch(workdir, 'filtered', np.complex64, deltak.shape)
+	smoothed = scratch(workdir, 'smoothed', np.float32, I.shape)
+
+	#settings with the same barrier see the same fcoll at every radius
+	groups = {}
+	for n, setting in enumerate(settings):
+		key = (float(setting['fc_mean_ps']), tuple(float(d) for d in setting['denoms']))
+		groups.setdefault(key, []).append(n)
+	groups = sorted(groups.values())
+
+	forward_slabs(I, deltak, rows, fgrowth, threads)
+	if skip:
+		bound = smoothed_bound(deltak, dk, fil)
+		deltamean = deltak[0,0,0].real/HII_TOT_NUM_PIXELS
+	done = [False]*len(settings) #settings whose box is fully ionized
+	nskipped = 0
+
+	for r, R in enumerate(radii):
+		final_step = r == len(radii)-1
+		active = [[n for n in group if not done[n]] for group in groups]
+		active = [group for group in active if group]
+		if not active:
+			print 'all cells ionized, stopping at R={} Mpc'.format(R)
+			nskipped += len(radii) - r
+			break
+
+		if skip and not final_step and not can_ionize(bound(R), deltamean, r, settings, active, deltac, LE):
+			nskipped += 1
+			continue
+
+		print 'R={} Mpc'.format(R)
+		smooth_slabs(deltak, filtered, smoothed, dk, fil, R, rows, threads)
+		Rpix = np.float32(R/scale)
+
+		for group in active:
+			first = settings[group[0]]
+			denom = first['denoms'][r]
+			if not LE:
+				norm = first['fc_mean_ps']/fcoll_mean(smoothed, deltac, denom, slab_rows(CELL_BYTES*w*w, memory))
+			#painting a slab needs the ionizing cells up to R away on either side
+			halo = 0
+			if any(settings[n]['update'] == 1 for n in group):
+				halo = int(np.ceil(Rpix))
+			complete = dict((n, True) for n in group)
+			for s in slabs(w, slab_rows(CELL_BYTES*w*w, memory, halo)):
+				lo, hi = max(s.start - halo, 0), min(s.stop + halo, w)
+				fcoll = fcoll_kernel(smoothed[lo:hi], deltac, denom)
+				if not LE:
+					fcoll *= norm #normalize since we used non-linear density
+				inner = slice(s.start - lo, s.stop - lo)
+				for n in group:
+					zeta = settings[n]['zeta']
+					slab = ionized[n][s]
+					if settings[n]['update'] == 0:
+						update_kernel(slab, fcoll[inner], zeta)
+					elif settings[n]['update'] == 1:
+						update_sphere_kernel(slab, fcoll, zeta, Rpix, inner)
+					if bubble_radius:
+						record_kernel(radius[n][s], slab, R)
+					if final_step:
+						final_kernel(slab, fcoll[inner], zeta)
+					elif skip:
+						complete[n] = complete[n] and bool(slab.all())
+			if skip and not final_step:
+				for n in group:
+					done[n] = complete[n]
+
+	if skip:
+		print 'skipped {} of {} filter passes'.format(nskipped, len(radii))
+	del deltak, filtered, smoothed
+	for name in ('deltak', 'filtered', 'smoothed'):
+		os.remove(os.path.join(workdir, name))
+	for box in ionized:
+		box.flush()
+	print 'ionization boxes written to {}'.format(workdir)
+	if bubble_radius:
+		for box in radius:
+			box.flush()
+		return zip(ionized, radius)
+	return ionized
+
+def conv_bubbles_ooc(I, param_dict, Z, settings, scale=None, fil=1, LE=False, memory=2**30, workdir=None,
+		threads=None, skip=True, bubble_radius=False):
+	"""find_bubbles_cpu.conv_bubbles_batch working out of core within about
+	memory bytes, see excursion_set_ooc. I may be a numpy.memmap and is
+	never read in full"""
+	print "Using filter_type {}".format(fil)
+	if scale is None:
+		scale = float(param_dict['BoxSize'])/param_dict['HIIdim']
+	dk, deltac, fgrowth, radii, engine_settings = engine_setup(I.shape[0], param_dict, Z, settings, scale)
+	if LE:
+		fgrowth = None
+	return excursion_set_ooc(I, dk, radii, engine_settings, deltac, fil=fil, LE=LE, scale=scale, fgrowth=fgrowth,
+		memory=memory, workdir=workdir, threads=threads, skip=skip, bubble_radius=bubble_radius)
@@ -0,0 +1,49 @@
+#the excursion-set engines are imported from the repository root, as by
+#find_HII_bubbles
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy import ndimage, special
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+  sys.path.insert(0,ROOT)
+
+
+@pytest.fixture
+def density():
+  """smooth gaussian density box of 32 cells per side and 2 Mpc cells,
+  with the param_dict and redshift to ionize it with"""
+  np.random.seed(1)
+  I=ndimage.gaussian_filter(np.random.randn(32,32,32),2,mode='wrap').astype(np.float32)*6
+  return I,{'BoxSize':64.,'HIIdim':32},10.
+
+
+def toy_sigma(R):
+  """stands in for Choud14.sig0, which needs cosmolopy"""
+  return 1.2/(1+np.float64(R))**0.8
+
+
+@pytest.fixture
+def engine(density):
+  """function turning a list of settings, each with zeta, update and
+  optionally smin (the barrier, as set by Tvir), into the arguments
+  (I,dk,radii,settings,deltac,scale) of excursion_set_batch for the density
+  box, following find_bubbles_cpu.engine_setup with a toy cosmology"""
+  import find_bubbles_cpu
+  (I,param_dict,Z)=density
+  scale=param_dict['BoxSize']/param_dict['HIIdim']
+  dk=2*np.pi/I.shape[0]*scale
+  deltac=1.686*13/(1.+Z)
+  radii=find_bubbles_cpu.radius_schedule(scale)
+  def make(settings):
+    engine_settings=[]
+    for setting in settings:
+      smin=setting.get('smin',toy_sigma(0.5))
+      engine_settings.append({'zeta':setting.get('zeta',40.),'update':setting.get('update',0),
+        'fc_mean_ps':np.float32(special.erfc(deltac/np.sqrt(2*smin))),
+        'denoms':[np.sqrt(2*(smin-np.float32(toy_sigma(R)))).astype(np.float32) for R in radii]})
+    return I*np.float32(deltac/1.686),dk,radii,engine_settings,deltac,scale
+  return make
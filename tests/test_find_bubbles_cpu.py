@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import find_bubbles_cpu as cpu
+
+
+@pytest.mark.parametrize('update',[0,1])
+def test_bubble_radius(engine,update):
+  (I,dk,radii,settings,deltac,scale)=engine([{'zeta':20.,'update':update}])
+  (ionized,radius)=cpu.excursion_set_batch(I,dk,radii,settings,deltac,scale=scale,bubble_radius=True)[0]
+  assert radius.dtype==np.float16
+  assert 0<(ionized==1).mean()<1
+  assert np.array_equal(ionized==1,radius>0)
+  assert set(np.unique(radius[radius>0]))<=set(np.float16(radii))
+  #the flags of a schedule cut short at a radius are the cells whose bubble
+  #is at least that large
+  for r in (10,30,len(radii)-2):
+    cut=dict(settings[0],denoms=settings[0]['denoms'][:r+1])
+    short=cpu.excursion_set_batch(I,dk,radii[:r+1],[cut],deltac,scale=scale)[0]
+    assert np.array_equal(short==1,radius>=np.float16(radii[r]))
+  (R,fraction)=cpu.radius_distribution(radius,rows=5)
+  assert np.all(np.diff(R)<0)
+  assert np.isclose(fraction.sum(),(ionized==1).mean())
+  assert np.isclose(fraction[R>=np.float32(np.float16(radii[30]))].sum(),(radius>=np.float16(radii[30])).mean())
+
+
+def test_batch_matches_separate_runs(engine):
+  #two barriers, with settings sharing each
+  settings=[{'zeta':10.,'update':0},{'zeta':20.,'update':1},{'zeta':10.,'update':0,'smin':1.},
+            {'zeta':10.,'update':1,'smin':1.}]
+  (I,dk,radii,settings,deltac,scale)=engine(settings)
+  batch=cpu.excursion_set_batch(I,dk,radii,settings,deltac,scale=scale)
+  assert len(batch)==len(settings)
+  for (setting,ionized) in zip(settings,batch):
+    single=cpu.excursion_set(I,dk,radii,setting['denoms'],deltac,setting['fc_mean_ps'],zeta=setting['zeta'],
+      update=setting['update'],scale=scale)
+    assert 0<(ionized==1).mean()<1
+    assert np.array_equal(ionized,single)
+
+
+def test_conv_bubbles_batch(density):
+  #engine_setup needs the cosmology of Choud14
+  pytest.importorskip('Choud14')
+  (I,param_dict,Z)=density
+  settings=[{'zeta':10.,'update':0},{'zeta':20.,'update':1},{'update':1}]
+  batch=cpu.conv_bubbles_batch(I,param_dict,Z,settings)
+  for (setting,ionized) in zip(settings,batch):
+    assert np.array_equal(ionized,cpu.conv_bubbles_batch(I,param_dict,Z,[setting])[0])
+  assert np.array_equal(batch[2],cpu.conv_bubbles_cpu(I,param_dict,Z,update=1))
+
+
+@pytest.mark.parametrize('update',[0,1])
+def test_skip_does_not_change_result(engine,update):
+  settings=[{'zeta':5.,'update':update},{'zeta':40.,'update':update}]
+  (I,dk,radii,settings,deltac,scale)=engine(settings)
+  for LE in (False,True):
+    skipped=cpu.excursion_set_batch(I,dk,radii,settings,deltac,LE=LE,scale=scale,skip=True,bubble_radius=True)
+    full=cpu.excursion_set_batch(I,dk,radii,settings,deltac,LE=LE,scale=scale,skip=False,bubble_radius=True)
+    for ((a,ra),(b,rb)) in zip(skipped,full):
+      assert np.array_equal(a,b)
+      assert np.array_equal(ra,rb)
+
+
+@pytest.mark.parametrize('fil',[0,1,2])
+def test_smoothed_bound(engine,fil):
+  from tocmfastpy import fftutils
+  (I,dk,radii,settings,deltac,scale)=engine([{}])
+  deltak=fftutils.rfftn(I)
+  bound=cpu.smoothed_bound(deltak,dk,fil)
+  for R in radii[::8]+radii[-1:]:
+    fourierbox=deltak.copy()
+    cpu.HII_filter(fourierbox,dk,fil,R)
+    smoothed=fftutils.irfftn(fourierbox,I.shape)
+    assert np.abs(smoothed).max()<=bound(R)
+
+
+@pytest.mark.parametrize('fil',[0,1,2])
+def test_HII_filter_work_buffer(fil):
+  from tocmfastpy import fftutils
+  w=16
+  dk=2*np.pi/32.
+  deltak=fftutils.rfftn(np.random.RandomState(2).randn(w,w,w).astype(np.float32))
+  kR=fftutils.kGrid(w,2*np.pi/dk)*np.float32(3.)
+  with np.errstate(divide='ignore',invalid='ignore'):
+    W={0:3*(np.sin(kR)/kR**3-np.cos(kR)/kR**2),1:(kR*np.float32(0.413566994)<=1).astype(np.float32),
+       2:np.exp(-(kR*np.float32(0.643))**2/2)}[fil]
+  if fil==0:
+    W[kR<=1e-4]=1
+  work=np.empty(deltak.shape,dtype=np.float32)
+  filtered=cpu.HII_filter(deltak.copy(),dk,fil,3.,work)
+  assert np.allclose(filtered,deltak*W,rtol=1e-6,atol=1e-6*np.abs(deltak).max())
+  if fil==0:
+    assert np.array_equal(filtered,deltak*W)
+  assert np.array_equal(cpu.HII_filter(deltak.copy(),dk,fil,3.),filtered)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import find_bubbles_cpu as cpu
+import find_bubbles_ooc as ooc
+
+SETTINGS=[{'zeta':10.,'update':0},{'zeta':20.,'update':1},{'zeta':20.,'update':0}]
+
+
+@pytest.mark.parametrize('settings,memory',[
+  (SETTINGS,48*32*32*36), #halo of 15 planes at 30 Mpc, 6 planes per slab
+  (SETTINGS[::2],48*32*17*5), #no halo, 5 planes per FFT slab
+])
+def test_ooc_matches_in_core(density,engine,tmpdir,settings,memory):
+  (I,dk,radii,settings,deltac,scale)=engine(settings)
+  expected=cpu.excursion_set_batch(I,dk,radii,settings,deltac,scale=scale)
+  #the growth factor is applied slab by slab to the unscaled density
+  fgrowth=np.float32(deltac/1.686)
+  result=ooc.excursion_set_ooc(density[0],dk,radii,settings,deltac,scale=scale,fgrowth=fgrowth,
+    memory=memory,workdir=str(tmpdir))
+  assert sorted(tmpdir.listdir())==sorted(tmpdir.join('ionized_%d' % n) for n in range(len(settings)))
+  for (a,b) in zip(expected,result):
+    assert 0<(a==1).mean()<1
+    assert np.array_equal(a==1,b==1)
+    assert np.allclose(a,b,rtol=0,atol=1e-6)
+
+
+def test_conv_bubbles_ooc(density,tmpdir):
+  #engine_setup needs the cosmology of Choud14
+  pytest.importorskip('Choud14')
+  (I,param_dict,Z)=density
+  expected=cpu.conv_bubbles_batch(I,param_dict,Z,SETTINGS)
+  result=ooc.conv_bubbles_ooc(I,param_dict,Z,SETTINGS,memory=48*32*32*36,workdir=str(tmpdir))
+  for (a,b) in zip(expected,result):
+    assert np.array_equal(a==1,b==1)
+    assert np.allclose(a,b,rtol=0,atol=1e-6)
+
+
+def test_slab_rows():
+  assert ooc.slab_rows(100,1000)==10
+  assert ooc.slab_rows(100,1000,halo=2)==6
+  with pytest.raises(ValueError) as error:
+    ooc.slab_rows(100,1000,halo=5)
+  assert '1100 bytes' in str(error.value)
+
+
+def test_ooc_budget_too_small_for_halo(engine,tmpdir):
+  (I,dk,radii,settings,deltac,scale)=engine(SETTINGS)
+  with pytest.raises(ValueError):
+    ooc.excursion_set_ooc(I,dk,radii,settings,deltac,scale=scale,memory=48*32*32*20,workdir=str(tmpdir))
+  #nothing was filtered before the budget was checked
+  assert not tmpdir.join('smoothed').check() or tmpdir.join('smoothed').size()==0
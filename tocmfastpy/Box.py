@@ -3,8 +3,14 @@ maintain list of run data and location of boxes
 if boxes read in to memory then remember that too"""
 
 import numpy
+import warnings
+from BoxMoments import *
 
 class Box:
+    #set Box.checkUpcast=True to warn whenever a full size box is held in
+    #double precision; boxes are float32 and masks bool to save memory
+    checkUpcast=False
+
     def __init__(self):
         self.name='my name'
         self.box_data=[]
@@ -27,13 +33,27 @@ class Box:
         self.dim=param_dict['dim']
         self.init=True
         self.z=param_dict['z']
+        self.checkDtype()
+        return
+
+    def checkDtype(self,data=None):
+        """if Box.checkUpcast is set, warn when data (default box_data) is a
+        float64 array as large as the full box"""
+        if not self.checkUpcast:
+            return
+        if data is None:
+            data=self.box_data
+        if getattr(data,'dtype',None)==numpy.float64 and numpy.size(data)>=self.dim**3:
+            warnings.warn('full size box of shape %s upcast to float64' % (data.shape,),
+                          RuntimeWarning,stacklevel=3)
         return
 
     def getBoxStats(self):
         if self.init:
             print 'box_data exists'
-            self.mean=self.box_data.mean()
-            self.var=self.box_data.var()
+            moments=self.moments(nmom=2)
+            self.mean=moments.mean()
+            self.var=moments.var()
         else:
             print 'box_data has not been initialised'
             self.mean=0.0
@@ -41,36 +61,159 @@ class Box:
 
         print 'mean=',self.mean, ' var=',self.var
         return
+
+    def moments(self,nmom=4,hrange=None,nbin=0,step=1):
+        """return a BoxMoments holding the mean, central moments up to nmom,
+        min/max and, if hrange=(xmin,xmax) and nbin are given, a histogram,
+        all from a single pass over the box in chunks. step>1 uses only
+        every step-th cell along each axis"""
+        moments=BoxMoments(nmom,hrange,nbin)
+        for chunk in self.chunks(ncells=2**22,step=step):
+            moments.add(chunk)
+        return moments
     
-    def boxToOverdensity(self):
-        """Renormalise the box to scaled variable delta=(x-xmean)/xmean"""
+    def boxToOverdensity(self,inplace=False):
+        """Renormalise the box to scaled variable delta=(x-xmean)/xmean
+
+        inplace=True overwrites box_data chunk by chunk rather than
+        allocating a new box, so peak memory does not double. Read-only
+        (memory mapped) boxes are always copied.
+        """
         if self.init:
             self.getBoxStats()
-            self.box_data=(self.box_data-self.mean)/self.mean
+            mean=self.mean
+            if inplace and self.box_data.flags.writeable:
+                for chunk in self.chunks():
+                    chunk-=mean
+                    chunk/=mean
+            else:
+                self.box_data=(self.box_data-mean)/mean
+                self.checkDtype()
 
+            #statistics of the renormalised box follow directly
+            self.mean=0.0
+            self.var=self.var/mean**2
         else:
             print 'box_data has not been initialised'
+            self.mean=0.0
+            self.var=0.0
 
-        self.getBoxStats()
+        print 'mean=',self.mean, ' var=',self.var
         return
 
     def boxFromThreshold(self,crit_delta):
-        #produce new box with all zeros
-        newbox=numpy.zeros(self.box_data.shape)
-        newbox[self.box_data<=crit_delta]=1
-        return newbox
+        #produce bool mask box, True where box_data<=crit_delta
+        return self.box_data<=crit_delta
+
+    def chunks(self,ncells=2**24,step=1):
+        """iterate over the box data in slabs along the first axis holding
+        about ncells cells, so that memmapped boxes are streamed from disk
+        rather than read all at once. step>1 sub-samples every step-th cell
+        along each axis. With step=1 the slabs are views into box_data"""
+        data=self.box_data
+        if step>1:
+            data=data[::step,::step,::step]
+        nslab=max(1,ncells//max(1,data[0].size))
+        for i in range(0,data.shape[0],nslab):
+            yield data[i:i+nslab]
 
-    def thresholdFromVolume(self,vol_frac):
+    def thresholdFromVolume(self,vol_frac,nbins=4096,maxcand=2**22):
         """given a volume fraction find the threshold delta_crit that
-        divides box values below that from box values above that. """
+        divides box values below that from box values above that.
 
+        vol_frac may also be an array of volume fractions, in which case an
+        array of thresholds is returned from the same passes over the box.
+
+        Rather than sorting a copy of the box, a histogram locates the bin
+        holding the threshold, which is refined until at most maxcand
+        candidate values remain and these are selected exactly. Only a slab
+        of the box is in memory at a time, so memmapped boxes work too.
+        """
+
+        data=self.box_data
+        fracs=numpy.atleast_1d(vol_frac)
         #work in terms of number of pixels that need to be below threshold
-        count_frac=int(vol_frac*self.box_data.size)
-        #use ordered list of all box elements
-        indx=self.box_data.copy()   #this is memory inefficient
-        indx=indx.reshape((indx.size))
-        indx.sort()
-        #find threshold value
-        crit_delta=indx[count_frac]
+        counts=numpy.minimum((fracs*data.size).astype(numpy.int64),data.size-1)
+        crit=numpy.zeros(len(counts))
+
+        #each search holds the interval [lo,hi) of values, the number of
+        #box values in it and the targets (index,rank within interval)
+        #bin edges are kept in the data type so comparisons with the box
+        #values and with the edges agree exactly
+        if data.dtype.kind=='f':
+            dtype=data.dtype.type
+        else:
+            dtype=numpy.float64
+        xmin=numpy.inf
+        xmax=-numpy.inf
+        for chunk in self.chunks():
+            xmin=min(xmin,chunk.min())
+            xmax=max(xmax,chunk.max())
+        (xmin,xmax)=(dtype(xmin),dtype(xmax))
+        searches=[(xmin,numpy.nextafter(xmax,dtype(numpy.inf)),data.size,
+                   [(k,counts[k]) for k in range(len(counts))])]
+
+        while searches:
+            #decide which searches can select from their candidates now
+            collect=[search[2]<=maxcand for search in searches]
+            edges=[numpy.linspace(search[0],search[1],nbins+1).astype(dtype) for search in searches]
+            hists=[numpy.zeros(nbins,dtype=numpy.int64) for search in searches]
+            cands=[[] for search in searches]
+            vmin=[numpy.inf for search in searches]
+            vmax=[-numpy.inf for search in searches]
+
+            for chunk in self.chunks():
+                for (n,(lo,hi,size,targets)) in enumerate(searches):
+                    sel=chunk[(chunk>=lo)&(chunk<hi)]
+                    if sel.size==0:
+                        continue
+                    if collect[n]:
+                        cands[n].append(sel.ravel())
+                    else:
+                        sel=sel.ravel()
+                        edge=edges[n]
+                        indx=((sel-lo)*(nbins/(hi-lo))).astype(numpy.intp)
+                        numpy.clip(indx,0,nbins-1,out=indx)
+                        #rounding can put values next to their true bin, so
+                        #correct against the edges themselves
+                        while True:
+                            low=sel<edge[indx]
+                            high=sel>=edge[indx+1]
+                            if not (low.any() or high.any()):
+                                break
+                            indx-=low
+                            indx+=high
+                        hists[n]+=numpy.bincount(indx,minlength=nbins)
+                        vmin[n]=min(vmin[n],sel.min())
+                        vmax[n]=max(vmax[n],sel.max())
+
+            refined=[]
+            for (n,(lo,hi,size,targets)) in enumerate(searches):
+                if collect[n]:
+                    cand=numpy.concatenate(cands[n])
+                    ranks=[rank for (k,rank) in targets]
+                    cand=numpy.partition(cand,ranks)
+                    for (k,rank) in targets:
+                        crit[k]=cand[rank]
+                elif vmin[n]==vmax[n]:
+                    #all values in the interval are equal
+                    for (k,rank) in targets:
+                        crit[k]=vmin[n]
+                else:
+                    #narrow each target to the bin that holds it
+                    cum=numpy.cumsum(hists[n])
+                    bins={}
+                    for (k,rank) in targets:
+                        b=numpy.searchsorted(cum,rank,side='right')
+                        below=cum[b-1] if b>0 else 0
+                        bins.setdefault(b,[]).append((k,rank-below))
+                    for b in sorted(bins.keys()):
+                        refined.append((edges[n][b],edges[n][b+1],hists[n][b],bins[b]))
+            searches=refined
+
+        if numpy.isscalar(vol_frac):
+            crit_delta=crit[0]
+        else:
+            crit_delta=crit
         
         return crit_delta
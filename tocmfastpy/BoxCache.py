@@ -0,0 +1,194 @@
+#!/usr/bin/python
+"""
+Class: BoxCache
+
+Bounded least-recently-used cache of Box objects keyed by filename, with
+background prefetching on a thread pool.
+
+The cache holds boxes up to a memory budget in bytes and evicts the least
+recently used box once that is exceeded. prefetch() starts reading boxes on
+worker threads so that I/O for the next redshift overlaps with work on the
+current one. numpy releases the GIL while reading, so threads are enough.
+
+The expected size of a box is reserved against the budget as soon as its
+prefetch is submitted, and prefetches that would not fit are dropped, so
+the budget holds for boxes in flight too. Finished prefetches join the
+cache as its most recently used boxes.
+
+Cached data is shared between callers, so get() hands out a separate Box
+whose box_data is read-only. Ask for get(filename,writeable=True) to
+receive a private copy that can be modified in place.
+
+EXAMPLE USAGE:
+     cache=BoxCache(budget=8e9,nworkers=2)
+     cache.prefetch([slice.fxH,slice.fdensity])
+     box=cache.get(slice.fxH)
+
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy
+import boxio
+import boxstore
+
+
+def expected_bytes(filename):
+    """bytes taken by the data of a box file once read, from its header or
+    file size alone"""
+    if boxstore.is_store(filename):
+        array=boxstore.read_header(filename)['arrays']['box']
+        return int(numpy.prod(array['shape']))*numpy.dtype(str(array['dtype'])).itemsize
+    dim=boxio.parse_filename(filename)['HIIdim']
+    return int(numpy.prod(boxio.box_shape(filename,dim)))*numpy.dtype('f').itemsize
+
+
+class BoxCache:
+    """Define BoxCache class holding recently used boxes in memory"""
+    def __init__(self,budget=4e9,nworkers=2,mmap=False):
+        self.budget=budget      #memory budget in bytes
+        self.nworkers=nworkers  #number of prefetch threads
+        self.mmap=mmap          #memory map boxes rather than reading them
+        self.used=0             #bytes held or reserved for prefetches
+        self.boxes=OrderedDict()  #{filename: Box} oldest first
+        self.pending={}         #{filename: (token,AsyncResult)} being prefetched
+        self.reserved={}        #{filename: bytes} reserved for each prefetch
+        self.lock=threading.Lock()
+        self.pool=None
+        return
+
+    def info(self):
+        """report the state of the cache"""
+        print 'cached boxes=',len(self.boxes),' pending=',len(self.pending)
+        print 'used=',self.used,' of budget=',self.budget
+        return
+
+    def get(self,filename,writeable=False):
+        """return the Box for filename, reading it if it is not cached. The
+        box_data is read-only and shared with the cache unless writeable is
+        set, in which case it is a private copy"""
+        self.lock.acquire()
+        try:
+            box=self.boxes.pop(filename,None)
+            if box is not None:
+                self.boxes[filename]=box
+            else:
+                pending=self.pending.pop(filename,None)
+                self.used-=self.reserved.pop(filename,0)
+        finally:
+            self.lock.release()
+
+        if box is not None:
+            return self.handout(box,writeable)
+        if pending is not None:
+            box=pending[1].get()
+        else:
+            box=boxio.readbox(filename,quiet=True,mmap=self.mmap)
+
+        self.lock.acquire()
+        try:
+            if filename in self.boxes:
+                box=self.boxes[filename]
+            else:
+                self.store(filename,box)
+        finally:
+            self.lock.release()
+
+        return self.handout(box,writeable)
+
+    def handout(self,box,writeable):
+        """a Box of its own for the caller, sharing cached data read-only
+        or holding a writeable copy of it"""
+        box=copy.copy(box)
+        if writeable:
+            box.box_data=numpy.array(box.box_data)
+        return box
+
+    def store(self,filename,box):
+        """add a freshly read box as the most recently used one, making its
+        data read-only. Caller must hold the lock"""
+        box.box_data.flags.writeable=False
+        self.boxes[filename]=box
+        self.used+=box.box_data.nbytes
+        self.evict()
+        return
+
+    def prefetch(self,filenames):
+        """start reading boxes in the background. The expected size of each
+        is reserved against the budget, evicting older boxes if need be, and
+        boxes that still don't fit are not prefetched"""
+        if self.pool is None:
+            self.pool=ThreadPool(self.nworkers)
+
+        self.lock.acquire()
+        try:
+            for filename in filenames:
+                if not filename or filename in self.boxes or filename in self.pending:
+                    continue
+                nbytes=expected_bytes(filename)
+                self.used+=nbytes
+                self.evict()
+                if self.used>self.budget:
+                    self.used-=nbytes
+                    continue
+                token=object()
+                callback=lambda box,filename=filename,token=token: self.prefetched(filename,token,box)
+                result=self.pool.apply_async(boxio.readbox,(filename,True,self.mmap),callback=callback)
+                self.pending[filename]=(token,result)
+                self.reserved[filename]=nbytes
+        finally:
+            self.lock.release()
+        return
+
+    def prefetched(self,filename,token,box):
+        """move a finished prefetch into the cache, swapping its reservation
+        for its actual size. Runs on the pool's result thread"""
+        self.lock.acquire()
+        try:
+            pending=self.pending.get(filename)
+            if pending is not None and pending[0] is token:
+                del self.pending[filename]
+                self.used-=self.reserved.pop(filename)
+                self.store(filename,box)
+        finally:
+            self.lock.release()
+        return
+
+    def evict(self):
+        """drop least recently used boxes until within budget, always
+        keeping the most recent one. Prefetches in flight are not dropped.
+        Caller must hold the lock"""
+        while self.used>self.budget and len(self.boxes)>1:
+            (filename,box)=self.boxes.popitem(last=False)
+            self.used-=box.box_data.nbytes
+        return
+
+    def forget(self,filename):
+        """remove a single box from the cache"""
+        self.lock.acquire()
+        try:
+            box=self.boxes.pop(filename,None)
+            if box is not None:
+                self.used-=box.box_data.nbytes
+            self.pending.pop(filename,None)
+            self.used-=self.reserved.pop(filename,0)
+        finally:
+            self.lock.release()
+        return
+
+    def clear(self):
+        """empty the cache and stop the prefetch threads"""
+        self.lock.acquire()
+        try:
+            self.boxes=OrderedDict()
+            self.pending={}
+            self.reserved={}
+            self.used=0
+        finally:
+            self.lock.release()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool=None
+        return
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+"""
+Class: BoxIndex
+
+Persistent index of the parsed filenames in a 21cmFast Boxes directory.
+
+Parsing every filename with boxio.parse_filename is slow for directories
+holding tens of thousands of boxes, and runio, Run and Slice would each
+otherwise redo it. BoxIndex parses each file once and keeps the resulting
+param_dicts in a sidecar file inside the directory. When the directory
+mtime or listing changes only the new files are parsed. The sidecar is
+replaced by renaming a complete temporary file over it, so other processes
+never read it half written.
+
+EXAMPLE USAGE:
+     index=BoxIndex('../21cmFAST/Boxes/')
+     index.query(type='xh',dim=200,BoxSize=143)
+     index.query(type='density',z=9.0)
+
+"""
+
+import os
+import sys
+import pickle
+import tempfile
+import boxio
+
+
+class BoxIndex:
+    """Define BoxIndex class for holding parsed filenames of a directory"""
+    indexname='.tocmfastpy_index'
+
+    def __init__(self,base=''):
+        self.base=base
+        self.mtime=None   #mtime of base when index was last brought up to date
+        self.params={}    #{filename: param_dict} keyed by filename without base
+        self.init=False
+        if base:
+            self.update()
+        return
+
+    def indexfile(self):
+        """path to the sidecar file holding the index"""
+        return os.path.join(self.base,self.indexname)
+
+    def load(self):
+        """read the sidecar file if there is one. Returns True on success"""
+        try:
+            fd=open(self.indexfile(),'rb')
+            (mtime,params)=pickle.load(fd)
+            fd.close()
+        except (IOError,EOFError,ValueError,pickle.UnpicklingError):
+            return False
+
+        self.mtime=mtime
+        self.params=params
+        return True
+
+    def save(self):
+        """write the index to a temporary file in the directory and rename
+        it over the sidecar file"""
+        tmpname=None
+        try:
+            (handle,tmpname)=tempfile.mkstemp(prefix=self.indexname,suffix='.tmp',dir=self.base)
+            fd=os.fdopen(handle,'wb')
+            try:
+                pickle.dump((self.mtime,self.params),fd,pickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            #mkstemp files are private, so give the sidecar the usual permissions
+            umask=os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpname,0666&~umask)
+            os.rename(tmpname,self.indexfile())
+        except (IOError,OSError) as e:
+            #read only directories just don't get a persistent index
+            print "Could not save index for", self.base, e
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+        return
+
+    def update(self):
+        """bring the index up to date with the directory, parsing only the
+        files that are not already indexed. As directory mtimes may be too
+        coarse to see every change, the listing is compared too"""
+        if not os.path.isdir(self.base):
+            print self.base, 'is not a valid directory'
+            sys.exit(1)
+
+        if not self.init:
+            self.load()
+            self.init=True
+
+        mtime=os.path.getmtime(self.base)
+        #the sidecar and any temporary files of a save are not boxes
+        current=set(filename for filename in os.listdir(self.base)
+                    if not filename.startswith(self.indexname))
+        if mtime==self.mtime and current==set(self.params.keys()):
+            return
+
+        #forget files that have gone and parse the new ones
+        changed=False
+        for filename in self.params.keys():
+            if filename not in current:
+                del self.params[filename]
+                changed=True
+        for filename in current:
+            if filename not in self.params:
+                self.params[filename]=boxio.parse_filename(os.path.join(self.base,filename))
+                changed=True
+
+        self.mtime=mtime
+        if changed:
+            self.save()
+        return
+
+    def filenames(self):
+        """return sorted list of full paths to all indexed files"""
+        return [os.path.join(self.base,filename) for filename in sorted(self.params.keys())]
+
+    def param_dict(self,filepath):
+        """return the parsed param_dict of a file, parsing it if it is not
+        part of the index"""
+        (base,filename)=os.path.split(filepath)
+        if filename in self.params and os.path.abspath(base)==os.path.abspath(self.base):
+            return self.params[filename]
+        return boxio.parse_filename(filepath)
+
+    def query(self,**kwargs):
+        """return sorted list of full paths to files whose param_dict matches
+        all of the keyword arguments e.g. query(type='xh',z=9.0,dim=200).
+        Any param_dict key can be used, typically type, z, dim, BoxSize and
+        Iteration
+        """
+        files=[]
+        for filename in sorted(self.params.keys()):
+            param_dict=self.params[filename]
+            match=True
+            for key in kwargs:
+                if key not in param_dict or not param_dict[key]==kwargs[key]:
+                    match=False
+                    break
+            if match:
+                files.append(os.path.join(self.base,filename))
+
+        return files
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+"""
+Class: BoxMoments
+
+Accumulates the statistics of a box in a single pass over chunks of data:
+number of cells, mean, variance and higher central moments, min/max and
+optionally a histogram over a fixed range.
+
+Moments are accumulated as power sums of (x-shift) in double precision,
+with shift taken from the first chunk to avoid cancellation. Central
+moments are recovered from the power sums by binomial expansion.
+
+EXAMPLE USAGE:
+     moments=BoxMoments(nmom=4,hrange=(-1,5),nbin=100)
+     for chunk in box.chunks():
+         moments.add(chunk)
+     print moments.mean(), moments.var(), moments.moment(3)
+     pdf=moments.pdf()
+
+"""
+
+import numpy as np
+from PDF import *
+
+
+def binindex(x,lo,hi,nbin):
+    """index of the uniform bin over [lo,hi] holding each value of x, with
+    values equal to hi in the last bin (as numpy.histogram) and -1 for
+    values outside the range"""
+    indx=np.floor((x-lo)*(nbin/float(hi-lo))).astype(np.intp)
+    indx[x==hi]=nbin-1
+    indx[(indx<0)|(indx>=nbin)]=-1
+    return indx
+
+
+class BoxMoments:
+    """Define BoxMoments class for single pass box statistics"""
+    def __init__(self,nmom=4,hrange=None,nbin=0):
+        self.nmom=nmom         #highest moment accumulated
+        self.n=0               #number of cells seen
+        self.shift=None        #shift applied before forming power sums
+        self.sums=np.zeros(nmom+1)  #sums of (x-shift)**p for p=0..nmom
+        self.xmin=np.inf
+        self.xmax=-np.inf
+        self.hrange=hrange     #(xmin,xmax) of histogram, if any
+        self.nbin=nbin
+        self.hist=np.zeros(nbin,dtype=np.int64)
+        return
+
+    def add(self,data):
+        """add a chunk of data to the accumulated statistics"""
+        if data.size==0:
+            return
+        x=np.asarray(data,dtype=np.float64).ravel()
+        if self.shift is None:
+            self.shift=x.mean()
+
+        self.n+=x.size
+        self.xmin=min(self.xmin,x.min())
+        self.xmax=max(self.xmax,x.max())
+
+        d=x-self.shift
+        p=np.ones_like(d)
+        self.sums[0]+=x.size
+        for i in range(1,self.nmom+1):
+            p*=d
+            self.sums[i]+=p.sum()
+
+        if self.nbin>0 and self.hrange is not None:
+            (lo,hi)=self.hrange
+            indx=binindex(x,lo,hi,self.nbin)
+            self.hist+=np.bincount(indx[indx>=0],minlength=self.nbin)
+        return
+
+    def mean(self):
+        """mean of the data seen so far"""
+        if self.n==0:
+            return 0.0
+        return self.shift+self.sums[1]/self.n
+
+    def moment(self,Nmom):
+        """Nth central moment of the data seen so far
+
+        N=2: gives variance
+        N=3: gives (unnormalised) skew
+        N=4: gives (unnormalised) kurtosis
+        """
+        if Nmom>self.nmom:
+            print "Only accumulated moments up to N=",self.nmom
+            return 0.0
+        if self.n==0:
+            return 0.0
+
+        #raw moments about shift, then expand (d-m)**N binomially
+        raw=self.sums/self.n
+        m=raw[1]
+        mom=0.0
+        coeff=1.0
+        for j in range(Nmom+1):
+            mom+=coeff*raw[Nmom-j]*(-m)**j
+            coeff=coeff*(Nmom-j)/(j+1)
+        return mom
+
+    def var(self):
+        """variance of the data seen so far"""
+        return self.moment(2)
+
+    def pdf(self):
+        """return the accumulated histogram as a PDF object"""
+        pdfV=PDF()
+        if self.nbin==0 or self.hrange is None:
+            print "No histogram was accumulated"
+            return pdfV
+
+        (lo,hi)=self.hrange
+        delta=(hi-lo)/float(self.nbin)
+        xbin=lo+delta*(np.arange(self.nbin)+0.5)
+        pdfV.setFromFreq(lo,hi,delta,xbin,self.hist.astype(np.float64))
+        return pdfV
@@ -33,6 +33,7 @@ Last modified: 2 Jan 2012
 """
 
 from Slice import *
+from BoxCache import *
 import boxio
 import numpy
 import os.path
@@ -50,6 +51,7 @@ class Run:
         self.dim=0
         self.boxsize=0
         self.init=False
+        self.cache=None
         return
 
     def len(self):
@@ -80,16 +82,56 @@ class Run:
         return filedict
 
 
-    def setFromDict(self,filedict):
+    def setFromDict(self,filedict,index=None):
         """given dictionary of form {z,filenames} set up Run as a
         collection of Slices
+
+        index is an optional BoxIndex holding the parsed filenames
         """
         
         for z in sorted(filedict.keys()):
             slice=Slice()
             files=filedict[z]
-            slice.assignFiles(files)
+            slice.assignFiles(files,index)
             self.slices.append(slice)
             self.redshifts.append(z)
 
         return
+
+
+    def setCache(self,budget=4e9,nworkers=2,mmap=False):
+        """read boxes through a BoxCache holding at most budget bytes and
+        prefetching on nworkers threads"""
+        if self.cache is not None:
+            self.cache.clear()
+        self.cache=BoxCache(budget,nworkers,mmap)
+        return
+
+
+    def iterslices(self,filter=[True,True,True,True,True,True],reverse=False):
+        """iterate over (z,slice) in redshift order with the boxes selected
+        by filter loaded. The next slice's boxes are prefetched through the
+        Run's BoxCache while the current one is being processed, so I/O
+        overlaps with compute. reverse=True runs from high redshift to low.
+
+        EXAMPLE USAGE:
+             myrun.setCache(budget=8e9)
+             for (z,slice) in myrun.iterslices([False,True,False,False,False,False]):
+                 print z, slice.xH.box_data.mean()
+        """
+        if self.cache is None:
+            self.setCache()
+
+        order=range(len(self.slices))
+        if reverse:
+            order.reverse()
+
+        for (n,i) in enumerate(order):
+            slice=self.slices[i]
+            slice.loaddata(filter,cache=self.cache)
+            if n+1<len(order):
+                self.cache.prefetch(self.slices[order[n+1]].filelist(filter))
+            yield (self.redshifts[i],slice)
+            slice.forgetdata()
+
+        return
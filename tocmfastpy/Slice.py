@@ -21,6 +21,8 @@ import boxio
 class Slice:
     """This is the Slice class"""
     boxtypedict={'density':0,'xh':1,'vx':2,'vy':3,'vz':4,'deltaT':5}
+    pixeldtype=np.dtype([('density','f4'),('xH','f4'),('vx','f4'),
+                         ('vy','f4'),('vz','f4'),('deltaT','f4')])
     
     def __init__(self):
         self.init=False
@@ -65,10 +67,13 @@ class Slice:
         return files
     
 
-    def assignFiles(self,files):
+    def assignFiles(self,files,index=None):
         """from list of files work out which are which and assign Slice
 
         Also basic checking that all correspond to same redshift
+
+        index is an optional BoxIndex, in which case the already parsed
+        filenames are used rather than parsing them again
         """
 
         #default to no file present
@@ -80,7 +85,10 @@ class Slice:
         fdeltaT=''
 
         for file in files:
-            param_dict=boxio.parse_filename(file)
+            if index is not None:
+                param_dict=index.param_dict(file)
+            else:
+                param_dict=boxio.parse_filename(file)
             
             if (param_dict['type'] =='density'):
                 fdensity=file
@@ -145,31 +153,61 @@ class Slice:
         loaddata(filter)
         return
 
-    def loaddata(self,filter=[True,True,True,True,True,True]):
+    def filelist(self,filter=[True,True,True,True,True,True]):
+        """return list of the filenames selected by filter that exist.
+        Order: (density,xH,vx,vy,vz,deltaT)
+        """
+        files=[self.fdensity,self.fxH,self.fvx,self.fvy,self.fvz,self.fdeltaT]
+        return [file for (file,flag) in zip(files,filter) if flag and file]
+
+    def filename(self,label):
+        """filename of the box with string label, a key of boxtypedict
+        e.g. 'xh'. Returns '' if the Slice has no such box"""
+        files=[self.fdensity,self.fxH,self.fvx,self.fvy,self.fvz,self.fdeltaT]
+        return files[self.boxtypedict[label]]
+
+    def box(self,label):
+        """the loaded Box with string label, a key of boxtypedict e.g. 'xh'.
+        Returns False if that box is not loaded"""
+        boxes=[self.density,self.xH,self.vx,self.vy,self.vz,self.deltaT]
+        return boxes[self.boxtypedict[label]]
+
+    def loadbox(self,filename,mmap=False,cache=None):
+        """read a single box, going through cache if one is given"""
+        if cache is not None:
+            return cache.get(filename)
+        return boxio.readbox(filename,mmap=mmap)
+
+    def loaddata(self,filter=[True,True,True,True,True,True],mmap=False,cache=None):
         """Using filenames load data into memory
 
         filter is an optional tuple of booleans specifying which data should
         be loaded (density,xH,vx,vy,vz,deltaT). Default is load all
+
+        mmap=True memory maps the boxes instead, so that only the parts of
+        each box that are actually accessed are read from disk
+
+        cache is an optional BoxCache through which the boxes are read
         """
         
         if(os.path.exists(self.fdensity) and filter[0]):
            print "loading...",self.fdensity
-           self.density=boxio.readbox(self.fdensity)
+           self.density=self.loadbox(self.fdensity,mmap,cache)
         if(os.path.exists(self.fxH) and filter[1]):
            print "loading...",self.fxH
-           self.xH=boxio.readbox(self.fxH)
+           self.xH=self.loadbox(self.fxH,mmap,cache)
         if(os.path.exists(self.fvx) and filter[2]):
            print "loading...",self.fvx
-           self.vx=boxio.readbox(self.fvx)
+           self.vx=self.loadbox(self.fvx,mmap,cache)
         if(os.path.exists(self.fvy) and filter[3]):
            print "loading...",self.fvy
-           self.vy=boxio.readbox(self.fvy)
+           self.vy=self.loadbox(self.fvy,mmap,cache)
         if(os.path.exists(self.fvz) and filter[4]):
            print "loading...",self.fvz
-           self.vz=boxio.readbox(self.fvz)
+           self.vz=self.loadbox(self.fvz,mmap,cache)
         if(os.path.exists(self.fdeltaT) and filter[5]):
            print "loading...",self.fdeltaT
-           self.deltaT=boxio.readbox(self.fdeltaT)
+           self.deltaT=self.loadbox(self.fdeltaT,mmap,cache)
            
         return
 
@@ -213,8 +251,74 @@ class Slice:
         if isinstance(self.vy,Box):
             vy=self.vy.box_data[pos]
         if isinstance(self.vz,Box):
-            vy=self.vz.box_data[pos]
+            vz=self.vz.box_data[pos]
         if isinstance(self.deltaT,Box):
             deltaT=self.deltaT.box_data[pos]
             
         return (density,xH,vx,vy,vz,deltaT)
+
+    def pixels(self,positions,wrap=True,interp=False):
+        """vectorised version of pixel. From an (N,3) array of positions
+        return a structured array of length N with fields
+        (density,xH,vx,vy,vz,deltaT), one vectorised gather per field
+
+        Boxes that are not loaded give zeros, as for pixel.
+
+        wrap=True maps positions periodically into the box, otherwise
+        positions must lie inside the box (and are clamped to the edge cells
+        when interpolating)
+
+        interp=False takes the value of the cell containing each position
+        (floor of float positions), interp=True trilinearly interpolates
+        between cell values at integer positions
+        """
+        pos=np.atleast_2d(np.asarray(positions))
+        if not pos.shape[1]==3:
+            print "Expect positions to be an (N,3) array"
+            return
+
+        boxes=[self.density,self.xH,self.vx,self.vy,self.vz,self.deltaT]
+        names=self.pixeldtype.names
+        values=np.zeros(len(pos),dtype=self.pixeldtype)
+
+        loaded=[box for box in boxes if isinstance(box,Box)]
+        if not loaded:
+            return values
+        shape=np.array(loaded[0].box_data.shape)
+
+        def cellindex(indx):
+            #map integer indices into the box
+            if wrap:
+                return indx%shape
+            if interp:
+                return np.clip(indx,0,shape-1)
+            return indx
+
+        if not interp:
+            indx=cellindex(np.floor(pos).astype(np.intp))
+            indx=(indx[:,0],indx[:,1],indx[:,2])
+            for (name,box) in zip(names,boxes):
+                if isinstance(box,Box):
+                    values[name]=box.box_data[indx]
+            return values
+
+        #trilinear interpolation from the 8 surrounding cells
+        pos=np.asarray(pos,dtype=np.float64)
+        low=np.floor(pos).astype(np.intp)
+        frac=pos-low
+        corners=[]
+        for (dx,dy,dz) in [(0,0,0),(1,0,0),(0,1,0),(0,0,1),
+                           (1,1,0),(1,0,1),(0,1,1),(1,1,1)]:
+            offset=np.array([dx,dy,dz])
+            indx=cellindex(low+offset)
+            weight=np.prod(np.where(offset,frac,1-frac),axis=1)
+            corners.append(((indx[:,0],indx[:,1],indx[:,2]),weight))
+
+        for (name,box) in zip(names,boxes):
+            if isinstance(box,Box):
+                total=np.zeros(len(pos))
+                for (indx,weight) in corners:
+                    total+=weight*box.box_data[indx]
+                values[name]=total
+
+        return values
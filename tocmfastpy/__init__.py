@@ -15,9 +15,14 @@ from Run import *
 from Box import *
 from PDF import *
 from Slice import *
+from BoxIndex import *
+from BoxMoments import *
 import boxio
+import boxstore
 import boxstats
 import runio
+import fftutils
 #import boxvisuals
 #import box_visual
 import tocmphysics
+import lightcone
@@ -25,10 +25,20 @@ import time
 import commands
 import numpy
 from Box import *
+import boxstore
 
 
-def readbox(filename, quiet=False):
+def readbox(filename, quiet=False, mmap=False):
   #read a 21cmfast output file and return a Box object with data
+  #
+  #with mmap=True the box data is a read-only numpy.memmap onto the file,
+  #so nothing is read from disk until the data is actually touched
+  #
+  #boxstore files (see boxstore.py) are decompressed in full, since they
+  #can't be memory mapped
+
+  if boxstore.is_store(filename):
+    return boxstore.readbox(filename,quiet)
 
   #parse filename to (1) check its a 21cmFast box (2) get box parameters
   # (3) identify what sort of box it is
@@ -38,7 +48,7 @@ def readbox(filename, quiet=False):
 
   #open box and read in data
   dim=param_dict['HIIdim']
-  box_data=open_box(filename,dim)
+  box_data=open_box(filename,dim,mmap=mmap)
   
   #tidy data to ensure its in optimal form i.e. trim padding
   box_data=trim_box(box_data)
@@ -206,24 +216,19 @@ def trim_box(box):
   return new_box
 
 
-def open_box(filename,dim):
-  """Given dimensions of cubic box (dim,dim,dim) storing float data
-  read in that data and return a numpy array of the correct dimensions
-
-  Note- fftw padding convention:   P[x,y,z]= z+2*(D/2+1)*(y+D*x)
-      - fftw no-padding convention P[x,y,z]=z+D*(y+D*x)
-      reshaping must match these conventions
+def box_shape(filename,dim):
+  """Given the expected dimension of a cubic box work out the shape of the
+  data stored in filename from the file size alone. Returns the shape as
+  stored on disk, i.e. including any FFT padding, so that the result can be
+  used to reshape or memory map the raw data before trimming.
   """
 
   size=dim*dim*dim
-  dtype='f'
-  fd=open(filename,'rb')
-  read_data=numpy.fromfile(fd,dtype)
-  fd.close()
-  
-  if not size==len(read_data):
+  nread=os.path.getsize(filename)/numpy.dtype('f').itemsize
+
+  if not size==nread:
     print 'Error: Read box does not match expected size=',dim,'...'
-    size=len(read_data)
+    size=nread
     root3=int(pow(size,1.0/3.0))
     if root3*root3*root3==size:
       print 'but read box is cubic with size=',root3,',so winging it...'
@@ -235,24 +240,78 @@ def open_box(filename,dim):
       print 'but consistent with fftw box with FFT padding'  
       dim=root3
       shape=(dim,dim,2*(dim/2+1))
-      print 'no. elements=',len(read_data), ' and shape=',shape
+      print 'no. elements=',nread, ' and shape=',shape
     else:
       print 'and box is not cubic.  Aborting.'
-      print 'Box was:%d' % len(read_data)
+      print 'Box was:%d' % nread
       print 'Expected length and dim were: %i' % root3
       sys.exit(1)
   else:
       shape=(dim,dim,dim)
 
-  #print filename
-  #print numpy.sum(read_data)/len(read_data)
-  data_box=read_data.reshape(shape)
+  return shape
+
+
+def open_box(filename,dim,mmap=False):
+  """Given dimensions of cubic box (dim,dim,dim) storing float data
+  read in that data and return a numpy array of the correct dimensions
+
+  Note- fftw padding convention:   P[x,y,z]= z+2*(D/2+1)*(y+D*x)
+      - fftw no-padding convention P[x,y,z]=z+D*(y+D*x)
+      reshaping must match these conventions
+
+  If mmap is True the file is not read. Instead a read-only numpy.memmap
+  is returned, which pulls data from disk only as it is accessed. Padded
+  boxes come back as a strided view that skips the padding.
+
+  boxstore files are recognised by their extension and always read in full.
+  """
+
+  if boxstore.is_store(filename):
+    return boxstore.load_store(filename)
+
+  shape=box_shape(filename,dim)
+  dtype='f'
+
+  if mmap:
+    data_box=numpy.memmap(filename,dtype=dtype,mode='r',shape=shape)
+  else:
+    fd=open(filename,'rb')
+    read_data=numpy.fromfile(fd,dtype)
+    fd.close()
+    data_box=read_data.reshape(shape)
 
   data_box=trim_box(data_box)
 
   return data_box
 
 
+def open_region(filename,dim,index):
+  """Read only a sub-volume of a box from disk and return it as a numpy
+  array. index is a numpy index expression into the trimmed (dim,dim,dim)
+  box, so e.g.
+
+      numpy.s_[:,:,10]            a single z plane
+      numpy.s_[10:20]             a slab of x planes
+      numpy.s_[0:64,0:64,0:64]    a sub-cube
+      numpy.s_[::4,::4,::4]       every 4th cell along each axis
+
+  Both the padded and unpadded fftw layouts are handled, since the region
+  is taken from the trimmed memory mapped view of the file. Only the pages
+  containing the requested cells are read. For boxstore files only the
+  compressed chunks overlapping the region are read and decompressed.
+  """
+
+  if boxstore.is_store(filename):
+    return boxstore.load_region(filename,index)
+
+  box_data=open_box(filename,dim,mmap=True)
+  region=numpy.array(box_data[index])
+  del box_data
+
+  return region
+
+
 def save_box(filename, box_data):
   """ Save a numpy box in a binary format"""
 
@@ -9,9 +9,13 @@ on the box itself and its parameters and data
 """
 from Box import *
 from PDF import *
+from Slice import *
+import boxio
+import fftutils
 import numpy as np
 import os
 import math
+import multiprocessing
 import string
 import matplotlib.pyplot as plt
 
@@ -27,84 +31,293 @@ def boxVar(box):
 
 def boxBasics(box):
     """basic statistics of box. Returns (mean,var)"""
-    mean=box.box_data.mean()
-    var=box.box_data.var()
-    return (mean,var)
-
-def boxPDF(box,NBIN=20):
-    """get simple PDF of box as (xmin,xmax,pdf)
-    hack here to ensure all data included in straightforward way
-    bad since slightly distorts uniform distribution"""
-    xmin=box.box_data.min()*0.99999  
-    xmax=box.box_data.max()*1.00001
-
-    delta=(xmax-xmin)/(NBIN)
-    pdf=np.zeros(NBIN)
-    xbin=np.zeros(NBIN)
-
-    data=box.box_data
-    pdfsum=0
-
-    #number of elements which fall in to bin
-    #trying to do this without a loop over the data elements
-    for i in range(NBIN):
-        binlow=i*delta+xmin
-        binhigh=binlow+delta
-        binmid=(binlow+binhigh)/2
-        xbin[i]=binmid
-        #next line a little convoluted and must be better way of
-        #combining the two criterea into one evaluation over box
-        nval=((data>=binlow)*(data<binhigh)).nonzero()[0].size
-        pdfsum+=nval
-        pdf[i]=float(nval)/float(data.size)/delta
-
-    if not pdfsum==data.size:
-        print 'Warning: pdf calculation has double counted elements'
+    moments=box.moments(nmom=2)
+    return (moments.mean(),moments.var())
+
+def boxMoments(box,nmom=4,hrange=None,NBIN=0,step=1):
+    """single pass statistics of box returned as a BoxMoments object
+    holding the mean, central moments up to nmom, min/max and, if a range
+    hrange=(xmin,xmax) is given, an NBIN histogram. step>1 sub-samples
+    every step-th cell along each axis. Works on memory mapped boxes"""
+    return box.moments(nmom,hrange,NBIN,step)
+
+def boxPDF(box,NBIN=20,log=False,xlimits=None,step=1):
+    """get simple PDF of box as a PDF object
+
+    All cells are binned in a single pass over the box in chunks, so memory
+    use is fixed however many bins are used. The range defaults to the
+    (min,max) of the box, with the maximum included in the top bin.
+
+    log=True bins log10 of the positive cells instead, so the PDF is
+    dP/dlog10(x) with xbin holding log10 midpoints. xlimits=(xmin,xmax)
+    fixes the range (in log10 if log=True) and skips the pass to find it.
+    step>1 sub-samples every step-th cell along each axis"""
+
+    if xlimits is None:
+        xmin=np.inf
+        xmax=-np.inf
+        for chunk in box.chunks(step=step):
+            if log:
+                chunk=chunk[chunk>0]
+                if chunk.size==0:
+                    continue
+            xmin=min(xmin,chunk.min())
+            xmax=max(xmax,chunk.max())
+        if log:
+            (xmin,xmax)=(np.log10(xmin),np.log10(xmax))
+        if xmax==xmin:
+            xmax=xmin+1.0
+    else:
+        (xmin,xmax)=xlimits
+    #float limits, as numpy can't subtract the limits of bool boxes
+    (xmin,xmax)=(float(xmin),float(xmax))
+
+    moments=BoxMoments(0,(xmin,xmax),NBIN)
+    ncell=0
+    for chunk in box.chunks(step=step):
+        if log:
+            chunk=np.log10(chunk[chunk>0])
+        ncell+=chunk.size
+        moments.add(chunk)
+
+    pdfsum=moments.hist.sum()
+    if not pdfsum==ncell:
+        print 'Warning: pdf excludes elements outside range'
         print 'counted=',pdfsum
-        print 'expected=',data.size
+        print 'expected=',ncell
 
-    pdfV=PDF()
-    pdfV.set(xmin,xmax,delta,xbin,pdf)
-    #return (xmin,xmax,delta,xbin,pdf,pdfV)
+    pdfV=moments.pdf()
     return pdfV
 
-def boxMinkowski(box):
-    """calculate Minkowksi functionals from box
-
-    This is not straightforward...
+def filePDF(args):
+    """PDF of the box in a file from args=(filename,NBIN,log,xlimits).
+    Worker for runPDF"""
+    (filename,NBIN,log,xlimits)=args
+    box=boxio.readbox(filename,quiet=True,mmap=True)
+    return boxPDF(box,NBIN,log,xlimits)
+
+def runPDF(myrun,boxtype='xh',NBIN=20,log=False,xlimits=None,nworkers=None):
+    """PDFs of one type of box for every Slice of a Run, computed on a pool
+    of nworkers processes (default one per cpu). boxtype is a key of
+    Slice.boxtypedict. Returns a list of PDF objects in the order of
+    myrun.slices, with None for slices without that box"""
+
+    filenames=[slice.filename(boxtype) for slice in myrun.slices]
+    jobs=[(filename,NBIN,log,xlimits) for filename in filenames if filename]
+
+    pool=multiprocessing.Pool(nworkers)
+    try:
+        pdfs=pool.map(filePDF,jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    pdfs.reverse()
+    return [pdfs.pop() if filename else None for filename in filenames]
+
+def boxMinkowski(box,thresholds=None,above=True,periodic=True,nslab=32):
+    """calculate the four Minkowski functionals of the excursion sets of
+    the box for a whole vector of thresholds at once
+
+    The excursion set is {x>=threshold} (or {x<=threshold} if above=False,
+    e.g. ionized regions from an xH box), treated as the union of closed
+    cubic pixels. Each element of that cubical complex (cubes, faces, edges
+    and vertices) is in the set if any pixel it touches is, so each cell is
+    mapped once to the number of thresholds it passes and every element
+    takes the maximum over its pixels. A bincount per element type then
+    gives the number of elements N3,N2,N1,N0 in the set at every threshold
+    with no re-thresholding per level, and
+
+        V0=N3 a^3                  volume
+        V1=(2N2-6N3) a^2/6         surface area/6
+        V2=(3N3-2N2+N1) a/3        integrated mean curvature/(3pi)
+        V3=N0-N1+N2-N3             Euler characteristic
+
+    for pixel size a. The box is processed in slabs of nslab planes, so
+    memory mapped boxes work. periodic=False treats the outside of the box
+    as not in the set.
+
+    Returns (thresholds,V) with V an (nthresholds,4) array of the
+    functionals per unit volume of the box (Mpc^-3,Mpc^-1,Mpc^-2,Mpc^-3).
+    thresholds defaults to 50 values spanning the range of the box.
     """
-    mink=1
-    return mink
 
+    data=box.box_data
+    shape=data.shape
+    if thresholds is None:
+        moments=box.moments(nmom=0)
+        thresholds=np.linspace(moments.xmin,moments.xmax,50)
+    thresholds=np.atleast_1d(np.asarray(thresholds,dtype=np.float64))
+    nthresh=len(thresholds)
+
+    #work with sorted thresholds on the set {sign*x>=sign*threshold}
+    sign=1.0 if above else -1.0
+    order=np.argsort(sign*thresholds)
+    levels=(sign*thresholds)[order]
+    qtype=np.uint16 if nthresh<65535 else np.int32
+
+    #outside of a non-periodic box is an extra empty plane on the high side
+    #of each axis, which the periodic wrap also places below the box
+    pad=0 if periodic else 1
+    nx=shape[0]+pad
+
+    def rank(i0,i1):
+        #number of thresholds passed by each cell in planes i0..i1-1 (mod nx)
+        planes=np.arange(i0,i1)%nx
+        q=np.zeros((len(planes),shape[1]+pad,shape[2]+pad),dtype=qtype)
+        inbox=planes<shape[0]
+        if inbox.any():
+            values=sign*np.asarray(data[planes[inbox]],dtype=np.float64)
+            q[inbox,:shape[1],:shape[2]]=np.searchsorted(levels,values,side='right')
+        return q
+
+    def up(q,axis):
+        #maximum of each cell with its periodic neighbour above along axis
+        out=np.empty_like(q)
+        lo=[slice(None)]*3
+        hi=[slice(None)]*3
+        lo[axis]=slice(0,-1)
+        hi[axis]=slice(1,None)
+        np.maximum(q[tuple(lo)],q[tuple(hi)],out=out[tuple(lo)])
+        lo[axis]=slice(-1,None)
+        hi[axis]=slice(0,1)
+        np.maximum(q[tuple(lo)],q[tuple(hi)],out=out[tuple(lo)])
+        return out
+
+    def count(q):
+        #number of elements in the set at each threshold
+        hist=np.bincount(q.ravel(),minlength=nthresh+1)
+        return np.cumsum(hist[::-1])[::-1][1:]
+
+    N=np.zeros((4,nthresh))
+    for i0 in range(0,nx,nslab):
+        i1=min(i0+nslab,nx)
+        q=rank(i0,i1+1)
+        cube=q[:-1]
+        facex=np.maximum(q[:-1],q[1:])
+        facey=up(cube,1)
+        facez=up(cube,2)
+        edgez=up(facex,1)
+        N[3]+=count(cube)
+        N[2]+=count(facex)+count(facey)+count(facez)
+        N[1]+=count(edgez)+count(up(facex,2))+count(up(facey,2))
+        N[0]+=count(up(edgez,2))
+
+    a=box.param_dict['BoxSize']/float(box.dim)
+    volume=(a*shape[0])*(a*shape[1])*(a*shape[2])
+    V=np.zeros((nthresh,4))
+    V[order,0]=N[3]*a**3
+    V[order,1]=(2*N[2]-6*N[3])*a**2/6.0
+    V[order,2]=(3*N[3]-2*N[2]+N[1])*a/3.0
+    V[order,3]=N[0]-N[1]+N[2]-N[3]
+
+    return thresholds,V/volume
 
 def drawSkewer(box,startpos,direction,length):
+    """Values of the box along a single skewer, taking the value of the
+    pixel at each unit step along the path. See drawSkewers"""
+    startpos=np.asarray(startpos,dtype=np.float64)
+    direction=np.asarray(direction,dtype=np.float64)
+    skewer=drawSkewers(box,startpos[np.newaxis,:],direction[np.newaxis,:],length)
 
-    #find positions of skewer
-    skewerpos=findSkewer(box,startpos,direction,length)
-    skewer=np.zeros(len(skewerpos))
-    
-    #recover value of box at pixel positions along skewer
-    for i in range(len(skewerpos)):
-        skewer[i]=box.box_data[(skewerpos[i,0],skewerpos[i,1],skewerpos[i,2])]
-
-    return skewer
+    return skewer[0]
 
 def drawCleverSkewer(box,startpos,direction,length):
+    """Values of the box along a single skewer, with each element the
+    average of the box along that unit length of path weighted by the path
+    length within each pixel crossed. See drawSkewers"""
+    startpos=np.asarray(startpos,dtype=np.float64)
+    direction=np.asarray(direction,dtype=np.float64)
+    skewer=drawSkewers(box,startpos[np.newaxis,:],direction[np.newaxis,:],length,
+                       weighted=True)
+
+    return skewer[0]
+
+def drawSkewers(box,startpos,directions,length,weighted=False,nbatch=4096):
+    """Draw many 1D skewers through the box at once and return an
+    (Nskewers,length) array of box values along them
+
+    startpos=(N,3) array of initial positions in pixels
+    directions=(N,3) array of direction vectors (or a single (3,) vector
+               shared by all skewers), normalised internally
+    length: length of the skewers in pixels
+
+    Paths wrap periodically through the box.
+
+    weighted=False takes the value of the pixel containing the start of
+    each unit step along the path, as findSkewer.
+    weighted=True gives each element the average of the box over that
+    unit length of path, weighted by the exact path length within each
+    pixel crossed (voxel traversal). Skewers are processed nbatch at a time
+    to bound memory.
+    """
 
-    #find positions of skewer
-    skewerpos=findSkewer(box,startpos,direction,length)
-    skewer=np.zeros(len(skewerpos))
-    
-    #recover value of box at pixel positions along skewer
-    for i in range(len(skewerpos)):
-        #consider each segment and work out which cells it intersects
-
-        #sum the contributions to get the average element along the skewer
-        skewer[i]=box.box_data[(skewerpos[i,0],skewerpos[i,1],skewerpos[i,2])]
-
-
+    data=box.box_data
+    dim=np.array(data.shape)
+    length=int(length)
+
+    startpos=np.atleast_2d(np.asarray(startpos,dtype=np.float64))
+    directions=np.asarray(directions,dtype=np.float64)
+    directions=np.atleast_2d(directions)*np.ones_like(startpos)
+    norm=np.sqrt((directions*directions).sum(axis=1))
+    directions=directions/norm[:,np.newaxis]  #ensure directions are unit vectors
+    startpos=startpos%dim #use periodic condition to map into box
 
-    return skewer
+    nskewer=len(startpos)
+    skewers=np.zeros((nskewer,length))
+    steps=np.arange(length,dtype=np.float64)
+
+    for first in range(0,nskewer,nbatch):
+        start=startpos[first:first+nbatch]
+        direction=directions[first:first+nbatch]
+        nb=len(start)
+
+        if not weighted:
+            cells=[(np.floor(steps[np.newaxis,:]*direction[:,i,np.newaxis]+
+                             start[:,i,np.newaxis])%dim[i]).astype(np.intp)
+                   for i in range(3)]
+            skewers[first:first+nb]=data[cells[0],cells[1],cells[2]]
+            continue
+
+        #path parameters t at which the skewer crosses a pixel boundary
+        #along each axis, together with the unit step boundaries. Crossings
+        #beyond the end of the skewer are clipped to zero length segments
+        bounds=[np.tile(np.arange(length+1,dtype=np.float64),(nb,1))]
+        for i in range(3):
+            speed=np.abs(direction[:,i])
+            ncross=int(length*speed.max())+2
+            k=np.arange(ncross,dtype=np.float64)
+            offset=np.where(direction[:,i]>0,np.ceil(start[:,i])-start[:,i],
+                            start[:,i]-np.floor(start[:,i]))
+            olderr=np.seterr(divide='ignore',invalid='ignore')
+            t=(offset[:,np.newaxis]+k[np.newaxis,:])/speed[:,np.newaxis]
+            t[~(t<=length)]=length
+            np.seterr(**olderr)
+            bounds.append(t)
+        bounds=np.sort(np.concatenate(bounds,axis=1),axis=1)
+
+        #each segment between boundaries lies within one pixel, so find the
+        #pixel from the segment midpoint, dropping zero length segments
+        seglen=bounds[:,1:]-bounds[:,:-1]
+        (row,col)=np.nonzero(seglen>0)
+        seglen=seglen[row,col]
+        mid=bounds[row,col]+0.5*seglen
+        cells=[]
+        for i in range(3):
+            cell=np.floor(mid*direction[row,i]+start[row,i]).astype(np.intp)
+            cell%=dim[i]
+            cells.append(cell)
+        if data.flags.c_contiguous:
+            values=np.take(data,np.ravel_multi_index(cells,dim))
+        else:
+            #strided (e.g. trimmed memory mapped) boxes are indexed in place
+            values=data[cells[0],cells[1],cells[2]]
+        step=np.minimum(mid.astype(np.intp),length-1)
+        weights=seglen*values
+        skewers[first:first+nb]=np.bincount(row*length+step,weights=weights,
+                                            minlength=nb*length).reshape((nb,length))
+
+    return skewers
 
 def findSkewer(box,startpos,direction,length):
     """Draw a 1D skewer through the box and return an appropriately
@@ -236,3 +449,169 @@ def conditionalPDF(boxX,boxY,Nbins=20,xlimits=None,ylimits=None,normed=True):
     histYcX=(histXY.T/histX).T    
     
     return binsX,binsY,histX,histY,histXY,histXcY,histYcX
+
+def runConditionalPDF(myrun,boxtypeX='density',boxtypeY='xh',Nbins=20,
+                      xlimits=None,ylimits=None,normed=True):
+    """ joint and conditional PDFs of two box types for every Slice of a Run
+
+    Slices are streamed from memory mapped boxes in chunks, so only a
+    chunk of each pair of boxes is in memory at a time. All redshifts share
+    the same bin edges, taken from xlimits/ylimits or otherwise from the
+    (min,max) over the whole Run. Each chunk is binned with a single
+    bincount of the linear index of the (X,Y) bin.
+
+    Returns (redshifts,binsX,binsY,histX,histY,histXY,histXcY,histYcX) with
+    the histograms stacked along a leading redshift axis, so that e.g.
+    histXY has shape (nz,Nbins,Nbins), and each redshift agrees with
+    conditionalPDF on that pair of boxes. As there, histX and histY are
+    binned separately rather than being marginals of histXY, so cells
+    outside the limits of the other variable still count. Slices without
+    both boxes are skipped, and a Run with none gives empty arrays.
+    """
+
+    pairs=[]
+    redshifts=[]
+    for (z,slice) in zip(myrun.redshifts,myrun.slices):
+        (fX,fY)=(slice.filename(boxtypeX),slice.filename(boxtypeY))
+        if fX and fY:
+            pairs.append((boxio.readbox(fX,quiet=True,mmap=True),
+                          boxio.readbox(fY,quiet=True,mmap=True)))
+            redshifts.append(z)
+    if not pairs:
+        print 'No slices with both',boxtypeX,'and',boxtypeY,'boxes'
+        return (redshifts,np.array([]),np.array([]),np.zeros((0,Nbins)),np.zeros((0,Nbins)),
+                np.zeros((0,Nbins,Nbins)),np.zeros((0,Nbins,Nbins)),np.zeros((0,Nbins,Nbins)))
+
+    #shared bin edges across all redshifts, finding the missing limits in a
+    #single pass over the chunks of each box
+    limits=[xlimits,ylimits]
+    missing=[axis for axis in range(2) if limits[axis] is None]
+    vmin=[np.inf,np.inf]
+    vmax=[-np.inf,-np.inf]
+    for pair in pairs:
+        for chunks in zip(*[pair[axis].chunks() for axis in missing]):
+            for (axis,chunk) in zip(missing,chunks):
+                vmin[axis]=min(vmin[axis],chunk.min())
+                vmax[axis]=max(vmax[axis],chunk.max())
+    for axis in missing:
+        if vmax[axis]==vmin[axis]:
+            vmax[axis]=vmin[axis]+1.0
+        limits[axis]=(float(vmin[axis]),float(vmax[axis]))
+    ((xmin,xmax),(ymin,ymax))=limits
+    binsX=np.linspace(xmin,xmax,Nbins+1)
+    binsY=np.linspace(ymin,ymax,Nbins+1)
+
+    histXY=np.zeros((len(pairs),Nbins,Nbins))
+    histX=np.zeros((len(pairs),Nbins))
+    histY=np.zeros((len(pairs),Nbins))
+    for (n,(boxX,boxY)) in enumerate(pairs):
+        counts=np.zeros(Nbins*Nbins,dtype=np.int64)
+        for (chunkX,chunkY) in zip(boxX.chunks(),boxY.chunks()):
+            ix=binindex(np.asarray(chunkX,dtype=np.float64).ravel(),xmin,xmax,Nbins)
+            iy=binindex(np.asarray(chunkY,dtype=np.float64).ravel(),ymin,ymax,Nbins)
+            inside=(ix>=0)&(iy>=0)
+            counts+=np.bincount(ix[inside]*Nbins+iy[inside],minlength=Nbins*Nbins)
+            histX[n]+=np.bincount(ix[ix>=0],minlength=Nbins)
+            histY[n]+=np.bincount(iy[iy>=0],minlength=Nbins)
+        histXY[n]=counts.reshape((Nbins,Nbins))
+
+    olderr=np.seterr(divide='ignore',invalid='ignore')
+    if normed:
+        dx=binsX[1]-binsX[0]
+        dy=binsY[1]-binsY[0]
+        histX=histX/histX.sum(axis=1)[:,np.newaxis]/dx
+        histY=histY/histY.sum(axis=1)[:,np.newaxis]/dy
+        histXY=histXY/histXY.sum(axis=(1,2))[:,np.newaxis,np.newaxis]/dx/dy
+
+    #p(X|Y)=p(X,Y)/p(Y) and p(Y|X)=p(X,Y)/p(X)
+    histXcY=histXY/histY[:,np.newaxis,:]
+    histYcX=histXY/histX[:,:,np.newaxis]
+    np.seterr(**olderr)
+
+    return redshifts,binsX,binsY,histX,histY,histXY,histXcY,histYcX
+
+###########################################################################
+# Power spectra
+###########################################################################
+def binSpectrum(power,dim,BoxSize,nbins=20,log=True):
+    """spherically average a power spectrum held on the (dim,dim,dim/2+1)
+    half spectrum grid into nbins bins of |k| between the fundamental mode
+    and the corner of the box, using the cached bins of fftutils.kBins. The
+    k=0 mode is excluded. Returns (k,P,nmodes) with k the mode weighted mean
+    |k| of each bin"""
+    (indx,k,nmodes)=fftutils.kBins(dim,BoxSize,nbins,log)
+    weights=fftutils.halfWeights(dim)
+
+    #weighted bincounts a block of rows at a time to bound the temporaries
+    psum=np.zeros(nbins+1)
+    step=fftutils.blockRows(dim)
+    for i in range(0,dim,step):
+        wpower=np.multiply(power[i:i+step],weights,dtype=np.float64)
+        psum+=np.bincount(indx[i:i+step].ravel(),weights=wpower.ravel(),minlength=nbins+1)
+
+    olderr=np.seterr(divide='ignore',invalid='ignore')
+    P=psum[:nbins]/nmodes
+    np.seterr(**olderr)
+
+    return k,P,nmodes
+
+def boxCrossSpectrum(boxA,boxB,nbins=20,log=True,threads=None):
+    """spherically averaged cross power spectrum of two boxes e.g.
+    density and xH, from real-to-complex FFTs using threads FFT threads.
+    Normalised so that P(k) is in Mpc^3 for a box of side BoxSize Mpc,
+    i.e. <A_k B_k*>=V P(k) delta_kk'. Returns (k,P,nmodes)"""
+    dim=boxA.dim
+    BoxSize=boxA.param_dict['BoxSize']
+    norm=float(BoxSize)**3/float(dim)**6
+
+    fourierA=fftutils.rfftn(np.asarray(boxA.box_data,dtype=np.float32),threads)
+    if boxB is boxA:
+        power=fourierA.real**2+fourierA.imag**2
+    else:
+        fourierB=fftutils.rfftn(np.asarray(boxB.box_data,dtype=np.float32),threads)
+        power=fourierA.real*fourierB.real+fourierA.imag*fourierB.imag
+        del fourierB
+    del fourierA
+    power*=norm
+
+    return binSpectrum(power,dim,BoxSize,nbins,log)
+
+def boxPowerSpectrum(box,nbins=20,log=True,threads=None):
+    """spherically averaged power spectrum of a box in Mpc^3, from a
+    real-to-complex FFT using threads FFT threads (all cpus by default,
+    if pyfftw is available). Returns (k,P,nmodes). The dimensionless
+    power is k**3*P/(2*pi**2)"""
+    return boxCrossSpectrum(box,box,nbins,log,threads)
+
+def runPowerSpectrum(myrun,boxtype='deltaT',boxtypeB=None,nbins=20,log=True,
+                     threads=None):
+    """power spectrum of one box type (or cross spectrum with boxtypeB) for
+    every Slice of a Run. Slices are read through the Run's BoxCache so the
+    next slice is read while the current one is transformed. Returns
+    (redshifts,k,P,nmodes) with k and P stacked as (nz,nbins) and nmodes
+    that of the bins shared by every slice, zero if no slice has the boxes.
+    Slices without the boxes are skipped"""
+    labels=[boxtype]
+    if boxtypeB is not None:
+        labels.append(boxtypeB)
+    filter=[False]*6
+    for label in labels:
+        filter[Slice.boxtypedict[label]]=True
+
+    redshifts=[]
+    kall=[]
+    Pall=[]
+    nmodes=np.zeros(nbins)
+    for (z,slice) in myrun.iterslices(filter):
+        boxA=slice.box(boxtype)
+        boxB=boxA
+        if boxtypeB is not None:
+            boxB=slice.box(boxtypeB)
+        if not (isinstance(boxA,Box) and isinstance(boxB,Box)):
+            continue
+        (k,P,nmodes)=boxCrossSpectrum(boxA,boxB,nbins,log,threads)
+        redshifts.append(z)
+        kall.append(k)
+        Pall.append(P)
+
+    return redshifts,np.array(kall),np.array(Pall),nmodes
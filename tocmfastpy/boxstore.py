@@ -0,0 +1,367 @@
+#!/usr/bin/python
+"""
+Chunked, compressed container format for 21cmFast boxes and derived arrays
+
+A store file holds one or more named arrays, each cut into a regular grid
+of chunks that are compressed independently with zlib. Raw 21cmFast boxes
+are held under the name 'box'. Floating point chunks are byte shuffled
+before compression, grouping the bytes of each value by significance,
+which compresses much better than the raw floats. A JSON header records
+the box param_dict, any scalar attributes and the shape, dtype and chunk
+offset table of every array.
+
+A region is read by decompressing only the chunks it overlaps, so a slab or
+plane of a box costs a fraction of reading the whole thing. Chunks are
+compressed and decompressed on a thread pool (zlib releases the GIL).
+
+File layout:
+    8 bytes    magic 'TCMBOX01'
+    8 bytes    little-endian uint64 offset of the JSON header
+    ...        compressed chunks
+    ...        JSON header
+
+boxio.readbox, open_box and open_region recognise store files by their
+extension, so converted directories can be used in place of the originals.
+
+EXAMPLE USAGE:
+     boxstore.save_store('xH.tcb',box.box_data,box.param_dict)
+     plane=boxstore.load_region('xH.tcb',numpy.s_[:,:,100])
+     boxstore.convert_directory('../21cmFAST/Boxes/','../21cmFAST/Store/')
+     boxstore.convert_npz('NPZ/dwatershed_z10.0_L143_Iter0.npz')
+
+"""
+
+import os
+import sys
+import json
+import zlib
+import struct
+import fnmatch
+import tempfile
+import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy
+from Box import *
+import boxio
+
+EXTENSION='.tcb'
+MAGIC='TCMBOX01'
+
+
+def is_store(filename):
+  """True if filename names a store file"""
+  return filename.endswith(EXTENSION)
+
+
+def nworkers(workers=None):
+  """number of compression threads to use, defaulting to one per cpu"""
+  if workers is None:
+    workers=multiprocessing.cpu_count()
+  return workers
+
+
+def chunk_shape(shape,chunks):
+  """chunk shape for an array of the given shape, chunks being the chunk
+  length along every axis or a tuple of lengths per axis"""
+  if numpy.isscalar(chunks):
+    chunks=(chunks,)*len(shape)
+  return tuple(max(1,min(int(c),n)) for (c,n) in zip(chunks,shape))
+
+
+def chunk_grid(shape,chunks):
+  """number of chunks along each axis"""
+  return tuple((n+c-1)//c for (n,c) in zip(shape,chunks))
+
+
+def chunk_slices(cindex,shape,chunks):
+  """index expression of chunk cindex within the full array"""
+  return tuple(slice(i*c,min((i+1)*c,n)) for (i,c,n) in zip(cindex,chunks,shape))
+
+
+def encode_chunk(data,chunks,shuffle,level,cindex):
+  """compress one chunk of data, byte shuffling it first if asked"""
+  chunk=numpy.ascontiguousarray(data[chunk_slices(cindex,data.shape,chunks)])
+  itemsize=chunk.dtype.itemsize
+  if shuffle and itemsize>1:
+    buf=chunk.view(numpy.uint8).reshape(-1,itemsize).T.tostring()
+  else:
+    buf=chunk.tostring()
+  return zlib.compress(buf,level)
+
+
+def decode_chunk(buf,dtype,shape,shuffle):
+  """decompress one chunk back into an array of the given shape"""
+  raw=zlib.decompress(buf)
+  dtype=numpy.dtype(dtype)
+  if shuffle and dtype.itemsize>1:
+    planes=numpy.frombuffer(raw,numpy.uint8).reshape(dtype.itemsize,-1)
+    return planes.T.copy().view(dtype).reshape(shape)
+  return numpy.frombuffer(raw,dtype).reshape(shape).copy()
+
+
+def plain(obj):
+  """convert numpy scalars/arrays and the unicode strings json hands back
+  into plain python objects so they behave like parse_filename output"""
+  if isinstance(obj,dict):
+    return dict((plain(k),plain(v)) for (k,v) in obj.items())
+  if isinstance(obj,(list,tuple)):
+    return [plain(v) for v in obj]
+  if isinstance(obj,unicode):
+    return str(obj)
+  if isinstance(obj,(numpy.ndarray,numpy.generic)):
+    return obj.tolist()
+  return obj
+
+
+def save_store(filename,arrays,param_dict=None,attrs=None,chunks=64,
+               shuffle=True,level=6,workers=None):
+  """Write arrays to a store file
+
+  arrays is either a single array, stored as 'box', or a mapping of names
+  to arrays (a dict or an open npz file). Members are fetched one at a
+  time, and zero dimensional members are kept as scalar attributes. chunks
+  is the chunk length along each axis. Chunks are taken from the array
+  as they are compressed, so a memory mapped box is streamed from disk.
+
+  The store is written to a temporary file in the same directory that is
+  renamed to filename once complete, so filename is never left truncated.
+  On error the temporary file is removed and the error raised.
+  """
+  if not hasattr(arrays,'keys'):
+    arrays={'box':arrays}
+  header={'param_dict':plain(param_dict or {}),'attrs':plain(attrs or {}),
+          'shuffle':bool(shuffle),'arrays':{}}
+
+  (dirname,fname)=os.path.split(os.path.abspath(filename))
+  (handle,tmpname)=tempfile.mkstemp(prefix='.'+fname,suffix='.tmp',dir=dirname)
+  fd=os.fdopen(handle,'wb')
+  pool=ThreadPool(nworkers(workers))
+  try:
+    fd.write(MAGIC+struct.pack('<Q',0))
+    for name in sorted(arrays.keys()):
+      data=numpy.asanyarray(arrays[name])
+      if data.ndim==0:
+        header['attrs'][name]=plain(data)
+        continue
+
+      chunks_a=chunk_shape(data.shape,chunks)
+      cindices=list(numpy.ndindex(*chunk_grid(data.shape,chunks_a)))
+      encode=functools.partial(encode_chunk,data,chunks_a,shuffle,level)
+      offsets=[]
+      sizes=[]
+      for buf in pool.imap(encode,cindices):
+        offsets.append(fd.tell())
+        sizes.append(len(buf))
+        fd.write(buf)
+      header['arrays'][name]={'shape':list(data.shape),'dtype':data.dtype.str,
+                              'chunks':list(chunks_a),'offsets':offsets,'sizes':sizes}
+
+    hoffset=fd.tell()
+    fd.write(json.dumps(header))
+    fd.seek(len(MAGIC))
+    fd.write(struct.pack('<Q',hoffset))
+    fd.close()
+    #mkstemp files are private, so give the store the usual permissions
+    umask=os.umask(0)
+    os.umask(umask)
+    os.chmod(tmpname,0666&~umask)
+    os.rename(tmpname,filename)
+  except:
+    fd.close()
+    os.remove(tmpname)
+    raise
+  finally:
+    pool.close()
+
+  return
+
+
+def read_header(filename):
+  """read the JSON header of a store file"""
+  fd=open(filename,'rb')
+  magic=fd.read(len(MAGIC))
+  if not magic==MAGIC:
+    print 'Error:',filename,'is not a tocmfastpy box store'
+    fd.close()
+    sys.exit(1)
+  (hoffset,)=struct.unpack('<Q',fd.read(8))
+  fd.seek(hoffset)
+  header=plain(json.loads(fd.read()))
+  fd.close()
+
+  return header
+
+
+def read_chunks(filename,header,name,cindices,workers=None):
+  """decompress chunks cindices of array name, returning {cindex: chunk}.
+  Compressed chunks are read in file order, then decompressed in parallel"""
+  info=header['arrays'][name]
+  shape=info['shape']
+  chunks=info['chunks']
+  grid=chunk_grid(shape,chunks)
+
+  jobs=[]
+  fd=open(filename,'rb')
+  for cindex in sorted(cindices,key=lambda c:numpy.ravel_multi_index(c,grid)):
+    n=numpy.ravel_multi_index(cindex,grid)
+    fd.seek(info['offsets'][n])
+    cshape=tuple(s.stop-s.start for s in chunk_slices(cindex,shape,chunks))
+    jobs.append((cindex,fd.read(info['sizes'][n]),cshape))
+  fd.close()
+
+  decode=lambda job: decode_chunk(job[1],info['dtype'],job[2],header['shuffle'])
+  if len(jobs)>1 and nworkers(workers)>1:
+    pool=ThreadPool(min(len(jobs),nworkers(workers)))
+    decoded=pool.map(decode,jobs)
+    pool.close()
+  else:
+    decoded=map(decode,jobs)
+
+  return dict((job[0],chunk) for (job,chunk) in zip(jobs,decoded))
+
+
+def region_bounds(index,shape):
+  """Split a numpy index expression into the bounding box [lo,hi) of the
+  cells it touches along each axis and the equivalent index relative to
+  that box. Axes indexed by anything other than an integer or slice are
+  read in full and indexed afterwards"""
+  if not isinstance(index,tuple):
+    index=(index,)
+  ellipsis=[i for (i,entry) in enumerate(index) if entry is Ellipsis]
+  if ellipsis:
+    i=ellipsis[0]
+    index=index[:i]+(slice(None),)*(len(shape)-len(index)+1)+index[i+1:]
+  index=index+(slice(None),)*(len(shape)-len(index))
+
+  bounds=[]
+  relindex=[]
+  for (entry,n) in zip(index,shape):
+    if isinstance(entry,(int,long,numpy.integer)):
+      i=int(entry)+n if entry<0 else int(entry)
+      bounds.append((i,i+1))
+      relindex.append(0)
+    elif isinstance(entry,slice):
+      (start,stop,step)=entry.indices(n)
+      count=len(xrange(start,stop,step))
+      if count==0:
+        bounds.append((0,0))
+        relindex.append(slice(0,0))
+      elif step>0:
+        last=start+(count-1)*step
+        bounds.append((start,last+1))
+        relindex.append(slice(0,last-start+1,step))
+      else:
+        last=start+(count-1)*step
+        bounds.append((last,start+1))
+        relindex.append(slice(start-last,None,step))
+    else:
+      bounds.append((0,n))
+      relindex.append(entry)
+
+  return (bounds,tuple(relindex))
+
+
+def load_region(filename,index=Ellipsis,name='box',workers=None):
+  """Read only a sub-volume of an array in a store file, with index a numpy
+  index expression as for boxio.open_region. Only the chunks overlapping
+  the requested cells are decompressed"""
+  header=read_header(filename)
+  info=header['arrays'][name]
+  shape=info['shape']
+  chunks=info['chunks']
+
+  (bounds,relindex)=region_bounds(index,shape)
+  region=numpy.empty([hi-lo for (lo,hi) in bounds],dtype=numpy.dtype(info['dtype']))
+  if region.size>0:
+    ranges=[xrange(lo//c,(hi-1)//c+1) for ((lo,hi),c) in zip(bounds,chunks)]
+    cindices=list(numpy.ndindex(*[len(r) for r in ranges]))
+    cindices=[tuple(r[i] for (r,i) in zip(ranges,c)) for c in cindices]
+    decoded=read_chunks(filename,header,name,cindices,workers)
+
+    for cindex in cindices:
+      csl=chunk_slices(cindex,shape,chunks)
+      #overlap of the chunk and the bounding box in full array coordinates
+      lows=[max(s.start,lo) for (s,(lo,hi)) in zip(csl,bounds)]
+      highs=[min(s.stop,hi) for (s,(lo,hi)) in zip(csl,bounds)]
+      dst=tuple(slice(l-lo,h-lo) for (l,h,(lo,hi)) in zip(lows,highs,bounds))
+      src=tuple(slice(l-s.start,h-s.start) for (l,h,s) in zip(lows,highs,csl))
+      region[dst]=decoded[cindex][src]
+
+  return region[relindex]
+
+
+def load_store(filename,name='box',workers=None):
+  """read a whole array from a store file"""
+  return load_region(filename,Ellipsis,name,workers)
+
+
+def readbox(filename,quiet=False):
+  """read a 21cmFast box from a store file and return a Box object"""
+  header=read_header(filename)
+  param_dict=header['param_dict']
+  (base,fname)=os.path.split(filename)
+  param_dict['filename']=fname
+  param_dict['basedir']=base
+  if not quiet:
+    print param_dict
+
+  box=Box()
+  box.setBox(load_store(filename),param_dict)
+  return box
+
+
+def is_raw_box(filename,dim):
+  """True if filename holds a raw box of dim cells per side, padded or not"""
+  nread=os.path.getsize(filename)/numpy.dtype('f').itemsize
+  return nread in (dim*dim*dim,dim*dim*2*(dim/2+1))
+
+
+def convert_directory(base,outdir,pattern='*',chunks=64,shuffle=True,
+                      level=6,workers=None,overwrite=False):
+  """Convert every 21cmFast box in directory base whose name matches
+  pattern into a store file in outdir, named after the original plus
+  EXTENSION so that parse_filename still works on it. outdir must differ
+  from base, since a directory holding both formats would match each box
+  twice when runs are assembled from it. Up to date store files are
+  skipped unless overwrite is set. Returns the list of store files written"""
+  import BoxIndex
+  if os.path.realpath(outdir)==os.path.realpath(base):
+    raise ValueError('store files must be written to a directory other than %s' % base)
+  if not os.path.isdir(outdir):
+    os.makedirs(outdir)
+
+  index=BoxIndex.BoxIndex(base)
+  written=[]
+  for path in index.filenames():
+    (dirname,fname)=os.path.split(path)
+    param_dict=index.param_dict(path)
+    if is_store(fname) or not fnmatch.fnmatch(fname,pattern):
+      continue
+    if 'HIIdim' not in param_dict or not is_raw_box(path,param_dict['HIIdim']):
+      continue
+
+    outfile=os.path.join(outdir,fname+EXTENSION)
+    if not overwrite and os.path.exists(outfile) and os.path.getmtime(outfile)>=os.path.getmtime(path):
+      continue
+
+    box_data=boxio.open_box(path,param_dict['HIIdim'],mmap=True)
+    save_store(outfile,box_data,param_dict,chunks=chunks,shuffle=shuffle,
+               level=level,workers=workers)
+    del box_data
+    print fname,' compression=',os.path.getsize(path)/float(os.path.getsize(outfile))
+    written.append(outfile)
+
+  return written
+
+
+def convert_npz(filename,outfile=None,chunks=64,shuffle=True,level=6,workers=None):
+  """Convert an npz archive (e.g. watershed output) into a store file,
+  one array per key with scalar members kept as attributes. Members are
+  loaded and compressed one at a time. Returns the store filename"""
+  if outfile is None:
+    outfile=os.path.splitext(filename)[0]+EXTENSION
+  npz=numpy.load(filename)
+  save_store(outfile,npz,chunks=chunks,shuffle=shuffle,level=level,workers=workers)
+  npz.close()
+  return outfile
@@ -10,6 +10,7 @@ regions
 """
 
 mayaviflag=True
+imageioflag=True
 
 import os
 import re
@@ -27,12 +28,22 @@ except:
   print "mayavi module not available, so disabling 3D plotting"
   mayaviflag=False
   
+try:
+  import imageio
+except ImportError:
+  print "imageio module not available, so using ffmpeg for GIFs"
+  imageioflag=False
+
 import time
 import commands
+import subprocess
+import collections
+import multiprocessing
 import numpy
 import Image
 import Box
 import Run
+import boxio
 from matplotlib import mpl,pyplot
 
 def lutForTBMap():
@@ -95,31 +106,127 @@ def show_slice(box,indx,boxtype):
   
   return img
 
-def movie(myrun,boxtype):
-  """ Make a movie from a Run object. This makes individual frames as png
-  files and then uses an external call to ffmpeg to make a mov file that
-  combines the individual frames.
-
-  TO DO: options for colour map, selecting which 21cmFast box to use, and
-  which index position to use
+def movie(myrun,boxtype,outfile='./anim.mov',indx=0,fps=5,nworkers=None):
+  """ Make a movie from a Run object. Frames are rendered straight to RGB
+  arrays in parallel worker processes and streamed to the movie writer, so
+  no png files are made and memory use does not grow with the number of
+  frames. Use makeframes() and makemovie() to keep the individual frames.
 
   Parameters:
   boxtype - determine which of the six available boxes to use
   0:density 1:xH 2:vx 3:vy 4:vz 5:deltaT
   currently handles boxtype<1: xH otherwise deltaT
-  
+  outfile - movie file to write. A .gif extension makes an animated GIF
+  indx - index of the plane through the box shown in each frame
+  fps - frame rate in frames/second
+  nworkers - number of rendering processes, defaulting to one per cpu
   """
 
-  makeframes(myrun,boxtype)
-  makemovie()
+  frames=renderframes(myrun,boxtype,indx,nworkers)
+  writemovie(frames,outfile,fps)
+  return
+
+
+def framefiles(myrun,boxtype):
+  """ list the box files used for the frames of a movie, running through
+  the slices of a Run from high-redshift to low"""
+  filenames=[]
+  for j in range(1,len(myrun.slices)):
+    i=len(myrun.slices)-j
+    if boxtype==0:
+      filenames.append(myrun.slices[i].fdensity)
+    elif boxtype==1:
+      filenames.append(myrun.slices[i].fxH)
+    else:
+      filenames.append(myrun.slices[i].fdeltaT)
+  return filenames
+
+
+def renderplane(args):
+  """ read plane indx of a box file and colour it with the colourmap for
+  boxtype, returning an RGB uint8 array of shape (dim,dim,3). Used as the
+  worker function of renderframes, so takes a single (filename,boxtype,indx)
+  tuple"""
+  (filename,boxtype,indx)=args
+  dim=boxio.parse_filename(filename)['HIIdim']
+  slice_data=boxio.open_region(filename,dim,numpy.s_[:,indx,:])
+  if boxtype==0:
+    slice_data=slice_data+1 #delta+1
+
+  (cmap,norm)=getColourMap(boxtype)
+  if norm is None:
+    #autoscale each frame, as imshow does
+    norm=mpl.colors.Normalize(vmin=slice_data.min(),vmax=slice_data.max())
+  rgba=cmap(norm(slice_data),bytes=True)
+  return numpy.ascontiguousarray(rgba[:,:,:3])
+
+
+def renderframes(myrun,boxtype,indx=0,nworkers=None):
+  """ generator of RGB frames for a movie of a Run object, rendered in
+  order by a pool of worker processes. At most 2*nworkers frames are
+  rendering or waiting to be consumed at any time, so workers pause when
+  the movie writer falls behind rather than piling up frames"""
+  if nworkers is None:
+    nworkers=multiprocessing.cpu_count()
+  jobs=[(filename,boxtype,indx) for filename in framefiles(myrun,boxtype)]
+
+  pool=multiprocessing.Pool(nworkers)
+  pending=collections.deque()
+  try:
+    for job in jobs:
+      pending.append(pool.apply_async(renderplane,(job,)))
+      if len(pending)>=2*nworkers:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    pool.terminate()
+  return
+
+
+def writemovie(frames,outfile='./anim.mov',fps=5):
+  """ write an iterable of RGB uint8 frames to a movie, piping raw frames
+  into ffmpeg. GIFs are written with imageio when it is available"""
+  frames=iter(frames)
+  try:
+    frame=frames.next()
+  except StopIteration:
+    print 'no frames to write'
+    return
+
+  if outfile.endswith('.gif') and imageioflag:
+    writer=imageio.get_writer(outfile,mode='I',duration=1.0/fps)
+    writer.append_data(frame)
+    for frame in frames:
+      writer.append_data(frame)
+    writer.close()
+    print 'movie made'
+    return
+
+  (height,width)=frame.shape[:2]
+  cmd=['ffmpeg','-y','-f','rawvideo','-pix_fmt','rgb24',
+       '-s','%dx%d' % (width,height),'-r',str(fps),'-i','-']
+  if not outfile.endswith('.gif'):
+    #yuv420p needs even frame dimensions
+    cmd+=['-vf','scale=trunc(iw/2)*2:trunc(ih/2)*2','-pix_fmt','yuv420p']
+  cmd.append(outfile)
+
+  proc=subprocess.Popen(cmd,stdin=subprocess.PIPE)
+  proc.stdin.write(frame.tostring())
+  for frame in frames:
+    proc.stdin.write(frame.tostring())
+  proc.stdin.close()
+  status=proc.wait()
+  print status
   return
 
 def makeframes(myrun,boxtype):
   """ make a set of sequentially numbered frames from a Run object for
   use in making a movie from the simulation
 
-  WARNING: there seems to be some memory lekage somewhere. Increase in memory
-  used by python with each iteration
+  The figure is cleared after each frame, since otherwise every imshow
+  image is kept on the axes and memory grows with each iteration. movie()
+  renders frames without pyplot at all
   
   """
 
@@ -131,19 +238,12 @@ def makeframes(myrun,boxtype):
   (cmap,norm)=getColourMap(boxtype)
 
   #make individual frames
-  for j in range(1,len(myrun.slices)):
-    #run through slices from high-redshift to low
-    i=len(myrun.slices)-j
-    
-    #from the box data make a slice
-    myrun.slices[i].loaddata()
+  for (j,filename) in enumerate(framefiles(myrun,boxtype),1):
+    #from the box file read just the plane needed for the frame
+    dim=boxio.parse_filename(filename)['HIIdim']
+    slice_data=boxio.open_region(filename,dim,numpy.s_[:,indx,:])
     if boxtype==0:
-      #slice_data=myrun.slices[i].density.box_data[:,indx,:] #delta
-      slice_data=(myrun.slices[i].density.box_data+1)[:,indx,:] #delta+1
-    elif boxtype==1:
-      slice_data=myrun.slices[i].xH.box_data[:,indx,:]
-    else:
-      slice_data=myrun.slices[i].deltaT.box_data[:,indx,:]
+      slice_data=slice_data+1 #delta+1
       
     img=plt.imshow(slice_data,cmap,norm=norm)
     
@@ -152,7 +252,7 @@ def makeframes(myrun,boxtype):
     print filename
     #plt.show()
     plt.savefig(filename,format='png')
-    myrun.slices[i].forgetdata()
+    plt.clf()
 
   print 'frames made'
   return
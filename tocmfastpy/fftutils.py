@@ -0,0 +1,184 @@
+#!/usr/bin/python
+"""
+Real-to-complex FFT helpers for 21cmFast boxes
+
+Uses pyfftw with multiple threads if it is available and otherwise falls
+back on numpy.fft, which is single threaded. Single precision input gives
+single precision output with either backend.
+
+Also holds the cached |k| grid of the half (real-to-complex) spectrum of a
+box, which depends only on (dim,BoxSize), and the cached |k| bin of every
+mode used to spherically average spectra.
+"""
+
+import numpy as np
+import multiprocessing
+
+pyfftwflag=True
+try:
+  import pyfftw
+  pyfftw.interfaces.cache.enable()
+except ImportError:
+  print "pyfftw module not available, so using single threaded numpy FFTs"
+  pyfftwflag=False
+
+
+def nthreads(threads=None):
+  """number of FFT threads to use, defaulting to one per cpu"""
+  if threads is None:
+    threads=multiprocessing.cpu_count()
+  return threads
+
+
+def rfftn(data,threads=None,axes=None):
+  """real-to-complex FFT of a real box, returning the (dim,dim,dim/2+1)
+  half spectrum. axes restricts the transform to some of the axes, the last
+  of them being halved, as in numpy"""
+  if pyfftwflag:
+    return pyfftw.interfaces.numpy_fft.rfftn(data,axes=axes,threads=nthreads(threads))
+
+  fourierbox=np.fft.rfftn(data,axes=axes)
+  if data.dtype==np.float32:
+    fourierbox=fourierbox.astype(np.complex64)
+  return fourierbox
+
+
+def irfftn(fourierbox,shape,threads=None,axes=None):
+  """complex-to-real inverse FFT of a half spectrum, returning a real box of
+  the given shape. axes restricts the transform to some of the axes"""
+  if axes is not None:
+    shape=[shape[axis] for axis in axes]
+  if pyfftwflag:
+    return pyfftw.interfaces.numpy_fft.irfftn(fourierbox,shape,axes=axes,threads=nthreads(threads))
+
+  data=np.fft.irfftn(fourierbox,shape,axes=axes)
+  if fourierbox.dtype==np.complex64:
+    data=data.astype(np.float32)
+  return data
+
+
+def fft(data,axis,threads=None,inverse=False):
+  """complex FFT, or with inverse=True its normalised inverse, along a
+  single axis"""
+  if pyfftwflag:
+    if inverse:
+      return pyfftw.interfaces.numpy_fft.ifft(data,axis=axis,threads=nthreads(threads))
+    return pyfftw.interfaces.numpy_fft.fft(data,axis=axis,threads=nthreads(threads))
+
+  if inverse:
+    result=np.fft.ifft(data,axis=axis)
+  else:
+    result=np.fft.fft(data,axis=axis)
+  if data.dtype==np.complex64:
+    result=result.astype(np.complex64)
+  return result
+
+
+def emptyAligned(shape,dtype):
+  """uninitialised array, SIMD aligned for pyfftw when it is available"""
+  if pyfftwflag:
+    return pyfftw.empty_aligned(shape,dtype=dtype)
+  return np.empty(shape,dtype=dtype)
+
+
+def irfftnPlan(fourierbox,out,threads=None):
+  """return a function that inverse transforms the half spectrum held in
+  fourierbox into the preallocated real array out, for transforms that are
+  repeated on the same buffers. With pyfftw the transform is planned once,
+  which overwrites both arrays, and each call may destroy fourierbox"""
+  if pyfftwflag:
+    plan=pyfftw.FFTW(fourierbox,out,axes=range(out.ndim),direction='FFTW_BACKWARD',
+                     flags=('FFTW_MEASURE','FFTW_DESTROY_INPUT'),threads=nthreads(threads))
+    def execute():
+      plan()
+      return out
+    return execute
+
+  def execute():
+    out[...]=np.fft.irfftn(fourierbox,out.shape)
+    return out
+  return execute
+
+
+kgridcache={}
+
+def kGrid(dim,BoxSize):
+  """|k| in 1/Mpc on the (dim,dim,dim/2+1) half spectrum of a box of dim
+  cells per side and side length BoxSize Mpc. Cached per (dim,BoxSize)"""
+  key=(dim,BoxSize)
+  if key not in kgridcache:
+    kgridcache[key]=kBlock(dim,BoxSize)
+  return kgridcache[key]
+
+
+def kBlock(dim,BoxSize,rows=slice(None),cols=slice(None),dtype=np.float32):
+  """uncached |k| on the block [rows,cols,:] of the kGrid half spectrum,
+  for boxes whose full k grid is too large to keep in memory. dtype=float64
+  keeps |k| exact enough to compare against bin edges"""
+  kf=2*np.pi/float(BoxSize)
+  kx=np.fft.fftfreq(dim,1.0/dim)*kf
+  kz=np.fft.rfftfreq(dim,1.0/dim)*kf
+  ksq=kx[rows,np.newaxis,np.newaxis]**2+kx[np.newaxis,cols,np.newaxis]**2
+  return np.sqrt(ksq+kz[np.newaxis,np.newaxis,:]**2).astype(dtype)
+
+
+def blockRows(dim,ncells=2**22):
+  """rows of the half spectrum to handle at a time to keep temporaries to
+  about ncells cells"""
+  return max(1,ncells//(dim*(dim/2+1)))
+
+
+kbincache={}
+
+def kBins(dim,BoxSize,nbins=20,log=True):
+  """bins of |k| between the fundamental mode and the corner of the box,
+  log or linearly spaced, for the half spectrum of kGrid. Returns
+  (indx,k,nmodes): the bin of each mode as a (dim,dim,dim/2+1) array, with
+  nbins for the k=0 mode which lies outside, and the mode weighted mean |k|
+  and the number of modes of each bin, counting the complex conjugates of
+  the half spectrum (see halfWeights). Cached per (dim,BoxSize,nbins,log),
+  and built from float64 |k| a block of rows at a time, as the float32
+  kGrid can fall just below the fundamental mode"""
+  key=(dim,BoxSize,nbins,log)
+  if key in kbincache:
+    return kbincache[key]
+
+  kf=2*np.pi/float(BoxSize)
+  kmax=kf*np.sqrt(3)*(dim/2)*1.00001
+  kmin=kf*0.99999
+  if log:
+    edges=np.logspace(np.log10(kmin),np.log10(kmax),nbins+1)
+  else:
+    edges=np.linspace(kmin,kmax,nbins+1)
+
+  indx=np.empty((dim,dim,dim/2+1),dtype=np.intp)
+  weights=halfWeights(dim)
+  nmodes=np.zeros(nbins+1)
+  ksum=np.zeros(nbins+1)
+  step=blockRows(dim)
+  for i in range(0,dim,step):
+    rows=slice(i,min(i+step,dim))
+    kmag=kBlock(dim,BoxSize,rows,dtype=np.float64)
+    block=np.searchsorted(edges,kmag,side='right')-1
+    block[(block<0)|(block>=nbins)]=nbins
+    indx[rows]=block
+    w=np.broadcast_to(weights,kmag.shape).ravel()
+    nmodes+=np.bincount(block.ravel(),weights=w,minlength=nbins+1)
+    ksum+=np.bincount(block.ravel(),weights=w*kmag.ravel(),minlength=nbins+1)
+
+  olderr=np.seterr(divide='ignore',invalid='ignore')
+  k=ksum[:nbins]/nmodes[:nbins]
+  np.seterr(**olderr)
+  kbincache[key]=(indx,k,nmodes[:nbins])
+  return kbincache[key]
+
+
+def halfWeights(dim):
+  """number of modes each plane of the half spectrum stands for along the
+  last axis: 1 for kz=0 and the Nyquist plane, 2 for the others whose
+  complex conjugates are not stored"""
+  weights=np.full(dim/2+1,2.0)
+  weights[0]=1.0
+  if dim%2==0:
+    weights[-1]=1.0
+  return weights
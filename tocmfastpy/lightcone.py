@@ -0,0 +1,83 @@
+#!/usr/bin/python
+"""
+This code builds lightcones from the coeval boxes of a 21cmFast Run
+
+The lightcone is built plane by plane along the line of sight. Each plane
+sits at a comoving distance from the observer and takes the plane of the
+boxes at that distance (modulo the box size, so the box is tiled
+periodically), interpolated linearly in comoving distance between the two
+coeval boxes whose redshifts bracket it. Slices are walked in redshift
+order keeping only those two boxes in memory, and planes are appended to
+the output file as they are made, so peak memory is about three boxes
+however deep the lightcone is.
+
+The output is a raw float32 file of shape (nlos,dim,dim), line of sight
+first, which can be read back with numpy.memmap or numpy.fromfile.
+
+EXAMPLE USAGE:
+     import tocmfastpy as TOCM
+     myrun=TOCM.runio.loadslices(basedir,200,143)
+     (redshifts,distances)=TOCM.lightcone.makeLightcone(myrun,'lightcone.dat')
+     cone=numpy.memmap('lightcone.dat',dtype='f',mode='r',
+                       shape=(len(redshifts),200,200))
+"""
+
+import numpy as np
+import boxio
+import tocmphysics
+from Slice import *
+
+
+def makeLightcone(myrun,outfile,boxtype='deltaT',los=2,cosmo=tocmphysics.Planck13):
+    """build a lightcone of boxtype (a key of Slice.boxtypedict) along axis
+    los from the lowest to the highest redshift Slice of a Run holding that
+    box, writing it incrementally to outfile
+
+    Returns (redshifts,distances) of the planes of the lightcone, with
+    distances the comoving distance in Mpc
+    """
+
+    slices=[(z,slice.filename(boxtype)) for (z,slice) in zip(myrun.redshifts,myrun.slices)
+            if slice.filename(boxtype)]
+    slices.sort()
+    if len(slices)<2:
+        print 'Need at least two redshifts to make a lightcone'
+        return
+
+    param_dict=boxio.parse_filename(slices[0][1])
+    dim=param_dict['HIIdim']
+    dr=param_dict['BoxSize']/float(dim)
+
+    zbox=np.array([z for (z,filename) in slices])
+    chibox=tocmphysics.comovingDistance(zbox,cosmo)
+    nlos=int((chibox[-1]-chibox[0])/dr)+1
+    distances=chibox[0]+dr*np.arange(nlos)
+
+    #redshift of each plane from the inverse of the distance relation
+    zgrid=np.linspace(zbox[0],zbox[-1],10*nlos+2)
+    redshifts=np.interp(distances,tocmphysics.comovingDistance(zgrid,cosmo),zgrid)
+
+    fd=open(outfile,'wb')
+    try:
+        n=0
+        low=np.asarray(boxio.readbox(slices[0][1],quiet=True).box_data,dtype=np.float32)
+        high=np.asarray(boxio.readbox(slices[1][1],quiet=True).box_data,dtype=np.float32)
+        for (p,chi) in enumerate(distances):
+            #advance the bracketing pair of boxes, keeping only two in memory
+            while chi>chibox[n+1] and n+2<len(slices):
+                n+=1
+                low=high
+                high=None
+                high=np.asarray(boxio.readbox(slices[n+1][1],quiet=True).box_data,
+                                dtype=np.float32)
+
+            indx=int(round(chi/dr))%dim
+            weight=np.float32((chi-chibox[n])/(chibox[n+1]-chibox[n]))
+            plane=np.take(low,indx,axis=los)*(1-weight)
+            plane+=weight*np.take(high,indx,axis=los)
+            plane.astype(np.float32).tofile(fd)
+    finally:
+        fd.close()
+
+    print 'lightcone of',nlos,'planes written to',outfile
+    return redshifts,distances
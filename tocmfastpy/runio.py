@@ -12,6 +12,7 @@ therefore arrange as helper functions
 """
 
 from Run import *
+from BoxIndex import *
 import boxio
 import numpy
 import os.path
@@ -23,23 +24,28 @@ def loadslices(base,dim,boxsize):
     pixel dimensions dim and boxlength boxsize and sort them
     into a list of Slices"""
 
-    #first identify relevant files
-    filenames=findrun(base,dim,boxsize)
+    #first identify relevant files, using the persistent index of the
+    #directory so that each filename is only ever parsed once
+    index=BoxIndex(base)
+    filenames=findrun(base,dim,boxsize,index)
 
     #now sort them into redshift collections
-    filedict=dictByRedshift(filenames)
+    filedict=dictByRedshift(filenames,index)
 
     print filedict
 
     myrun=Run()
-    myrun.setFromDict(filedict)
+    myrun.setFromDict(filedict,index)
 
     return myrun
 
 
-def findrun(base,dim,boxsize):
+def findrun(base,dim,boxsize,index=None):
     """ find all files associated with run given base directory
-    and the resolution size and box length """
+    and the resolution size and box length
+
+    index is an optional BoxIndex for base, which avoids listing the
+    directory again"""
 
     if not os.path.isdir(base):
         print base, 'is not a valid directory'
@@ -49,7 +55,11 @@ def findrun(base,dim,boxsize):
     #note this will include the initialisation boxes, which
     #are independent of redshift
     searchstr='_'+str(dim)+'_'+str(boxsize)+'Mpc'
-    filenames=os.listdir(base)
+    if index is None:
+        filenames=os.listdir(base)
+    else:
+        index.update()
+        filenames=[os.path.basename(filename) for filename in index.filenames()]
 
     box_files=[]
     for filename in filenames:
@@ -74,21 +84,27 @@ def locateboxes(filenames,prefix):
     return sorted(boxes)
 
 
-def dictByRedshift(filenames):
+def dictByRedshift(filenames,index=None):
     """reorder the files by redshift and return a dictionary
     {z,filenames}
+
+    index is an optional BoxIndex from which the already parsed
+    redshifts are taken
     """
 
     #shortdict=[]
     longdict={}
     for filename in filenames:
-        match=re.search('_z([0-9.]+)',filename)
-        if match:
-            z=float(match.group(1))
+        if index is not None:
+            z=index.param_dict(filename)['z']
         else:
-            #initialisation boxes are labelled with z=0.0 in 21cmFast
-            #standard output or without a redshift label
-            z=0.0
+            match=re.search('_z([0-9.]+)',filename)
+            if match:
+                z=float(match.group(1))
+            else:
+                #initialisation boxes are labelled with z=0.0 in 21cmFast
+                #standard output or without a redshift label
+                z=0.0
 
         #shortdict.append((z,filename))
         if z in longdict.keys():
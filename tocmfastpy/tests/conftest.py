@@ -0,0 +1,5 @@
+#tocmfastpy is imported from the repository root, as by the scripts there
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
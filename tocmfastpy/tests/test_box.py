@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from tocmfastpy.Box import Box
+
+
+def makebox(data):
+  box=Box()
+  box.box_data=data
+  box.dim=data.shape[0]
+  box.init=True
+  return box
+
+
+@pytest.mark.parametrize('data',[
+  np.random.RandomState(0).randn(24,24,24).astype(np.float32),
+  np.random.RandomState(1).lognormal(0,3,(24,24,24)), #values spanning decades
+  np.random.RandomState(2).randint(0,5,(24,24,24)), #many ties
+  np.round(np.random.RandomState(3).rand(24,24,24),2).astype(np.float32)*(np.arange(24)>11), #half the box zero
+])
+@pytest.mark.parametrize('nbins,maxcand',[(4096,2**22),(8,50)])
+def test_thresholdFromVolume_matches_sort(data,nbins,maxcand,monkeypatch):
+  #small chunks so that the histograms are built up over many slabs
+  chunks=Box.chunks
+  monkeypatch.setattr(Box,'chunks',lambda self,ncells=100,step=1: chunks(self,ncells,step))
+  box=makebox(data)
+  ordered=np.sort(data.ravel())
+  fracs=np.array([0.,1e-4,0.1,0.25,0.5,0.5001,0.9,0.999,1.])
+  crit=box.thresholdFromVolume(fracs,nbins=nbins,maxcand=maxcand)
+  expected=ordered[np.minimum((fracs*data.size).astype(np.int64),data.size-1)]
+  assert np.array_equal(crit,expected)
+  assert box.thresholdFromVolume(0.3,nbins=nbins,maxcand=maxcand)==ordered[int(0.3*data.size)]
+
+
+def test_thresholdFromVolume_passes(monkeypatch):
+  #one pass for the range and one to select from few enough candidates
+  passes=[]
+  chunks=Box.chunks
+  def counting(self,*args,**kwargs):
+    passes.append(self)
+    return chunks(self,*args,**kwargs)
+  monkeypatch.setattr(Box,'chunks',counting)
+  data=np.random.RandomState(4).rand(16,16,16).astype(np.float32)
+  crit=makebox(data).thresholdFromVolume(0.5)
+  assert crit==np.sort(data.ravel())[data.size//2]
+  assert len(passes)==2
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+import pytest
+
+from tocmfastpy.BoxCache import BoxCache
+
+
+def makeboxes(dirname,nbox=4,dim=16):
+  filenames=[]
+  for i in range(nbox):
+    fname='xH_nohalos_z%06.2f_nf0.5_eff20.0_HIIfilter1_Mmin5.7e+08_RHIImax20_%d_64Mpc' % (6+i,dim)
+    path=os.path.join(str(dirname),fname)
+    (np.random.RandomState(i).rand(dim,dim,dim).astype(np.float32)+1).tofile(path)
+    filenames.append(path)
+  return filenames
+
+
+def settle(cache):
+  for (token,result) in list(cache.pending.values()):
+    result.wait() #the callback moving a box into the cache runs first
+
+
+def test_prefetch_respects_budget(tmpdir):
+  filenames=makeboxes(tmpdir)
+  nbytes=16**3*4
+  cache=BoxCache(budget=2.5*nbytes,nworkers=2)
+  cache.prefetch(filenames)
+  assert cache.used<=cache.budget
+  assert len(cache.pending)+len(cache.boxes)==2
+  settle(cache)
+  assert cache.used<=cache.budget
+  assert len(cache.boxes)==2 and not cache.pending
+  box=cache.get(filenames[3])
+  assert np.array_equal(box.box_data,np.fromfile(filenames[3],dtype=np.float32).reshape(16,16,16))
+  assert cache.used<=cache.budget
+  cache.clear()
+
+
+def test_cached_boxes_are_protected(tmpdir):
+  filenames=makeboxes(tmpdir,nbox=1)
+  cache=BoxCache(budget=1e6)
+  original=np.array(cache.get(filenames[0]).box_data)
+
+  box=cache.get(filenames[0])
+  with pytest.raises(ValueError):
+    box.box_data[0,0,0]=0
+  box.boxToOverdensity(inplace=True)
+  assert np.array_equal(cache.get(filenames[0]).box_data,original)
+
+  mine=cache.get(filenames[0],writeable=True)
+  mine.boxToOverdensity(inplace=True)
+  assert np.isclose(mine.box_data.mean(),0,atol=1e-5)
+  assert np.array_equal(cache.get(filenames[0]).box_data,original)
+  cache.clear()
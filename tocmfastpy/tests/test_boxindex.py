@@ -0,0 +1,82 @@
+import os
+import tempfile
+
+import pytest
+
+from tocmfastpy import boxio
+from tocmfastpy.BoxIndex import BoxIndex
+
+NAMES=['xH_nohalos_z010.00_nf0.500000_eff20.0_HIIfilter1_Mmin5.7e+08_RHIImax20_16_64Mpc',
+       'updated_smoothed_deltax_z010.00_16_64Mpc',
+       'xH_nohalos_z009.00_nf0.300000_eff20.0_HIIfilter1_Mmin5.7e+08_RHIImax20_16_64Mpc']
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+  """names passed to boxio.parse_filename"""
+  names=[]
+  parse_filename=boxio.parse_filename
+  def counting(filename):
+    names.append(os.path.basename(filename))
+    return parse_filename(filename)
+  monkeypatch.setattr(boxio,'parse_filename',counting)
+  return names
+
+
+def test_incremental_rescan(tmpdir,parsed):
+  for name in NAMES[:2]:
+    tmpdir.join(name).write('')
+  index=BoxIndex(str(tmpdir))
+  assert sorted(parsed)==sorted(NAMES[:2])
+  assert index.query(type='xh',z=10.0)==[str(tmpdir.join(NAMES[0]))]
+  assert sorted(f.basename for f in tmpdir.listdir())==sorted(NAMES[:2]+[BoxIndex.indexname])
+
+  #a fresh index loads the sidecar without parsing anything
+  del parsed[:]
+  assert BoxIndex(str(tmpdir)).filenames()==index.filenames()
+  assert parsed==[]
+
+  #only the new file is parsed, and removed files are forgotten
+  tmpdir.join(NAMES[2]).write('')
+  tmpdir.join(NAMES[1]).remove()
+  index=BoxIndex(str(tmpdir))
+  assert parsed==[NAMES[2]]
+  assert index.filenames()==sorted(str(tmpdir.join(name)) for name in (NAMES[0],NAMES[2]))
+  del parsed[:]
+  assert BoxIndex(str(tmpdir)).filenames()==index.filenames()
+  assert parsed==[]
+
+
+def test_change_within_mtime_resolution(tmpdir,parsed):
+  tmpdir.join(NAMES[0]).write('')
+  index=BoxIndex(str(tmpdir))
+  #a box written in the same mtime tick as the last save
+  tmpdir.join(NAMES[2]).write('')
+  os.utime(str(tmpdir),(index.mtime,index.mtime))
+  index.update()
+  assert str(tmpdir.join(NAMES[2])) in index.filenames()
+  assert str(tmpdir.join(NAMES[2])) in BoxIndex(str(tmpdir)).filenames()
+
+
+def test_save_replaces_sidecar(tmpdir):
+  tmpdir.join(NAMES[0]).write('')
+  index=BoxIndex(str(tmpdir))
+  fd=open(index.indexfile(),'rb') #a reader holding the old sidecar
+  inode=os.fstat(fd.fileno()).st_ino
+  tmpdir.join(NAMES[2]).write('')
+  index.update()
+  #the sidecar was replaced by a new file rather than rewritten in place
+  assert os.stat(index.indexfile()).st_ino!=inode
+  fd.close()
+  assert sorted(f.basename for f in tmpdir.listdir())==sorted([NAMES[0],NAMES[2],BoxIndex.indexname])
+
+
+def test_read_only_directory(tmpdir,monkeypatch):
+  for name in NAMES:
+    tmpdir.join(name).write('')
+  def denied(*args,**kwargs):
+    raise OSError(13,'Permission denied')
+  monkeypatch.setattr(tempfile,'mkstemp',denied)
+  index=BoxIndex(str(tmpdir))
+  assert index.filenames()==sorted(str(tmpdir.join(name)) for name in NAMES)
+  assert sorted(f.basename for f in tmpdir.listdir())==sorted(NAMES)
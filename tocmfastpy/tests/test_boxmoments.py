@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from tocmfastpy.BoxMoments import BoxMoments, binindex
+
+
+@pytest.mark.parametrize('offset',[0.,1e4]) #large offset checks the shift keeps moments accurate
+def test_moments_match_numpy(offset):
+  data=np.random.RandomState(0).gamma(2.,1.,(20,20,20))+offset
+  moments=BoxMoments(nmom=4,hrange=(offset,offset+10.),nbin=25)
+  for i in range(0,20,3):
+    moments.add(data[i:i+3].astype(np.float32))
+  moments.add(np.zeros((0,20,20)))
+  x=data.astype(np.float32).astype(np.float64).ravel()
+  assert moments.n==x.size
+  assert (moments.xmin,moments.xmax)==(x.min(),x.max())
+  assert np.isclose(moments.mean(),x.mean(),rtol=1e-12)
+  assert np.isclose(moments.var(),x.var(),rtol=1e-8)
+  for N in (3,4):
+    assert np.isclose(moments.moment(N),((x-x.mean())**N).mean(),rtol=1e-6)
+  expected=np.histogram(x,bins=25,range=(offset,offset+10.))[0]
+  assert np.array_equal(moments.hist,expected)
+  (density,edges)=np.histogram(x,bins=25,range=(offset,offset+10.),density=True)
+  pdf=moments.pdf()
+  assert np.allclose(pdf.pdf,density)
+  assert np.allclose(pdf.xbin,(edges[1:]+edges[:-1])/2)
+
+
+def test_binindex_edges():
+  x=np.array([-0.1,0.,0.5,0.99,1.,1.1])
+  assert list(binindex(x,0.,1.,4))==[-1,0,2,3,3,-1]
+
+
+def test_empty():
+  moments=BoxMoments()
+  assert moments.mean()==0.0
+  assert moments.var()==0.0
@@ -0,0 +1,215 @@
+import numpy as np
+import pytest
+
+from tocmfastpy import boxstats
+from tocmfastpy.Box import Box
+
+
+def makebox(data):
+  box=Box()
+  dim=data.shape[0]
+  box.setBox(data,{'dim':dim,'HIIdim':dim,'BoxSize':float(dim),'z':10.0})
+  return box
+
+
+def test_boxPDF_bool_box():
+  #boxFromThreshold gives bool masks, whose PDF has two populated bins
+  np.random.seed(1)
+  box=makebox(np.random.rand(16,16,16).astype(np.float32))
+  mask=makebox(box.boxFromThreshold(0.25))
+  pdf=boxstats.boxPDF(mask,NBIN=2)
+  assert (pdf.xmin,pdf.xmax)==(0.0,1.0)
+  frac=pdf.pdf*pdf.delta
+  assert np.isclose(frac[1],(box.box_data<=0.25).mean())
+  assert np.isclose(frac.sum(),1.0)
+
+
+def test_boxPDF_log_skips_zeros_quietly(capsys):
+  np.random.seed(2)
+  data=np.random.rand(16,16,16).astype(np.float32)+0.1
+  data[:8]=0
+  pdf=boxstats.boxPDF(makebox(data),NBIN=10,log=True)
+  assert 'Warning' not in capsys.readouterr()[0]
+  assert np.isclose(pdf.xmin,np.log10(data[data>0].min()))
+  assert np.isclose((pdf.pdf*pdf.delta).sum(),1.0)
+
+
+def test_boxPDF_matches_histogram():
+  np.random.seed(3)
+  data=np.random.randn(16,16,16).astype(np.float32)
+  pdf=boxstats.boxPDF(makebox(data),NBIN=12,xlimits=(-3,3))
+  hist,edges=np.histogram(data,bins=12,range=(-3,3))
+  assert np.allclose(pdf.pdf,hist/float(hist.sum())/(edges[1]-edges[0]))
+
+
+class FakeSlice:
+  def __init__(self,files):
+    self.files=files
+
+  def filename(self,boxtype):
+    return self.files.get(boxtype)
+
+
+class FakeRun:
+  def __init__(self,redshifts,slices):
+    self.redshifts=redshifts
+    self.slices=slices
+
+
+def writerun(tmpdir,redshifts,dim=16):
+  """FakeRun of density and xh boxes at redshifts, with the box data as a
+  flat list of (density,xh) per redshift"""
+  slices=[]
+  data=[]
+  for z in redshifts:
+    files={}
+    for (boxtype,prefix) in (('density','updated_smoothed_deltax'),('xh','xH_nohalos')):
+      fname='%s_z%06.2f_nf0.5_eff20.0_HIIfilter1_Mmin5.7e+08_RHIImax20_%d_64Mpc' % (prefix,z,dim)
+      values=np.random.RandomState(int(z)+len(files)).randn(dim,dim,dim).astype(np.float32)
+      values.tofile(str(tmpdir.join(fname)))
+      files[boxtype]=str(tmpdir.join(fname))
+      data.append(values)
+    slices.append(FakeSlice(files))
+  return FakeRun(redshifts,slices),data
+
+
+def test_runConditionalPDF_single_limits_pass(tmpdir,monkeypatch):
+  redshifts=[8.0,9.0]
+  (run,data)=writerun(tmpdir,redshifts)
+
+  passes=[]
+  chunks=Box.chunks
+  def counting(self,*args,**kwargs):
+    passes.append(self)
+    return chunks(self,*args,**kwargs)
+  monkeypatch.setattr(Box,'chunks',counting)
+
+  result=boxstats.runConditionalPDF(run,Nbins=8,normed=False)
+  (zs,binsX,binsY,histX,histY,histXY)=result[:6]
+  assert zs==redshifts
+  assert len(passes)==8 #one pass for the limits and one to bin, per box
+  assert np.isclose(binsX[0],min(data[0].min(),data[2].min()))
+  assert np.isclose(binsY[-1],max(data[1].max(),data[3].max()))
+  expected=np.histogram2d(data[0].ravel(),data[1].ravel(),bins=(binsX,binsY))[0]
+  assert np.array_equal(histXY[0],expected)
+
+
+@pytest.mark.parametrize('normed',[True,False])
+def test_runConditionalPDF_matches_conditionalPDF(tmpdir,normed):
+  #limits that leave out cells in both variables
+  (xlimits,ylimits)=((-1.0,1.5),(-0.5,2.0))
+  (run,data)=writerun(tmpdir,[8.0,9.0])
+  result=boxstats.runConditionalPDF(run,Nbins=6,xlimits=xlimits,ylimits=ylimits,normed=normed)
+  assert result[0]==[8.0,9.0]
+  for n in range(2):
+    expected=boxstats.conditionalPDF(data[2*n],data[2*n+1],Nbins=6,xlimits=xlimits,ylimits=ylimits,normed=normed)
+    assert np.allclose(result[1],expected[0]) and np.allclose(result[2],expected[1])
+    for (mine,theirs) in zip(result[3:],expected[2:]):
+      assert np.allclose(mine[n],theirs,equal_nan=True)
+
+
+def test_runConditionalPDF_without_pairs():
+  result=boxstats.runConditionalPDF(FakeRun([8.0],[FakeSlice({'density':'x'})]),Nbins=5)
+  assert result[0]==[]
+  assert [len(array) for array in result[1:]]==[0]*7
+  assert result[5].shape==(0,5,5)
+
+
+def sampled_skewer(data,start,direction,length,nsample):
+  """brute force skewer: the box value at nsample evenly spaced points of
+  each unit step, with nsample=1 sampling the start of the step"""
+  direction=np.asarray(direction,dtype=np.float64)
+  direction=direction/np.sqrt((direction**2).sum())
+  t=np.arange(length*nsample)/float(nsample)
+  if nsample>1:
+    t+=0.5/nsample
+  pos=np.asarray(start)[:,None]+direction[:,None]*t[None,:]
+  cells=[np.floor(pos[i]).astype(int)%data.shape[i] for i in range(3)]
+  return data[cells[0],cells[1],cells[2]].reshape(length,nsample).mean(axis=1)
+
+
+SKEWERS=[((0.5,2.25,3.75),(1,0,0)),   #axis aligned
+         ((4.2,0.3,6.9),(0,0,-2)),    #axis aligned backwards, unnormalised
+         ((1.3,2.6,0.4),(1,2,3)),     #oblique
+         ((5.9,0.1,7.5),(-0.3,0.5,-0.8)),
+         ((-3.5,15.25,2.0),(0.6,-0.8,0)), #start outside the box
+        ]
+
+
+def test_drawSkewers_matches_sampling():
+  #a box of different sides so that mixing up the axes shows, with skewers
+  #long enough to wrap around it several times
+  data=np.random.RandomState(5).rand(6,7,8)
+  box=Box()
+  box.box_data=data
+  length=40
+  starts=np.array([start for (start,direction) in SKEWERS])
+  directions=np.array([direction for (start,direction) in SKEWERS],dtype=np.float64)
+  nearest=boxstats.drawSkewers(box,starts,directions,length)
+  weighted=boxstats.drawSkewers(box,starts,directions,length,weighted=True,nbatch=2)
+  for (n,(start,direction)) in enumerate(SKEWERS):
+    assert np.array_equal(nearest[n],sampled_skewer(data,start,direction,length,1))
+    assert np.allclose(weighted[n],sampled_skewer(data,start,direction,length,4000),atol=5e-3)
+    assert np.array_equal(boxstats.drawCleverSkewer(box,start,direction,length),weighted[n])
+  #an axis aligned skewer from the middle of a pixel spends half of each
+  #step in each of two pixels
+  assert np.allclose(weighted[0][:-1],0.5*(nearest[0][:-1]+nearest[0][1:]))
+
+
+def test_drawSkewers_weights_are_path_lengths():
+  box=Box()
+  box.box_data=np.ones((6,7,8))
+  starts=np.array([start for (start,direction) in SKEWERS])
+  directions=np.array([direction for (start,direction) in SKEWERS],dtype=np.float64)
+  weighted=boxstats.drawSkewers(box,starts,directions,25,weighted=True)
+  assert np.allclose(weighted,1.0)
+  assert np.allclose(weighted.sum(axis=1),25.0)
+
+
+def minkowski(data,threshold=0.5,**kwargs):
+  """Minkowski functionals of {data>=threshold} in units of Mpc for a box
+  of 2 Mpc pixels, as (V0,V1,V2,V3)"""
+  box=Box()
+  box.setBox(data,{'dim':data.shape[0],'HIIdim':data.shape[0],'BoxSize':2.0*data.shape[0],'z':10.0})
+  (thresholds,V)=boxstats.boxMinkowski(box,[threshold],**kwargs)
+  return V[0]*(2.0*data.shape[0])**3
+
+
+def test_boxMinkowski_known_shapes():
+  a=2.0
+  data=np.zeros((8,8,8))
+  data[3,4,5]=1
+  assert np.allclose(minkowski(data),[a**3,a**2,a,1])
+  #the same cube as a region below threshold
+  assert np.allclose(minkowski(1-data,above=False),[a**3,a**2,a,1])
+
+  data[6,1,1]=1 #disjoint from the first, not even at a corner
+  assert np.allclose(minkowski(data),[2*a**3,2*a**2,2*a,2])
+
+  #a 3 pixel cube with a hollow centre: outer and cavity surfaces and
+  #the Euler characteristic of a sphere
+  data=np.zeros((8,8,8))
+  data[2:5,2:5,2:5]=1
+  data[3,3,3]=0
+  assert np.allclose(minkowski(data),[26*a**3,(54+6)*a**2/6,3*a-a,2])
+
+  #cubes on opposite faces touch through the periodic boundary only
+  data=np.zeros((8,8,8))
+  data[0,3,3]=data[7,3,3]=1
+  assert np.allclose(minkowski(data),[2*a**3,10*a**2/6,4*a/3,1])
+  assert np.allclose(minkowski(data,periodic=False),[2*a**3,2*a**2,2*a,2])
+
+
+@pytest.mark.parametrize('periodic',[True,False])
+@pytest.mark.parametrize('above',[True,False])
+def test_boxMinkowski_chunks(periodic,above):
+  from scipy import ndimage
+  data=ndimage.gaussian_filter(np.random.RandomState(7).randn(12,12,12),1.5,mode='wrap')
+  box=makebox(data)
+  thresholds=np.linspace(-0.2,0.2,9)[::-1]
+  (t,whole)=boxstats.boxMinkowski(box,thresholds,above=above,periodic=periodic,nslab=100)
+  assert np.array_equal(t,thresholds)
+  assert len(set(whole[:,3]))>1
+  for nslab in (1,5):
+    (t,V)=boxstats.boxMinkowski(box,thresholds,above=above,periodic=periodic,nslab=nslab)
+    assert np.allclose(V,whole)
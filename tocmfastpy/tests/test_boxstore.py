@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+from tocmfastpy import boxio, boxstore
+
+FNAME='xH_nohalos_z010.00_nf0.500000_eff20.0_HIIfilter1_Mmin5.7e+08_RHIImax20_16_64Mpc'
+
+
+def rawbox(dirname,seed=0):
+  np.random.seed(seed)
+  data=np.random.rand(16,16,16).astype(np.float32)
+  data[data<0.5]=0
+  path=os.path.join(str(dirname),FNAME)
+  data.tofile(path)
+  return path,data
+
+
+def test_store_round_trip(tmpdir):
+  np.random.seed(4)
+  arrays={'box':np.random.rand(20,18,16).astype(np.float32),
+          'labels':np.random.randint(0,9,(20,18,16)).astype(np.int32)}
+  filename=str(tmpdir.join('x.tcb'))
+  boxstore.save_store(filename,arrays,{'z':10.0},{'niter':3},chunks=7,workers=2)
+  for name in arrays:
+    assert np.array_equal(boxstore.load_store(filename,name),arrays[name])
+  for index in (np.s_[:,:,10],np.s_[3:11],np.s_[2:9,5:17,1:15],np.s_[::3,::4,::5],np.s_[5,...]):
+    assert np.array_equal(boxstore.load_region(filename,index),arrays['box'][index])
+  assert boxstore.read_header(filename)['attrs']['niter']==3
+
+
+def test_convert_directory(tmpdir):
+  base=tmpdir.mkdir('Boxes')
+  path,data=rawbox(base)
+  with pytest.raises(ValueError):
+    boxstore.convert_directory(str(base),str(base))
+  written=boxstore.convert_directory(str(base),str(tmpdir.join('Store')),chunks=8,workers=2)
+  assert written==[str(tmpdir.join('Store',FNAME+boxstore.EXTENSION))]
+  assert not any(boxstore.is_store(f) for f in os.listdir(str(base)))
+  box=boxio.readbox(written[0],quiet=True)
+  assert np.array_equal(box.box_data,data)
+  assert box.param_dict['HIIdim']==16
+  assert np.array_equal(boxio.open_region(written[0],16,np.s_[4:9]),data[4:9])
+
+
+def test_failed_store_leaves_no_file(tmpdir,monkeypatch):
+  base=tmpdir.mkdir('Boxes')
+  path,data=rawbox(base)
+  outdir=tmpdir.join('Store')
+  encode_chunk=boxstore.encode_chunk
+  calls=[]
+  def failing(*args):
+    calls.append(args)
+    if len(calls)==3:
+      raise IOError(28,'No space left on device')
+    return encode_chunk(*args)
+  monkeypatch.setattr(boxstore,'encode_chunk',failing)
+  with pytest.raises(IOError):
+    boxstore.convert_directory(str(base),str(outdir),chunks=8,workers=1)
+  assert outdir.listdir()==[]
+
+  #the failed box is not taken as up to date, so the next run writes it
+  monkeypatch.setattr(boxstore,'encode_chunk',encode_chunk)
+  written=boxstore.convert_directory(str(base),str(outdir),chunks=8,workers=1)
+  assert written==[str(outdir.join(FNAME+boxstore.EXTENSION))]
+  assert [f.basename for f in outdir.listdir()]==[FNAME+boxstore.EXTENSION]
+  assert np.array_equal(boxstore.load_store(written[0]),data)
+  umask=os.umask(0)
+  os.umask(umask)
+  assert outdir.join(FNAME+boxstore.EXTENSION).stat().mode&0777==0666&~umask
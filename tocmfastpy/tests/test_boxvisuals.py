@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+import pytest
+
+boxvisuals=pytest.importorskip('tocmfastpy.boxvisuals')
+
+
+class FakeSlice:
+  def __init__(self,fxH):
+    self.fxH=fxH
+
+
+class FakeRun:
+  def __init__(self,slices):
+    self.slices=slices
+
+
+def makerun(dirname,nslice=7,dim=8):
+  slices=[]
+  for i in range(nslice):
+    fname='xH_nohalos_z%06.2f_nf0.5_eff20.0_HIIfilter1_Mmin5.7e+08_RHIImax20_%d_64Mpc' % (6+i,dim)
+    path=os.path.join(str(dirname),fname)
+    np.random.RandomState(i).rand(dim,dim,dim).astype(np.float32).tofile(path)
+    slices.append(FakeSlice(path))
+  return FakeRun(slices)
+
+
+def test_renderframes_in_order(tmpdir):
+  myrun=makerun(tmpdir)
+  jobs=[(filename,1,3) for filename in boxvisuals.framefiles(myrun,1)]
+  frames=list(boxvisuals.renderframes(myrun,1,indx=3,nworkers=2))
+  assert len(frames)==len(myrun.slices)-1
+  for frame,job in zip(frames,jobs):
+    assert frame.dtype==np.uint8 and frame.shape==(8,8,3)
+    assert np.array_equal(frame,boxvisuals.renderplane(job))
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from tocmfastpy import lightcone, tocmphysics
+
+DIM=8
+BOXSIZE=16.0
+
+
+class FakeSlice:
+  def __init__(self,filename):
+    self.fdeltaT=filename
+
+  def filename(self,boxtype):
+    return self.fdeltaT if boxtype=='deltaT' else ''
+
+
+class FakeRun:
+  def __init__(self,redshifts,slices):
+    self.redshifts=redshifts
+    self.slices=slices
+
+
+def middle_redshift(z0,z2,nplanes):
+  """redshift between z0 and z2 exactly nplanes cells further away than z0,
+  so that a plane of the lightcone falls on it"""
+  dr=BOXSIZE/DIM
+  (lo,hi)=(z0,z2)
+  for i in range(100):
+    z=0.5*(lo+hi)
+    chi=tocmphysics.comovingDistance(np.array([z0,z,z2]))
+    if chi[1]-chi[0]<nplanes*dr:
+      lo=z
+    else:
+      hi=z
+  return z
+
+
+@pytest.mark.parametrize('los',[0,2])
+def test_makeLightcone_matches_interpolation(tmpdir,los):
+  (z0,z2)=(8.0,8.1)
+  redshifts=[z2,middle_redshift(z0,z2,6),z0] #not in redshift order
+  boxes=[]
+  slices=[]
+  for (n,z) in enumerate(redshifts):
+    data=np.random.RandomState(n).rand(DIM,DIM,DIM).astype(np.float32)
+    filename=str(tmpdir.join('delta_T_v3_no_halos_z%06.2f_nf0.500000_useTs0_aveTb20.00_%d_%dMpc'
+                             % (z,DIM,BOXSIZE)))
+    data.tofile(filename)
+    boxes.append(data)
+    slices.append(FakeSlice(filename))
+  slices.append(FakeSlice('')) #a slice without the box is ignored
+  redshifts.append(8.05)
+
+  outfile=str(tmpdir.join('cone.dat'))
+  (zplanes,distances)=lightcone.makeLightcone(FakeRun(redshifts,slices),outfile,los=los)
+  cone=np.fromfile(outfile,dtype=np.float32).reshape((len(distances),DIM,DIM))
+
+  #every box in memory, interpolated cell by cell in comoving distance
+  order=np.argsort(redshifts[:3])
+  chibox=tocmphysics.comovingDistance(np.array(redshifts[:3])[order])
+  assert np.isclose(distances[0],chibox[0]) and distances[-1]<=chibox[-1]
+  assert np.allclose(np.diff(distances),BOXSIZE/DIM)
+  assert np.isclose(zplanes[0],z0) and np.isclose(zplanes[6],redshifts[1],atol=1e-6)
+  for (p,chi) in enumerate(distances):
+    planes=np.array([np.take(boxes[n],int(round(chi*DIM/BOXSIZE))%DIM,axis=los) for n in order])
+    expected=np.apply_along_axis(lambda values: np.interp(chi,chibox,values),0,planes)
+    assert np.allclose(cone[p],expected,atol=1e-5)
+  #the plane at the middle slice is that box's plane
+  assert np.allclose(cone[6],np.take(boxes[1],int(round(distances[6]*DIM/BOXSIZE))%DIM,axis=los),atol=1e-5)
+
+
+def test_makeLightcone_needs_two_boxes(tmpdir):
+  assert lightcone.makeLightcone(FakeRun([8.0],[FakeSlice('')]),str(tmpdir.join('cone.dat'))) is None
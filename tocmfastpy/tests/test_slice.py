@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from tocmfastpy.Box import Box
+from tocmfastpy.Slice import Slice
+
+FIELDS=['density','xH','vx','vy','vz','deltaT']
+
+
+def makeslice(shape=(6,7,8),missing=()):
+  """Slice with a different random box for every field, so that mixing up
+  fields shows"""
+  myslice=Slice()
+  for (n,name) in enumerate(FIELDS):
+    if name in missing:
+      continue
+    box=Box()
+    box.box_data=np.random.RandomState(n).rand(*shape).astype(np.float32)
+    setattr(myslice,name,box)
+  return myslice
+
+
+def test_pixels_nearest():
+  myslice=makeslice(missing=('deltaT',))
+  pos=np.random.RandomState(9).uniform(-10,20,(50,3))
+  values=myslice.pixels(pos)
+  cells=np.floor(pos).astype(int)%np.array([6,7,8])
+  for name in FIELDS[:-1]:
+    data=getattr(myslice,name).box_data
+    assert np.array_equal(values[name],data[cells[:,0],cells[:,1],cells[:,2]])
+  assert np.array_equal(values['deltaT'],np.zeros(50))
+  #integer positions inside the box agree with pixel, field by field
+  for i in range(5):
+    assert tuple(values[i])==tuple(myslice.pixel(cells[i]))
+  inside=np.array([[0,0,0],[5,6,7],[2.5,3.9,0.1]])
+  assert np.array_equal(myslice.pixels(inside,wrap=False),myslice.pixels(inside))
+
+
+def test_pixels_interpolated():
+  myslice=makeslice()
+  shape=np.array([6,7,8])
+  pos=np.random.RandomState(10).uniform(-10,20,(50,3))
+  values=myslice.pixels(pos,interp=True)
+  inside=np.random.RandomState(11).uniform(0,1,(50,3))*(shape-1)
+  inside[:3]=[[0,0,0],[5,6,7],[5,0.5,7]]
+  clamped=myslice.pixels(inside,wrap=False,interp=True)
+  for name in FIELDS:
+    data=getattr(myslice,name).box_data
+    #periodic interpolation, with the box extended by its first planes as
+    #this scipy's mode='wrap' has a period of one cell less than the box
+    periodic=np.pad(data,((0,1),(0,1),(0,1)),mode='wrap')
+    expected=ndimage.map_coordinates(periodic.astype(np.float64),(pos%shape).T,order=1)
+    assert np.allclose(values[name],expected,atol=1e-6)
+    expected=ndimage.map_coordinates(data.astype(np.float64),inside.T,order=1,mode='nearest')
+    assert np.allclose(clamped[name],expected,atol=1e-6)
+
+
+def test_pixels_vy_and_vz_are_distinct():
+  myslice=makeslice()
+  pos=np.array([[1,2,3],[4.5,0.25,7.75]])
+  for interp in (False,True):
+    values=myslice.pixels(pos,interp=interp)
+    assert not np.allclose(values['vy'],values['vz'])
+    assert np.allclose(values['vz'],Slice.pixels(makeslice(missing=('vy',)),pos,interp=interp)['vz'])
+  assert myslice.pixel((1,2,3))[3]==myslice.vy.box_data[1,2,3]
+  assert myslice.pixel((1,2,3))[4]==myslice.vz.box_data[1,2,3]
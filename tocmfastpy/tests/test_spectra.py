@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from tocmfastpy import boxstats, fftutils
+from tocmfastpy.Box import Box
+
+
+def makebox(data,BoxSize):
+  box=Box()
+  dim=data.shape[0]
+  box.setBox(data,{'dim':dim,'HIIdim':dim,'BoxSize':BoxSize,'z':10.0})
+  return box
+
+
+@pytest.mark.parametrize('BoxSize',[75,143,300,256])
+@pytest.mark.parametrize('log',[True,False])
+def test_binSpectrum_keeps_every_mode(BoxSize,log):
+  #a flat spectrum must come back flat, with every k>0 mode in some bin
+  dim=32
+  power=np.ones((dim,dim,dim/2+1))
+  k,P,nmodes=boxstats.binSpectrum(power,dim,BoxSize,nbins=10,log=log)
+  assert nmodes.sum()==dim**3-1
+  assert nmodes[0]>=6
+  assert np.allclose(P[nmodes>0],1.0)
+  kf=2*np.pi/BoxSize
+  assert np.isclose(k[0],kf) if log else k[0]>=kf*0.99999
+
+
+@pytest.mark.parametrize('BoxSize',[143,300])
+def test_boxPowerSpectrum_plane_wave(BoxSize):
+  #a cosine along one axis puts all its power at 3 times the fundamental
+  dim=24
+  x=np.arange(dim)
+  data=np.cos(2*np.pi*3*x/dim)[:,None,None]*np.ones((dim,dim,dim))
+  k,P,nmodes=boxstats.boxPowerSpectrum(makebox(data.astype(np.float32),BoxSize),nbins=12,log=False)
+  power=np.nan_to_num(P*nmodes)
+  peak=np.argmax(power)
+  kf=2*np.pi/BoxSize
+  width=(np.sqrt(3)*np.pi*dim/BoxSize-kf)/12
+  assert abs(k[peak]-3*kf)<width
+  assert power[peak]>0.999*power.sum()
+
+
+def test_kBlock_matches_kGrid():
+  dim=16
+  kgrid=fftutils.kGrid(dim,143.)
+  assert kgrid.shape==(dim,dim,dim/2+1)
+  assert np.array_equal(fftutils.kBlock(dim,143.),kgrid)
+  assert np.array_equal(fftutils.kBlock(dim,143.,rows=slice(2,5),cols=slice(3,7)),kgrid[2:5,3:7])
+  assert np.allclose(fftutils.kBlock(dim,143.,dtype=np.float64),kgrid,rtol=1e-6)
+  assert fftutils.kGrid(dim,143.).dtype==np.float32
+  assert fftutils.kBlock(dim,143.,dtype=np.float64).dtype==np.float64
+
+
+def test_kBins_cached_and_blocked(monkeypatch):
+  dim=20
+  (indx,k,nmodes)=fftutils.kBins(dim,143.,nbins=7,log=False)
+  assert fftutils.kBins(dim,143.,nbins=7,log=False)[0] is indx
+  #building a block of rows at a time gives the bins of the whole grid
+  monkeypatch.setattr(fftutils,'kbincache',{})
+  monkeypatch.setattr(fftutils,'blockRows',lambda dim,ncells=2**22: 3)
+  (blocked,kb,nb)=fftutils.kBins(dim,143.,nbins=7,log=False)
+  assert np.array_equal(blocked,indx)
+  assert np.allclose(kb,k) and np.array_equal(nb,nmodes)
+  assert indx[0,0,0]==7 and (indx<7).sum()==indx.size-1
+  power=np.random.RandomState(0).rand(dim,dim,dim/2+1).astype(np.float32)
+  (k2,P,n2)=boxstats.binSpectrum(power,dim,143.,nbins=7,log=False)
+  weights=np.broadcast_to(fftutils.halfWeights(dim),power.shape)
+  expected=[(weights*power)[indx==b].sum()/weights[indx==b].sum() for b in range(7)]
+  assert np.allclose(P,expected)
+
+
+class EmptyRun:
+  def iterslices(self,filter):
+    return iter([])
+
+
+def test_runPowerSpectrum_without_boxes():
+  (redshifts,k,P,nmodes)=boxstats.runPowerSpectrum(EmptyRun(),nbins=5)
+  assert redshifts==[] and len(k)==0 and len(P)==0
+  assert np.array_equal(nmodes,np.zeros(5))
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from tocmfastpy import tocmphysics
+from tocmfastpy.Box import Box
+
+Z=9.0
+BOXSIZE=30.0
+
+
+def fields(dim=12,seed=3):
+  """float32 density, xH and velocity boxes, the velocities large enough
+  for dv/dr/H to pass MAX_DVDR in some cells"""
+  state=np.random.RandomState(seed)
+  density=(state.lognormal(0,0.5,(dim,dim,dim))-1).astype(np.float32)
+  xH=state.rand(dim,dim,dim).astype(np.float32)
+  xH[xH<0.3]=0
+  H=tocmphysics.hubble(Z)
+  v=[(state.randn(dim,dim,dim)*0.2*H*BOXSIZE/dim).astype(np.float32) for axis in range(3)]
+  return density,xH,v
+
+
+def reference(density,xH,v=None,los=2,TS=None):
+  """deltaT_b of the whole box at once in float64"""
+  deltaT=tocmphysics.deltaTbNorm(Z)*xH.astype(np.float64)*(1+density.astype(np.float64))
+  if TS is not None:
+    deltaT*=1-tocmphysics.TCMB0*(1+Z)/np.asarray(TS,dtype=np.float64)
+  if v is not None:
+    v=v.astype(np.float64)
+    dr=BOXSIZE/density.shape[los]
+    dvdr=(np.roll(v,-1,axis=los)-np.roll(v,1,axis=los))/(2*dr*tocmphysics.hubble(Z))
+    deltaT/=1+np.clip(dvdr,-tocmphysics.MAX_DVDR,tocmphysics.MAX_DVDR)
+  return deltaT
+
+
+@pytest.mark.parametrize('los',[0,1,2])
+def test_getDeltaTb_matches_whole_box(los):
+  (density,xH,v)=fields()
+  expected=reference(density,xH,v[los],los)
+  dvdr=(np.roll(v[los],-1,axis=los)-np.roll(v[los],1,axis=los))/(2*BOXSIZE/12*tocmphysics.hubble(Z))
+  assert (np.abs(dvdr)>tocmphysics.MAX_DVDR).mean()>0.1
+  for nslab in (1,5,16):
+    deltaT=tocmphysics.getDeltaTb(Z,density,xH,v[los],BOXSIZE,los,nslab=nslab)
+    assert deltaT.dtype==np.float32
+    assert np.allclose(deltaT,expected,rtol=1e-5,atol=1e-5)
+
+
+def test_getDeltaTb_without_rsd():
+  (density,xH,v)=fields()
+  out=np.zeros(density.shape,dtype=np.float32)
+  deltaT=tocmphysics.getDeltaTb(Z,density,xH,out=out,nslab=5)
+  assert deltaT is out
+  assert np.allclose(deltaT,reference(density,xH),rtol=1e-6,atol=1e-5)
+  TS=np.random.RandomState(4).uniform(50,500,density.shape)
+  assert np.allclose(tocmphysics.getDeltaTb(Z,density,xH,TS=TS,nslab=5),reference(density,xH,TS=TS),
+                     rtol=1e-5,atol=1e-5)
+  assert np.allclose(tocmphysics.getDeltaTb(Z,density,xH,TS=200.),reference(density,xH,TS=200.),
+                     rtol=1e-5,atol=1e-5)
+
+
+class FakeSlice:
+  def __init__(self,density,xH,v):
+    param_dict={'dim':density.shape[0],'HIIdim':density.shape[0],'BoxSize':BOXSIZE,'z':Z,'type':'density'}
+    self.density=Box()
+    self.density.setBox(density,dict(param_dict))
+    self.xH=Box()
+    self.xH.setBox(xH,dict(param_dict,type='xh'))
+    (self.vx,self.vy,self.vz)=[[] for axis in range(3)]
+    for (axis,box) in v.items():
+      vbox=Box()
+      vbox.setBox(box,dict(param_dict,type='v'))
+      setattr(self,'v'+'xyz'[axis],vbox)
+
+
+def test_sliceDeltaTb():
+  (density,xH,v)=fields()
+  box=tocmphysics.sliceDeltaTb(FakeSlice(density,xH,{1:v[1]}),los=1,nslab=4)
+  assert box.param_dict['type']=='deltaT' and box.z==Z
+  assert np.allclose(box.box_data,reference(density,xH,v[1],1),rtol=1e-5,atol=1e-5)
+  #no velocity box along the line of sight leaves out the distortions
+  box=tocmphysics.sliceDeltaTb(FakeSlice(density,xH,{1:v[1]}),los=2)
+  assert np.allclose(box.box_data,reference(density,xH),rtol=1e-6,atol=1e-5)
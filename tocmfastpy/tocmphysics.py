@@ -9,6 +9,9 @@ on the box itself and its parameters and data
 This file contains the physics of the 21cm line to calculate the optical
 depth and other important quantities
 
+Cosmological parameters are passed as a dictionary in the cosmolopy
+convention, defaulting to Planck13 as used elsewhere in this project
+
 """
 from Box import *
 from PDF import *
@@ -18,6 +21,10 @@ import math
 import string
 import matplotlib.pyplot as plt
 
+Planck13={'omega_M_0':0.315,'omega_b_0':0.0487,'omega_lambda_0':0.685,'h':0.673}
+TCMB0=2.725    #CMB temperature today in K
+MAX_DVDR=0.2   #maximum velocity gradient in units of H, as in 21cmFast
+
 def getTau(z,density,xH,TS= 1):
     """
     Given NumPy arrays for density, xH and TS calculate the corresponding
@@ -42,3 +49,124 @@ def getTS(z):
     return TS
 
     
+
+def hubble(z,cosmo=Planck13):
+    """
+    Hubble parameter H(z) in 1/s for a flat universe
+    """
+    H0=cosmo['h']*100.0/3.0856775807e19  #km/s/Mpc in 1/s
+    E=math.sqrt(cosmo['omega_M_0']*pow(1+z,3)+cosmo['omega_lambda_0'])
+    return H0*E
+
+def comovingDistance(z,cosmo=Planck13,nstep=1000):
+    """
+    Comoving distance in Mpc to redshift z (a number or array) for a flat
+    universe, by trapezium rule integration of c/H(z)
+    """
+    zarr=np.atleast_1d(np.asarray(z,dtype=np.float64))
+    zgrid=np.linspace(0,zarr.max(),nstep+1)
+    integrand=2.99792458e5/(cosmo['h']*100.0)/np.sqrt(cosmo['omega_M_0']*(1+zgrid)**3+
+                                                     cosmo['omega_lambda_0'])
+    chi=np.concatenate([[0.0],np.cumsum(0.5*(integrand[1:]+integrand[:-1])*np.diff(zgrid))])
+    dist=np.interp(zarr,zgrid,chi)
+    if np.isscalar(z):
+        return dist[0]
+    return dist
+
+def deltaTbNorm(z,cosmo=Planck13):
+    """
+    Normalisation of the 21cm brightness temperature in mK for a fully
+    neutral cell at mean density with TS>>TCMB, as in 21cmFast
+    """
+    h2=cosmo['h']**2
+    norm=27.0*(cosmo['omega_b_0']*h2/0.023)
+    norm*=math.sqrt(0.15/(cosmo['omega_M_0']*h2)*(1+z)/10.0)
+    return norm
+
+def getDeltaTb(z,density,xH,v=None,BoxSize=None,los=2,TS=None,cosmo=Planck13,
+               out=None,nslab=16):
+    """
+    Given NumPy arrays for density, xH and the line of sight velocity v
+    calculate the 21cm brightness temperature deltaT_b in mK
+
+    deltaT_b=norm*xH*(1+delta)*(1-TCMB(z)/TS)/(1+dv/dr/H)
+
+    Redshift space distortions use the gradient dv/dr of the peculiar
+    velocity along axis los, by periodic central differences with the
+    cell size from BoxSize (Mpc). Velocities are comoving Mpc/s as in the
+    21cmFast velocity boxes. As in 21cmFast, |dv/dr| is capped at MAX_DVDR*H.
+    v=None leaves out redshift space distortions and TS=None assumes
+    TS>>TCMB. TS may be a number or an array like density.
+
+    The box is built slab by slab along the first axis in float32, so
+    nothing beyond a few slab sized temporaries is allocated and the
+    inputs may be memory mapped. out is an optional float32 array (or
+    memmap) to write into.
+    """
+    shape=density.shape
+    if out is None:
+        out=np.empty(shape,dtype=np.float32)
+    norm=np.float32(deltaTbNorm(z,cosmo))
+    Tcmb=TCMB0*(1+z)
+
+    if v is not None:
+        H=hubble(z,cosmo)
+        dr=BoxSize/float(shape[los])
+        #dv/dr/H from the velocity difference across two cells
+        vscale=np.float32(1.0/(2.0*dr*H))
+
+    for i0 in range(0,shape[0],nslab):
+        i1=min(i0+nslab,shape[0])
+        slab=out[i0:i1]
+        np.add(density[i0:i1],np.float32(1),out=slab)
+        slab*=xH[i0:i1]
+        slab*=norm
+
+        if TS is not None:
+            if np.isscalar(TS):
+                slab*=np.float32(1-Tcmb/TS)
+            else:
+                slab*=1-np.float32(Tcmb)/np.asarray(TS[i0:i1],dtype=np.float32)
+
+        if v is not None:
+            if los==0:
+                #neighbouring planes wrap periodically around the box
+                above=np.arange(i0+1,i1+1)%shape[0]
+                below=np.arange(i0-1,i1-1)%shape[0]
+                dvdr=np.asarray(v[above],dtype=np.float32)
+                dvdr-=v[below]
+            else:
+                vslab=np.asarray(v[i0:i1],dtype=np.float32)
+                dvdr=np.roll(vslab,-1,axis=los)
+                dvdr-=np.roll(vslab,1,axis=los)
+            dvdr*=vscale
+            np.clip(dvdr,-MAX_DVDR,MAX_DVDR,out=dvdr)
+            dvdr+=np.float32(1)
+            slab/=dvdr
+
+    return out
+
+def sliceDeltaTb(slice,los=2,TS=None,cosmo=Planck13,nslab=16):
+    """
+    Build a deltaT Box from the density, xH and line of sight velocity
+    boxes loaded in a Slice, using getDeltaTb. los is 0,1,2 for vx,vy,vz.
+    Redshift space distortions are left out if the velocity box is not
+    loaded.
+    """
+    density=slice.density
+    param_dict=dict(density.param_dict)
+    v=[slice.vx,slice.vy,slice.vz][los]
+    if isinstance(v,Box):
+        v=v.box_data
+    else:
+        print "No velocity box loaded, so no redshift space distortions"
+        v=None
+
+    deltaT=getDeltaTb(density.z,density.box_data,slice.xH.box_data,v,
+                      param_dict['BoxSize'],los,TS,cosmo,nslab=nslab)
+
+    param_dict['type']='deltaT'
+    param_dict['filename']=''
+    box=Box()
+    box.setBox(deltaT,param_dict)
+    return box
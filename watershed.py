@@ -67,7 +67,7 @@ def watershed_3d(image, connectivity=2, h=0.7, target='cuda', edtfile=None):
         try:
             EDT = np.load(edtfile)['EDT']
         except:
-            EDT = ndimage.distance_transform_edt(ionized)
+            EDT = ndimage.distance_transform_edt(ionized).astype(np.float32)
         #EDT_c = edt_cuda.distance_transform_edt(arr=ionized)
         #
         maxima, smEDT = local_maxima_gpu(EDT.copy(), ionized, connectivity=connectivity, threshold_h=h)
@@ -84,7 +84,7 @@ def watershed_3d(image, connectivity=2, h=0.7, target='cuda', edtfile=None):
             import IPython; IPython.embed()
     elif target == 'cpu':
         print 'Computing EDT'
-        EDT = ndimage.distance_transform_edt(ionized)
+        EDT = ndimage.distance_transform_edt(ionized).astype(np.float32)
         maxima, smEDT = local_maxima_cpu(EDT.copy(), ionized, connectivity=connectivity, threshold_h=h)
         print 'Computing watershed'
         markers = measure.label(maxima, connectivity=connectivity)
@@ -228,7 +228,8 @@ if __name__ == '__main__':
         Q_a = 1 - b1.param_dict['nf']
         print 'Q', Q_a
         print 'saving', OUTFILE
-        np.savez(OUTFILE, Q=Q_a, scale=scale, labels=labels, markers=markers, EDT=EDT, smEDT=smEDT)
+        np.savez(OUTFILE, Q=Q_a, scale=scale, labels=labels.astype(np.int32), markers=markers.astype(np.int32),
+            EDT=EDT, smEDT=smEDT.astype(np.float32))
 
 
     #hist, bins = get_size_dist(labels, Q, scale=scale)
@@ -25,7 +25,7 @@ def watershed(I, mask=None):
   height, width, depth = I.shape
   I = np.float32(I.copy())
   if mask is None:
-    mask = np.ones(I.shape)
+    mask = np.ones(I.shape, dtype=np.int32)
   mask = np.int32(mask)
 
   # Get block/grid size for steps 1-3.
@@ -41,8 +41,7 @@ def watershed(I, mask=None):
   #               depth/(block_size2[0]-2)+1)
 
   # Initialize variables.
-  labeled       = np.zeros([height,width,depth]) 
-  labeled       = np.float64(labeled)
+  labeled       = np.zeros([height,width,depth], dtype=np.int32)
   width         = np.int32(width)
   height        = np.int32(height)
   depth         = np.int32(depth)